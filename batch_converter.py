@@ -0,0 +1,299 @@
+import glob
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from conversion_cache import ConversionCache, file_stat
+from simple_converter import convert_file, output_options
+
+"""
+usage: python batch_converter.py [-j WORKERS] [-o OUTPUT_DIR] [--manifest FILE] [source ...] loader_id
+
+Convert many results files into NeXus files in parallel.  Each source is a
+directory (all files matching --pattern), a glob pattern or a single file;
+a manifest lists one input file per line.  With --cache, inputs whose NeXus
+file is current are skipped (see conversion_cache).
+"""
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATTERN = "*.hdf"
+# as creator.nx_creator_xpcs.NX_EXTENSION, not imported from there: that loads numpy and h5py
+NX_EXTENSION = ".nxs"
+
+
+def collect_inputs(sources=(), manifest=None, pattern=DEFAULT_PATTERN):
+    """
+    Expand directories, glob patterns and a manifest into a sorted list of input files
+
+    :param sources: directories, glob patterns or file names
+    :param manifest: text file with one input file per line (``#`` starts a comment)
+    :param pattern: glob pattern used for directories
+    """
+    inputs = []
+    for source in sources:
+        if os.path.isdir(source):
+            inputs.extend(glob.glob(os.path.join(source, pattern)))
+        elif glob.has_magic(source):
+            inputs.extend(glob.glob(source))
+        else:
+            inputs.append(source)
+    if manifest is not None:
+        with open(manifest, "r") as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    inputs.append(line)
+    # drop files listed more than once
+    return sorted(set(os.path.abspath(p) for p in inputs))
+
+
+def output_name(input_filename, output_dir=None):
+    """NeXus file name for ``input_filename``, next to the input or in ``output_dir``"""
+    stem = os.path.splitext(os.path.basename(input_filename))[0]
+    directory = output_dir if output_dir is not None else os.path.dirname(input_filename)
+    return os.path.join(directory, stem + NX_EXTENSION)
+
+
+def _convert_one(input_filename, output_filename, loader_id, use_q_values, find_beam_center=False,
+                 map_library=None, derive_g2=False):
+    """Worker: convert one file, never raise (per-file error isolation)"""
+    result = dict(input=input_filename,
+                  output=output_filename,
+                  input_bytes=0,
+                  output_bytes=0,
+                  seconds=0.0,
+                  error=None)
+    t0 = time.perf_counter()
+    try:
+        result["input_bytes"] = os.path.getsize(input_filename)
+        convert_file(input_filename, output_filename, loader_id, use_q_values=use_q_values,
+                     find_beam_center=find_beam_center, map_library=map_library, derive_g2=derive_g2)
+        result["output_bytes"] = os.path.getsize(output_filename)
+    except Exception as exc:
+        result["error"] = f"{type(exc).__name__}: {exc}"
+        result["traceback"] = traceback.format_exc()
+    result["seconds"] = time.perf_counter() - t0
+    return result
+
+
+def _skipped(input_filename, output_filename):
+    return dict(input=input_filename, output=output_filename, input_bytes=0, output_bytes=0,
+                seconds=0.0, error=None, skipped=True)
+
+
+def convert_batch(inputs, loader_id, output_dir=None, workers=None, use_q_values=False,
+                  find_beam_center=False, map_library=None, derive_g2=False, cache=None):
+    """
+    Convert all ``inputs`` with a pool of worker processes
+
+    A failing file does not stop the batch, it is reported in the summary.
+
+    :param inputs: list of input (results) files
+    :param loader_id: "aps" or "nslsii"
+    :param output_dir: directory for the NeXus files, default: next to each input
+    :param workers: number of worker processes, default: number of CPUs; 1 converts in this process
+    :param use_q_values: use q values instead of indices for dynamic_q_list (NSLS-II only)
+    :param find_beam_center: estimate the beam centers from the SAXS 2D images
+    :param map_library: directory of the masks and q maps shared by all NeXus files
+                        (see :mod:`creator.nx_library_xpcs`), default: copy them into each file
+    :param derive_g2: derive g2_from_two_time_corr_func from the two-time correlation function
+                      for inputs that lack it
+    :param cache: :class:`conversion_cache.ConversionCache`, inputs whose NeXus file is
+                  current are skipped, successful conversions are recorded
+    :return *dict*: summary report, see :func:`summarize`
+    """
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    t0 = time.perf_counter()
+    results = []
+    options = output_options(use_q_values=use_q_values, find_beam_center=find_beam_center,
+                             map_library=map_library, derive_g2=derive_g2)
+    jobs = []
+    stats = {}  # input -> file_stat before the conversion, for the cache
+    for p in inputs:
+        output = output_name(p, output_dir)
+        if cache is not None:
+            if cache.is_current(p, output, loader_id, **options):
+                results.append(_skipped(p, output))
+                continue
+            stats[p] = file_stat(p)
+        jobs.append((p, output, loader_id, use_q_values, find_beam_center, map_library, derive_g2))
+    if results:
+        logger.info("%d of %d files are current", len(results), len(inputs))
+
+    def finished(result):
+        results.append(result)
+        _log_result(result)
+        if cache is not None and result["error"] is None:
+            cache.record(result["input"], result["output"], loader_id, stat=stats[result["input"]], **options)
+
+    if workers == 1:
+        for job in jobs:
+            finished(_convert_one(*job))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_convert_one, *job): job for job in jobs}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    # the worker process itself died (e.g. crash in the HDF5 library)
+                    job = futures[future]
+                    result = dict(input=job[0], output=job[1], input_bytes=0, output_bytes=0,
+                                  seconds=0.0, error=f"{type(exc).__name__}: {exc}")
+                finished(result)
+    return summarize(results, time.perf_counter() - t0)
+
+
+def _log_result(result):
+    if result["error"] is None:
+        logger.info("converted %s (%.2f s)", result["input"], result["seconds"])
+    else:
+        logger.error("FAILED %s: %s", result["input"], result["error"])
+
+
+def summarize(results, elapsed):
+    """
+    Summary report of a batch
+
+    :param results: per-file results of :func:`_convert_one`
+    :param elapsed: wall time of the batch in seconds
+    """
+    converted = [r for r in results if r["error"] is None and not r.get("skipped")]
+    input_bytes = sum(r["input_bytes"] for r in converted)
+    elapsed = max(elapsed, 1e-9)
+    failed = [r for r in results if r["error"] is not None]
+    return dict(files=len(results),
+                converted=len(converted),
+                skipped=len(results) - len(converted) - len(failed),
+                failed=len(failed),
+                seconds=elapsed,
+                files_per_second=len(converted) / elapsed,
+                megabytes_per_second=input_bytes / 1e6 / elapsed,
+                input_bytes=input_bytes,
+                output_bytes=sum(r["output_bytes"] for r in converted),
+                failures=[dict(input=r["input"], error=r["error"]) for r in results if r["error"] is not None],
+                results=sorted(results, key=lambda r: r["input"]))
+
+
+def get_user_parameters():
+    """configure user's command line parameters from sys.argv"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=sys.argv[0], description="NXxpcs batch writer"
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="logging verbosity",
+    )
+    parser.add_argument(
+        "sources",
+        nargs="*",
+        help="input directories, glob patterns or files",
+    )
+    parser.add_argument(
+        "Loader_id",
+        action="store",
+        help="Loader ID defines Loader type",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="text file with one input file per line",
+    )
+    parser.add_argument(
+        "--pattern",
+        default=DEFAULT_PATTERN,
+        help=f"glob pattern for input directories, default: {DEFAULT_PATTERN}",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        help="directory for the NeXus files, default: next to each input file",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="number of worker processes, default: number of CPUs",
+    )
+    parser.add_argument(
+        "--report",
+        help="write the summary report as JSON to this file",
+    )
+    parser.add_argument(
+        "--use_q_values",
+        action="store_true",
+        help="Use this to use q values for dynamic_q_list instead of index values",
+    )
+    parser.add_argument(
+        "--find_beam_center",
+        action="store_true",
+        help="Estimate the beam centers from the time-averaged SAXS 2D images",
+    )
+    parser.add_argument(
+        "--map_library",
+        help="directory of the masks and q maps shared by all NeXus files",
+    )
+    parser.add_argument(
+        "--derive_g2",
+        action="store_true",
+        help="Derive g2_from_two_time_corr_func from the two-time correlation function "
+             "if an input file lacks it",
+    )
+    parser.add_argument(
+        "--cache",
+        help="SQLite file of the conversions, skip inputs whose NeXus file is current",
+    )
+    parser.add_argument(
+        "--digest",
+        action="store_true",
+        help="Compare the content of touched input files (sha256) with the cache",
+    )
+    return parser.parse_args()
+
+
+def main():
+    options = get_user_parameters()
+    logging.basicConfig(level=logging.INFO if options.verbose else logging.WARNING)
+
+    inputs = collect_inputs(options.sources, options.manifest, options.pattern)
+    cache = None
+    if options.cache is not None:
+        cache = ConversionCache(options.cache, digest="sha256" if options.digest else None)
+    try:
+        summary = convert_batch(inputs,
+                                options.Loader_id,
+                                output_dir=options.output_dir,
+                                workers=options.workers,
+                                use_q_values=options.use_q_values,
+                                find_beam_center=options.find_beam_center,
+                                map_library=options.map_library,
+                                derive_g2=options.derive_g2,
+                                cache=cache)
+    finally:
+        if cache is not None:
+            cache.close()
+    print(f"converted {summary['converted']}/{summary['files']} files in {summary['seconds']:.1f} s "
+          f"({summary['files_per_second']:.2f} files/s, {summary['megabytes_per_second']:.1f} MB/s), "
+          f"{summary['skipped']} current files skipped")
+    for failure in summary["failures"]:
+        print(f"FAILED {failure['input']}: {failure['error']}")
+    if options.report is not None:
+        with open(options.report, "w") as f:
+            json.dump(summary, f, indent=2)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""
+Benchmark the conversion of synthetic results files at beamline scale.
+
+usage: python -m benchmarks.bench_conversion [--scale NAME] [--loader aps|nslsii] [--detector ROWSxCOLS]
+                                             [--q N] [--tau N] [--frames N] [--no-two-time]
+                                             [--workdir DIR] [--output FILE]
+
+For every stage of the conversion (loader calls and NXCreator group writers)
+the wall time, the peak RSS and the bytes read and written are recorded and
+printed (or appended to ``--output``) as JSON lines.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic_xpcs import MAKERS, SCALES
+from creator.nx_creator_xpcs import NXCreator
+from creator.nx_trace_xpcs import io_counters, peak_rss_bytes, reset_peak_rss
+from simple_converter import conversion_stages, get_loader
+
+
+class StageRecorder:
+    """
+    Record wall time, peak RSS and I/O bytes of named stages.
+
+    :param output_filename: NeXus file, its growth is used when /proc/self/io is not available
+    """
+
+    def __init__(self, output_filename=None):
+        self.output_filename = output_filename
+        self.records = []
+
+    def run(self, name, func, *args, **kwargs):
+        reset_peak_rss()
+        io_before = io_counters()
+        size_before = self._output_size()
+        t0 = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - t0
+        io_after = io_counters()
+        record = dict(stage=name,
+                      seconds=seconds,
+                      peak_rss_bytes=peak_rss_bytes())
+        if io_before is not None and io_after is not None:
+            record["bytes_read"] = io_after[0] - io_before[0]
+            record["bytes_written"] = io_after[1] - io_before[1]
+        else:
+            record["bytes_written"] = self._output_size() - size_before
+        self.records.append(record)
+        return result
+
+    def _output_size(self):
+        if self.output_filename is None or not os.path.exists(self.output_filename):
+            return 0
+        return os.path.getsize(self.output_filename)
+
+
+def bench_conversion(input_filename, output_filename, loader_id, **creator_options):
+    """
+    Convert ``input_filename`` stage by stage and record every stage
+
+    :param input_filename: synthetic results file
+    :param output_filename: NeXus file to write
+    :param loader_id: "aps" or "nslsii"
+    :param creator_options: keyword arguments for the NXCreator
+    :return *list*: one record per stage
+    """
+    recorder = StageRecorder(output_filename)
+    loader = recorder.run("open_loader", get_loader, input_filename, loader_id)
+    try:
+        with NXCreator(output_filename, **creator_options) as creator:
+            recorder.run("init_file", creator.init_file)
+            recorder.run("create_entry_group", creator.create_entry_group)
+            for method, produce in conversion_stages(loader):
+                kwargs = recorder.run(f"load:{method}", produce)
+                recorder.run(method, getattr(creator, method), **kwargs)
+            recorder.run("close", creator.close)
+    finally:
+        loader.close()
+    return recorder.records
+
+
+def get_user_parameters():
+    """configure user's command line parameters from sys.argv"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=sys.argv[0], description="NXxpcs conversion benchmark"
+    )
+    parser.add_argument("--scale", choices=sorted(SCALES), default="tiny", help="named scale (default: tiny)")
+    parser.add_argument("--loader", choices=sorted(MAKERS), default="aps", help="source file layout")
+    parser.add_argument("--detector", help="detector shape as ROWSxCOLS, overrides the scale")
+    parser.add_argument("--q", type=int, help="number of dynamic q-bins, overrides the scale")
+    parser.add_argument("--tau", type=int, help="number of g2 delays, overrides the scale")
+    parser.add_argument("--frames", type=int, help="frames of the two-time data, overrides the scale")
+    parser.add_argument("--no-two-time", action="store_true", help="source without two-time data")
+    parser.add_argument("--workdir", help="directory for the generated files, default: a temporary directory")
+    parser.add_argument("--output", help="append the JSON lines to this file instead of printing them")
+    return parser.parse_args()
+
+
+def main():
+    options = get_user_parameters()
+    scale = dict(SCALES[options.scale])
+    if options.detector:
+        scale["detector_shape"] = tuple(int(n) for n in options.detector.lower().split("x"))
+    for key, value in (("n_q", options.q), ("n_tau", options.tau), ("frames", options.frames)):
+        if value is not None:
+            scale[key] = value
+
+    with tempfile.TemporaryDirectory(dir=options.workdir) as workdir:
+        input_filename = os.path.join(workdir, f"synthetic_{options.loader}.hdf")
+        output_filename = os.path.join(workdir, "synthetic.nxs")
+        t0 = time.perf_counter()
+        MAKERS[options.loader](input_filename, two_time=not options.no_two_time, **scale)
+        generate_seconds = time.perf_counter() - t0
+
+        records = bench_conversion(input_filename, output_filename, options.loader)
+        run = dict(loader=options.loader,
+                   scale=options.scale,
+                   two_time=not options.no_two_time,
+                   input_bytes=os.path.getsize(input_filename),
+                   output_bytes=os.path.getsize(output_filename),
+                   generate_seconds=generate_seconds,
+                   **{k: list(v) if isinstance(v, tuple) else v for k, v in scale.items()})
+
+    lines = [json.dumps(dict(run, **record)) for record in records]
+    if options.output:
+        with open(options.output, "a") as f:
+            f.write("\n".join(lines) + "\n")
+    else:
+        print("\n".join(lines))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Compare dense and sparse (photon event) frame stacks at low count rates.
+
+usage: python -m benchmarks.bench_sparse [--frames N] [--detector ROWSxCOLS] [--rate R [R ...]]
+                                         [--workdir DIR] [--output FILE]
+
+For every count rate (mean photons per pixel and frame) a Poisson frame stack
+is written densely (chunked per frame, gzip) and as photon events, then the
+frame sum and the multi-tau correlation are computed from both.  File sizes
+and wall times are printed (or appended to ``--output``) as JSON lines.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from creator.nx_multitau_xpcs import multi_tau
+from creator.nx_sparse_xpcs import SparseFrames, write_sparse
+from creator.nx_stream_xpcs import iter_blocks
+
+
+def _timed(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - t0
+
+
+def _dense_frame_sum(frames):
+    total = np.zeros(frames.shape[1:])
+    for _, block in iter_blocks(frames):
+        total += block.sum(axis=0)
+    return total
+
+
+def bench_rate(workdir, frames, detector_shape, rate, seed=0):
+    """
+    Write one Poisson stack densely and sparsely and time both
+
+    :return *dict*: sizes and wall times
+    """
+    rng = np.random.default_rng(seed)
+    dense_name = os.path.join(workdir, f"dense_{rate}.h5")
+    sparse_name = os.path.join(workdir, f"sparse_{rate}.h5")
+    with h5py.File(dense_name, "w") as f:
+        ds = f.create_dataset("frames", shape=(frames,) + detector_shape, dtype=np.uint16,
+                              chunks=(1,) + detector_shape, compression="gzip")
+        for start in range(0, frames, 100):
+            stop = min(start + 100, frames)
+            ds[start:stop] = rng.poisson(rate, (stop - start,) + detector_shape)
+    with h5py.File(dense_name, "r") as f, h5py.File(sparse_name, "w") as s:
+        write_sparse(s.create_group("events"), f["frames"])
+
+    y, x = np.indices(detector_shape)
+    r = np.hypot(y - detector_shape[0] / 2, x - detector_shape[1] / 2)
+    roi_map = np.minimum((r / r.max() * 8).astype(int) + 1, 8)
+
+    with h5py.File(dense_name, "r") as f, h5py.File(sparse_name, "r") as s:
+        dense, sparse = f["frames"], SparseFrames(s["events"])
+        record = dict(frames=frames,
+                      detector_shape=list(detector_shape),
+                      rate=rate,
+                      events=sparse.nnz,
+                      dense_bytes=os.path.getsize(dense_name),
+                      sparse_bytes=os.path.getsize(sparse_name),
+                      dense_frame_sum_seconds=_timed(_dense_frame_sum, dense),
+                      sparse_frame_sum_seconds=_timed(sparse.pixel_sum),
+                      dense_multi_tau_seconds=_timed(multi_tau, dense, roi_map),
+                      sparse_multi_tau_seconds=_timed(multi_tau, sparse, roi_map))
+    return record
+
+
+def get_user_parameters():
+    """configure user's command line parameters from sys.argv"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=sys.argv[0], description="dense vs. sparse frame benchmark"
+    )
+    parser.add_argument("--frames", type=int, default=2000, help="number of frames (default: 2000)")
+    parser.add_argument("--detector", default="256x256", help="detector shape as ROWSxCOLS (default: 256x256)")
+    parser.add_argument("--rate", type=float, nargs="+", default=[0.001, 0.01, 0.1],
+                        help="mean photons per pixel and frame")
+    parser.add_argument("--workdir", help="directory for the generated files, default: a temporary directory")
+    parser.add_argument("--output", help="append the JSON lines to this file instead of printing them")
+    return parser.parse_args()
+
+
+def main():
+    options = get_user_parameters()
+    detector_shape = tuple(int(n) for n in options.detector.lower().split("x"))
+    with tempfile.TemporaryDirectory(dir=options.workdir) as workdir:
+        lines = [json.dumps(bench_rate(workdir, options.frames, detector_shape, rate))
+                 for rate in options.rate]
+    if options.output:
+        with open(options.output, "a") as f:
+            f.write("\n".join(lines) + "\n")
+    else:
+        print("\n".join(lines))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark the cold start of the converter: one fresh Python process per run.
+
+usage: python -m benchmarks.bench_startup [--repeat N] [--output FILE]
+
+Workflow systems start one short-lived process per file, so the time to
+import the converter counts for every file.  Each case runs ``--repeat``
+times in a new interpreter; the fastest run, the modules of
+:data:`HEAVY_MODULES` the case imported and the wall time are printed (or
+appended to ``--output``) as JSON lines.
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("numpy", "h5py", "pint")
+
+# code of the cases, run with the repository as working directory
+IMPORT_API = "import simple_converter"
+IMPORT_BATCH = "import batch_converter"
+CONVERT = """
+from simple_converter import convert
+convert({input!r}, {output!r}, {loader_id!r})
+"""
+REPORT = """
+import sys
+print(",".join(m for m in {modules!r} if m in sys.modules))
+"""
+
+
+def run_case(code, repeat=3):
+    """
+    Run ``code`` in ``repeat`` fresh interpreters
+
+    :param code: Python source of the case
+    :param repeat: number of runs
+    :return *dict*: ``seconds`` (fastest run) and ``modules`` (heavy modules imported)
+    """
+    source = code + REPORT.format(modules=HEAVY_MODULES)
+    seconds = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", source], cwd=REPO, capture_output=True,
+                                text=True, check=True)
+        seconds.append(time.perf_counter() - t0)
+    modules = result.stdout.strip().splitlines()[-1] if result.stdout.strip() else ""
+    return dict(seconds=min(seconds), modules=[m for m in modules.split(",") if m])
+
+
+def bench_startup(input_filename=None, output_filename=None, loader_id="aps", repeat=3):
+    """
+    Cold start of the interpreter, of importing the converters and of a whole conversion
+
+    :param input_filename: results file of the conversion case, None: no conversion case
+    :param output_filename: NeXus file of the conversion case
+    :param loader_id: "aps" or "nslsii"
+    :param repeat: runs per case
+    :return *list*: one record per case
+    """
+    cases = [("python", ""), ("import_api", IMPORT_API), ("import_batch", IMPORT_BATCH)]
+    if input_filename is not None:
+        cases.append(("convert", CONVERT.format(input=str(input_filename), output=str(output_filename),
+                                                loader_id=loader_id)))
+    return [dict(case=name, **run_case(code, repeat)) for name, code in cases]
+
+
+def get_user_parameters():
+    """configure user's command line parameters from sys.argv"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=sys.argv[0], description="NXxpcs converter cold-start benchmark"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="runs per case (default: 5)")
+    parser.add_argument("--loader", default="aps", help="source file layout of the conversion case")
+    parser.add_argument("--output", help="append the JSON lines to this file instead of printing them")
+    return parser.parse_args()
+
+
+def main():
+    from benchmarks.synthetic_xpcs import MAKERS, SCALES
+
+    options = get_user_parameters()
+    with tempfile.TemporaryDirectory() as workdir:
+        input_filename = os.path.join(workdir, f"synthetic_{options.loader}.hdf")
+        MAKERS[options.loader](input_filename, **SCALES["tiny"])
+        records = bench_startup(input_filename, os.path.join(workdir, "synthetic.nxs"), options.loader,
+                                repeat=options.repeat)
+
+    lines = [json.dumps(record) for record in records]
+    if options.output:
+        with open(options.output, "a") as f:
+            f.write("\n".join(lines) + "\n")
+    else:
+        print("\n".join(lines))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Synthetic XPCS results files in the APS and NSLS-II layouts.
+
+The files contain every field read by ``APSLoader`` and ``NSLSLoader``, at a
+configurable scale (detector shape, number of q-bins, delays, frames, with or
+without two-time data).  Large arrays are written in row tiles so that
+beamline-sized files can be generated without holding them in memory.
+"""
+import h5py
+import numpy as np
+
+# named scales: detector shape, q-bins, delays, frames of the two-time data
+SCALES = {
+    "tiny": dict(detector_shape=(64, 64), n_q=4, n_tau=16, frames=32),
+    "small": dict(detector_shape=(516, 516), n_q=18, n_tau=64, frames=1000),
+    "eiger4m": dict(detector_shape=(2162, 2068), n_q=36, n_tau=120, frames=5000),
+    "twotime": dict(detector_shape=(1030, 1065), n_q=8, n_tau=120, frames=20000),
+}
+
+ROW_TILE_BYTES = 64 * 1024 ** 2
+
+
+def _q_maps(detector_shape, n_q, n_static):
+    """ring shaped dynamic and static roi maps around the detector center"""
+    y, x = np.indices(detector_shape, dtype=np.float32)
+    r = np.hypot(y - detector_shape[0] / 2, x - detector_shape[1] / 2)
+    r /= r.max()
+    dynamic = np.minimum((r * n_q).astype(np.int32) + 1, n_q)
+    static = np.minimum((r * n_static).astype(np.int32) + 1, n_static)
+    return dynamic, static
+
+
+def _write_two_time(dataset, rng, frames):
+    """fill one (frames, frames) dataset tile by tile"""
+    rows = max(1, ROW_TILE_BYTES // (frames * dataset.dtype.itemsize))
+    for start in range(0, frames, rows):
+        stop = min(start + rows, frames)
+        dataset[start:stop] = 1 + rng.random((stop - start, frames), dtype=np.float32)
+
+
+def make_aps_file(filename, detector_shape=(64, 64), n_q=4, n_tau=16, frames=32,
+                  two_time=True, n_static=None, seed=0):
+    """
+    Write a synthetic APS (8-ID-I) results file.
+
+    :param filename: name of the file to write
+    :param detector_shape: (rows, columns) of the detector
+    :param n_q: number of dynamic q-bins
+    :param n_tau: number of delays of g2
+    :param frames: number of frames of the two-time data
+    :param two_time: include ``exchange/C2T_all``
+    :param n_static: number of static q-bins, default: ``10 * n_q``
+    :param seed: seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    n_static = n_static or 10 * n_q
+    dynamic, static = _q_maps(detector_shape, n_q, n_static)
+    with h5py.File(filename, "w") as f:
+        f["/exchange/norm-0-g2"] = 1 + rng.random((n_tau, n_q))
+        f["/exchange/norm-0-stderr"] = 0.01 * rng.random((n_tau, n_q))
+        f["/exchange/tau"] = np.arange(1, n_tau + 1, dtype=np.float64)
+        f["/exchange/g2partials"] = 1 + rng.random((n_tau, n_q, 4))
+        f["/exchange/g2full"] = 1 + rng.random((n_tau, n_q))
+        f["/exchange/partition-mean-total"] = rng.random(n_static)
+        f["/exchange/partition-mean-partial"] = rng.random((10, n_static))
+        f["/exchange/pixelSum"] = rng.random(detector_shape, dtype=np.float32)
+        f["/xpcs/mask"] = np.ones(detector_shape, dtype=np.int32)
+        f["/xpcs/dqmap"] = dynamic
+        f["/xpcs/sqmap"] = static
+        f["/xpcs/dqlist"] = np.linspace(0.001, 0.1, n_q)
+        f["/xpcs/sqlist"] = np.linspace(0.001, 0.1, n_static)
+        f["/xpcs/dphilist"] = np.zeros(n_q)
+        f["/xpcs/sphilist"] = np.zeros(n_static)
+        detector = "/measurement/instrument/detector"
+        f[f"{detector}/exposure_time"] = 1e-4
+        f[f"{detector}/exposure_period"] = 1e-4
+        f[f"{detector}/manufacturer"] = "synthetic"
+        f[f"{detector}/distance"] = 4000.0
+        f[f"{detector}/x_pixel_size"] = 75.0
+        f[f"{detector}/y_pixel_size"] = 75.0
+        f["/measurement/instrument/source_begin/energy"] = 10.0
+        f["/measurement/instrument/acquisition/beam_center_x"] = detector_shape[1] / 2
+        f["/measurement/instrument/acquisition/beam_center_y"] = detector_shape[0] / 2
+        if two_time:
+            for q in range(n_q):
+                ds = f.create_dataset(f"/exchange/C2T_all/c2t_{q + 1:05d}", shape=(frames, frames), dtype=np.float32)
+                _write_two_time(ds, rng, frames)
+
+
+def make_nsls_file(filename, detector_shape=(64, 64), n_q=4, n_tau=16, frames=32,
+                   two_time=True, n_static=None, seed=0):
+    """
+    Write a synthetic NSLS-II (CHX) results file, see :func:`make_aps_file` for the parameters.
+    """
+    rng = np.random.default_rng(seed)
+    n_static = n_static or 10 * n_q
+    dynamic, static = _q_maps(detector_shape, n_q, n_static)
+    with h5py.File(filename, "w") as f:
+        f["imgsum"] = rng.random(frames)
+        f["g2"] = 1 + rng.random((n_tau, n_q))
+        f["g2_stderr"] = 0.01 * rng.random((n_tau, n_q))
+        f["taus"] = np.arange(1, n_tau + 1, dtype=np.float64)
+        f["mask"] = np.ones(detector_shape, dtype=np.int32)
+        f["roi_mask"] = dynamic
+        f["static_roi_map"] = static
+        f["iq_saxs"] = rng.random(n_static)
+        f["q_saxs"] = np.linspace(0.001, 0.1, n_static)
+        f["avg_img"] = rng.random(detector_shape, dtype=np.float32)
+        qval_dict = f.create_group("qval_dict")
+        for q in range(n_q):
+            qval_dict.attrs[str(q)] = [0.001 * (q + 1), 0.0]
+        md = f.create_group("md")
+        md.attrs["detector"] = "synthetic"
+        md.attrs["eiger4m_single_photon_energy"] = 9650.0
+        md.attrs["detector_distance"] = 16.0
+        md.attrs["count_time"] = 1.0
+        md.attrs["frame_time"] = 1.0
+        md.attrs["beam_center_x"] = detector_shape[1] / 2
+        md.attrs["beam_center_y"] = detector_shape[0] / 2
+        md.attrs["x_pixel_size"] = 75.0
+        md.attrs["y_pixel_size"] = 75.0
+        if two_time:
+            ds = f.create_dataset("g12b", shape=(n_q, frames, frames), dtype=np.float32)
+            for q in range(n_q):
+                _write_two_time(_QSlice(ds, q), rng, frames)
+
+
+class _QSlice:
+    """write rows of one q-slice of a (q, frames, frames) dataset"""
+
+    def __init__(self, dataset, q):
+        self._dataset = dataset
+        self._q = q
+        self.dtype = dataset.dtype
+
+    def __setitem__(self, rows, value):
+        self._dataset[self._q, rows] = value
+
+
+MAKERS = {"aps": make_aps_file, "nslsii": make_nsls_file}
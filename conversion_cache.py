@@ -0,0 +1,169 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+"""
+Persistent record of the conversions, to skip inputs whose NeXus file is current.
+
+An SQLite file holds one row per input file: its size, mtime (and optionally a
+content digest) when it was converted, the loader id, the output options,
+the converter version and the size and mtime of the NeXus file written.  An
+input is current (:meth:`ConversionCache.is_current`) when all of these still
+match: one primary key lookup and two ``stat`` calls.  If only the mtime of an
+input changed and the cache keeps digests, the digest decides (and the new
+mtime is recorded).  Every update is one SQLite transaction, so a crash never
+leaves a partially written cache.
+"""
+
+logger = logging.getLogger(__name__)
+
+# part of the key: change it when the converter writes different files from the same input
+CONVERTER_VERSION = "2021.1"
+DIGEST_BLOCK_BYTES = 1024 ** 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversions (
+    input TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT,
+    loader_id TEXT NOT NULL,
+    options TEXT NOT NULL,
+    converter_version TEXT NOT NULL,
+    output TEXT NOT NULL,
+    output_size INTEGER NOT NULL,
+    output_mtime_ns INTEGER NOT NULL,
+    converted REAL NOT NULL
+)
+"""
+
+
+def file_stat(filename):
+    """``(size, mtime_ns)`` of a file, None if it does not exist"""
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def file_digest(filename, algorithm="sha256"):
+    """hex digest of the content of a file"""
+    digest = hashlib.new(algorithm)
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(DIGEST_BLOCK_BYTES), b""):
+            digest.update(block)
+    return f"{algorithm}:{digest.hexdigest()}"
+
+
+class ConversionCache:
+    """
+    Conversions recorded in an SQLite file, see the module documentation.
+
+    ::
+
+        with ConversionCache("conversions.sqlite") as cache:
+            if not cache.is_current(input_filename, output_filename, "aps"):
+                stat = file_stat(input_filename)
+                convert_file(input_filename, output_filename, "aps")
+                cache.record(input_filename, output_filename, "aps", stat=stat)
+
+    :param filename: SQLite file, created if missing
+    :param digest: hashlib algorithm of the content digests (e.g. "sha256"), None: size and mtime only
+    :param version: converter version, part of the key
+    """
+
+    def __init__(self, filename, digest=None, version=CONVERTER_VERSION):
+        self.filename = filename
+        self.digest = digest
+        self.version = version
+        self._db = sqlite3.connect(filename)
+        with self._db:
+            self._db.execute(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM conversions").fetchone()[0]
+
+    @staticmethod
+    def _options(options):
+        return json.dumps(options, sort_keys=True)
+
+    def _row(self, input_filename):
+        return self._db.execute(
+            "SELECT size, mtime_ns, digest, loader_id, options, converter_version, "
+            "output, output_size, output_mtime_ns FROM conversions WHERE input = ?",
+            (os.path.abspath(input_filename),)).fetchone()
+
+    def is_current(self, input_filename, output_filename, loader_id, **options):
+        """
+        `True` if ``output_filename`` was converted from the unchanged ``input_filename``
+        with the same loader, options and converter version and was not changed since
+
+        :param input_filename: input (results) file
+        :param output_filename: NeXus file
+        :param loader_id: "aps" or "nslsii"
+        :param options: options of the conversion that change the output
+        """
+        row = self._row(input_filename)
+        if row is None:
+            return False
+        size, mtime_ns, digest, loader, row_options, version, output, output_size, output_mtime_ns = row
+        if (loader, row_options, version, output) != (loader_id, self._options(options), self.version,
+                                                      os.path.abspath(output_filename)):
+            return False
+        if file_stat(output_filename) != (output_size, output_mtime_ns):
+            return False
+        stat = file_stat(input_filename)
+        if stat == (size, mtime_ns):
+            return True
+        if stat is None or stat[0] != size or self.digest is None or digest is None:
+            return False
+        # same size, new mtime: compare the content
+        if file_digest(input_filename, self.digest) != digest:
+            return False
+        with self._db:
+            self._db.execute("UPDATE conversions SET mtime_ns = ? WHERE input = ?",
+                             (stat[1], os.path.abspath(input_filename)))
+        logger.debug("%s touched but unchanged", input_filename)
+        return True
+
+    def record(self, input_filename, output_filename, loader_id, stat=None, **options):
+        """
+        Record a successful conversion
+
+        :param input_filename: input (results) file
+        :param output_filename: NeXus file written
+        :param loader_id: "aps" or "nslsii"
+        :param stat: ``file_stat`` of the input taken before the conversion started
+                     (default: now), so changes during the conversion are not missed
+        :param options: options of the conversion that change the output
+        """
+        stat = stat or file_stat(input_filename)
+        output_stat = file_stat(output_filename)
+        digest = None
+        if self.digest and file_stat(input_filename) == stat:
+            # (an input changed during the conversion gets no digest and is converted again)
+            digest = file_digest(input_filename, self.digest)
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(input_filename), stat[0], stat[1], digest, loader_id,
+                 self._options(options), self.version, os.path.abspath(output_filename),
+                 output_stat[0], output_stat[1], time.time()))
+
+    def forget(self, input_filename):
+        """drop the record of ``input_filename`` (e.g. after a failed conversion)"""
+        with self._db:
+            self._db.execute("DELETE FROM conversions WHERE input = ?", (os.path.abspath(input_filename),))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Incremental frame sum and average while frames are still being acquired.
+
+:class:`FrameAccumulator` adds batches of frames to a float64 running sum and
+a per-pixel count of valid (finite) values.  Its state is checkpointed into
+the NeXus file, alternating between two slots of the NXcollection
+``<entry>/XPCS/accumulator``; the ``current`` attribute is switched only
+after a slot is completely written and flushed.  A process killed while
+writing a checkpoint thus normally leaves the previous one readable, but
+without SWMR HDF5 gives no guarantee for a file whose writer died in the
+middle of a write: its metadata, and with it the whole file, may be
+corrupt.  A new accumulator on the same file resumes from the last
+checkpoint (see :attr:`FrameAccumulator.frames` for the number of frames to
+skip).
+
+The current average is published to ``<entry>/SAXS_2D/data/I`` at a
+configurable cadence, and :meth:`FrameAccumulator.finalize` writes
+``frame_sum`` and ``frame_average`` of ``<entry>/XPCS/data``.  All groups and
+datasets are written by an :class:`~creator.nx_creator_xpcs.NXCreator` with
+``reuse_groups`` (units check, layout and tracing as for any result); later
+checkpoints and publishes overwrite the values in place.
+"""
+import logging
+
+import h5py
+import numpy as np
+
+from creator.nx_creator_xpcs import NXCreator
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_SLOTS = ("checkpoint_0", "checkpoint_1")
+
+
+def _write(creator, group, name, value, expected=None, supplied=None, **attrs):
+    """
+    Overwrite dataset ``name`` in place, or write it with the creator
+
+    :param creator: NXCreator of the output file
+    :param group: h5parent
+    :param name: name of the dataset
+    :param value: array
+    :param expected: expected units, the units are checked if given
+    :param supplied: supplied units
+    :param attrs: additional attributes for the dataset
+    """
+    ds = group.get(name)
+    if ds is not None and ds.shape == np.shape(value) and ds.dtype == np.asarray(value).dtype:
+        ds[...] = value
+        for k, v in attrs.items():
+            ds.attrs[k] = v
+        return
+    if ds is not None:
+        del group[name]
+    if expected is None:
+        creator._create_dataset(group, name, value, **attrs)
+    else:
+        creator.create_data_with_units(group, name, value, expected, supplied, **attrs)
+
+
+class FrameAccumulator:
+    """
+    Running float64 sum and per-pixel count of frames, checkpointed into the NeXus file.
+
+    ::
+
+        accumulator = FrameAccumulator("results.nxs", (1030, 1065), publish_every=100)
+        for batch in acquisition(skip=accumulator.frames):
+            accumulator.add(batch)
+        accumulator.finalize()
+
+    :param output_filename: NeXus file of the checkpoints and results
+    :param frame_shape: (rows, columns) of the frames
+    :param entry: name of the entry group
+    :param checkpoint_every: write a checkpoint after this many frames (None: only when asked)
+    :param publish_every: publish the average to SAXS_2D/data/I after this many frames (None: never)
+    :param resume: continue from the last checkpoint in the file, if there is one
+    """
+
+    def __init__(self, output_filename, frame_shape, entry="entry", checkpoint_every=1000,
+                 publish_every=None, resume=True):
+        self.output_filename = output_filename
+        self.frame_shape = tuple(frame_shape)
+        self.entry = entry
+        self.checkpoint_every = checkpoint_every
+        self.publish_every = publish_every
+        self.sum = np.zeros(self.frame_shape)
+        self.counts = np.zeros(self.frame_shape, dtype=np.int64)
+        self.frames = 0
+        self._checkpointed = 0
+        self._published = 0
+        if resume:
+            self._resume()
+
+    def _resume(self):
+        try:
+            file = h5py.File(self.output_filename, "r")
+        except OSError:  # no file (yet)
+            return
+        with file:
+            group = file.get(f"{self.entry}/XPCS/accumulator")
+            if group is None or "current" not in group.attrs:
+                return
+            slot = group[group.attrs["current"]]
+            if tuple(slot["frame_sum"].shape) != self.frame_shape:
+                raise ValueError(f"checkpoint has frames of shape {slot['frame_sum'].shape}, "
+                                 f"expected {self.frame_shape}")
+            self.sum = slot["frame_sum"][()]
+            self.counts = slot["counts"][()]
+            self.frames = int(slot.attrs["frames"])
+        self._checkpointed = self._published = self.frames
+        logger.info("resumed %s after %d frames", self.output_filename, self.frames)
+
+    def add(self, frames):
+        """
+        Add a batch of frames (or one frame); NaN and inf pixels are not counted.
+
+        :param frames: array with shape (n, rows, columns) or (rows, columns)
+        """
+        frames = np.asarray(frames)
+        if frames.shape == self.frame_shape:
+            frames = frames[np.newaxis]
+        if tuple(frames.shape[1:]) != self.frame_shape:
+            raise ValueError(f"frames of shape {frames.shape[1:]} do not match {self.frame_shape}")
+        if np.issubdtype(frames.dtype, np.floating):
+            valid = np.isfinite(frames)
+            self.sum += np.where(valid, frames, 0).sum(axis=0)
+            self.counts += valid.sum(axis=0)
+        else:
+            self.sum += frames.sum(axis=0, dtype=np.float64)
+            self.counts += len(frames)
+        self.frames += len(frames)
+
+        if self.checkpoint_every and self.frames - self._checkpointed >= self.checkpoint_every:
+            self.checkpoint()
+        if self.publish_every and self.frames - self._published >= self.publish_every:
+            self.publish()
+
+    @property
+    def frame_sum(self):
+        return self.sum
+
+    @property
+    def frame_average(self):
+        """average of the valid values of every pixel, NaN where there are none"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.sum / self.counts
+
+    def _session(self):
+        """creator on the output file that adds to the groups already in it"""
+        return NXCreator(self.output_filename, reuse_groups=True)
+
+    def _group(self, creator, file, path):
+        """the groups ``path`` below the entry, ``(name, NX_class)`` pairs"""
+        group = creator._init_group(file, self.entry, "NXentry")
+        for name, NX_class in path:
+            group = creator._init_group(group, name, NX_class)
+        return group
+
+    def checkpoint(self):
+        """Write the state into the unused slot, then make it the current one."""
+        with self._session() as creator, creator._open() as file:
+            group = self._group(creator, file, (("XPCS", "NXprocess"), ("accumulator", "NXcollection")))
+            current = group.attrs.get("current", CHECKPOINT_SLOTS[1])
+            name = CHECKPOINT_SLOTS[0] if current == CHECKPOINT_SLOTS[1] else CHECKPOINT_SLOTS[1]
+            slot = group.require_group(name)
+            _write(creator, slot, "frame_sum", self.sum)
+            _write(creator, slot, "counts", self.counts)
+            slot.attrs["frames"] = self.frames
+            file.flush()
+            group.attrs["current"] = name
+            file.flush()
+        self._checkpointed = self.frames
+        logger.debug("checkpoint after %d frames", self.frames)
+
+    def publish(self):
+        """Write the current average to SAXS_2D/data/I."""
+        with self._session() as creator, creator._open() as file:
+            data = self._group(creator, file, (("SAXS_2D", "NXprocess"), ("data", "NXdata")))
+            # as NXCreator.create_saxs_2d_group
+            _write(creator, data, "I", self.frame_average, units="au", frames=self.frames)
+        self._published = self.frames
+
+    def finalize(self, frame_units=None):
+        """
+        Checkpoint, publish and write frame_sum and frame_average of XPCS/data.
+
+        :param frame_units: units of frame_sum and frame_average (checked as by
+                            :meth:`~creator.nx_creator_xpcs.NXCreator.create_xpcs_group`)
+        :return *dict*: ``frame_sum`` and ``frame_average``
+        """
+        self.checkpoint()
+        self.publish()
+        with self._session() as creator, creator._open() as file:
+            data = self._group(creator, file, (("XPCS", "NXprocess"), ("data", "NXdata")))
+            _write(creator, data, "frame_sum", self.frame_sum, 's', frame_units, frames=self.frames)
+            _write(creator, data, "frame_average", self.frame_average, 's', frame_units, frames=self.frames)
+        return dict(frame_sum=self.frame_sum, frame_average=self.frame_average)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Beam center of a SAXS pattern from the ring symmetry of its time-averaged image.
+
+Around the true beam center the intensity of an isotropic pattern depends on
+the distance only, so the variance of the (log) intensity within the rings of
+constant distance is smallest there.  :func:`radial_variance` computes it for
+one candidate with two ``np.bincount`` over the valid pixels.
+
+:func:`find_beam_center` searches coarse to fine: the image is downsampled by
+powers of two until it is at most ``coarse_size`` pixels wide, every pixel of
+the coarsest image (or of the search region) is tried, and each finer level
+only searches the neighborhood of the previous best candidate.  The result is
+refined to sub-pixel precision with a parabola through the scores around the
+best pixel of the full image.  Coordinates are 0-based pixel indices, x along
+the columns and y along the rows, as ``beam_center_x``/``beam_center_y`` of
+the detector group.
+"""
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+COARSE_SIZE = 64  # edge of the coarsest image of the search
+FINE_STEPS = 2  # candidates +/- FINE_STEPS pixels around the previous best, per level
+
+
+def downsample(image, valid, factor):
+    """
+    Mean of the valid pixels of ``factor x factor`` blocks (the image is cropped to full blocks)
+
+    :param image: 2D image
+    :param valid: boolean mask of the pixels to use
+    :param factor: edge of the blocks
+    :return *tuple*: downsampled image and its mask (blocks with any valid pixel)
+    """
+    rows, columns = (n // factor * factor for n in np.shape(image))
+    shape = (rows // factor, factor, columns // factor, factor)
+    weights = valid[:rows, :columns].reshape(shape).sum(axis=(1, 3))
+    sums = np.where(valid, image, 0)[:rows, :columns].reshape(shape).sum(axis=(1, 3), dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return sums / weights, weights > 0
+
+
+class _Level:
+    """valid pixels of one downsampling level, in coordinates of the full image"""
+
+    def __init__(self, image, valid, factor, log=True, r_min=0.0, bin_width=1.0):
+        if factor > 1:
+            image, valid = downsample(image, valid, factor)
+        if log:
+            valid = valid & (image > 0)
+        rows, columns = np.nonzero(valid)
+        offset = (factor - 1) / 2  # center of the block
+        self.x = columns * factor + offset
+        self.y = rows * factor + offset
+        values = image[valid].astype(np.float64)
+        self.values = np.log(values) if log else values
+        self.sum_squares = float(np.sum(self.values ** 2))
+        self.factor = factor
+        self.r_min = r_min
+        self.bin_width = bin_width * factor
+
+    def score(self, x, y):
+        """mean variance within the rings around (x, y)"""
+        r = np.hypot(self.x - x, self.y - y)
+        values = self.values
+        if self.r_min:
+            used = r >= self.r_min
+            r, values = r[used], values[used]
+        if len(values) == 0:
+            return np.inf
+        bins = (r / self.bin_width).astype(np.int64)
+        n = np.bincount(bins)
+        s = np.bincount(bins, weights=values)
+        filled = n > 0
+        sum_squares = self.sum_squares if not self.r_min else float(np.sum(values ** 2))
+        return (sum_squares - np.sum(s[filled] ** 2 / n[filled])) / len(values)
+
+    def best(self, xs, ys):
+        """best of the candidates ``xs x ys`` and the grid of scores (ys, xs)"""
+        scores = np.array([[self.score(x, y) for x in xs] for y in ys])
+        row, column = np.unravel_index(np.argmin(scores), scores.shape)
+        return xs[column], ys[row], scores
+
+
+def radial_variance(image, center, mask=None, log=True, r_min=0.0, bin_width=1.0):
+    """
+    Mean variance of the intensity within rings of ``bin_width`` pixels around ``center``
+
+    :param image: 2D image, e.g. the time-averaged SAXS_2D image
+    :param center: (x, y) in pixels
+    :param mask: nonzero for the pixels to use (default: all pixels)
+    :param log: score the logarithm of the intensity (non-positive pixels are not used)
+    :param r_min: pixels closer to the center are not used
+    :param bin_width: width of the rings in pixels
+    """
+    image = np.asarray(image)
+    valid = np.ones(image.shape, dtype=bool) if mask is None else np.asarray(mask) != 0
+    return _Level(image, valid & np.isfinite(image), 1, log, r_min, bin_width).score(*center)
+
+
+def _parabola_vertex(left, middle, right):
+    """offset of the vertex of the parabola through three equally spaced scores"""
+    curvature = left - 2 * middle + right
+    if not np.isfinite(curvature) or curvature <= 0:
+        return 0.0
+    return float(np.clip((left - right) / (2 * curvature), -0.5, 0.5))
+
+
+def find_beam_center(image, mask=None, guess=None, radius=None, coarse_size=COARSE_SIZE,
+                     log=True, r_min=0.0):
+    """
+    Beam center of an isotropic scattering pattern (see module documentation)
+
+    :param image: 2D image, e.g. the time-averaged SAXS_2D image
+    :param mask: nonzero for the pixels to use (default: all pixels)
+    :param guess: (x, y) center of the search region in pixels (default: center of the image)
+    :param radius: half edge of the search region in pixels (default: the whole image)
+    :param coarse_size: edge of the coarsest image of the search
+    :param log: score the logarithm of the intensity (non-positive pixels are not used)
+    :param r_min: pixels closer to a candidate than this are not used (e.g. the beam stop)
+    :return *tuple*: (x, y) in pixels
+    """
+    image = np.asarray(image)
+    rows, columns = image.shape
+    valid = np.ones(image.shape, dtype=bool) if mask is None else np.asarray(mask) != 0
+    valid = valid & np.isfinite(image)
+    if not valid.any():
+        raise ValueError("the mask excludes all pixels")
+
+    factor = 1
+    while max(rows, columns) / factor > coarse_size:
+        factor *= 2
+    if guess is None:
+        guess = ((columns - 1) / 2, (rows - 1) / 2)
+    if radius is None:
+        x_range, y_range = (0, columns - 1), (0, rows - 1)
+    else:
+        x_range = (guess[0] - radius, guess[0] + radius)
+        y_range = (guess[1] - radius, guess[1] + radius)
+
+    # coarsest level: every (downsampled) pixel of the search region
+    level = _Level(image, valid, factor, log, r_min)
+    xs = np.arange(x_range[0], x_range[1] + factor, factor, dtype=np.float64)
+    ys = np.arange(y_range[0], y_range[1] + factor, factor, dtype=np.float64)
+    x, y, scores = level.best(xs, ys)
+    logger.debug("level %d: %d candidates, best (%g, %g)", factor, scores.size, x, y)
+
+    # finer levels: the neighborhood of the previous best
+    steps = np.arange(-FINE_STEPS, FINE_STEPS + 1)
+    while factor > 1:
+        factor //= 2
+        level = _Level(image, valid, factor, log, r_min)
+        x, y, scores = level.best(x + steps * factor, y + steps * factor)
+        logger.debug("level %d: best (%g, %g)", factor, x, y)
+
+    # sub-pixel: parabola through the scores next to the best pixel
+    if scores.shape == (len(steps), len(steps)):
+        row, column = np.unravel_index(np.argmin(scores), scores.shape)
+        if 0 < column < len(steps) - 1:
+            x += _parabola_vertex(*scores[row, column - 1:column + 2])
+        if 0 < row < len(steps) - 1:
+            y += _parabola_vertex(*scores[row - 1:row + 2, column])
+    logger.info("beam center (%.2f, %.2f)", x, y)
+    return float(x), float(y)
+
+
+def beam_center_kwargs(image, mask=None, **options):
+    """
+    Estimated beam center as keyword arguments of ``create_instrument_group``
+
+    :param image: 2D image, e.g. the time-averaged SAXS_2D image
+    :param mask: nonzero for the pixels to use (default: all pixels)
+    :param options: keyword arguments of :func:`find_beam_center`
+    :return *dict*: ``beam_center_x``, ``beam_center_y`` and ``beam_center_units``
+    """
+    x, y = find_beam_center(image, mask, **options)
+    return dict(beam_center_x=x, beam_center_y=y, beam_center_units="pixel")
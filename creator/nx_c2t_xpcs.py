@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""
+Two-time correlation function computed from a frame stack, tile by tile.
+
+For the pixels of every dynamic ROI (label ``q`` of the ``dynamic_roi_map``)
+the intensity history is a ``frames x pixels`` matrix ``A`` and
+
+    C(q, t1, t2) = <I(t1) I(t2)> / (<I(t1)> <I(t2)>)
+
+with the averages over the pixels of the ROI, i.e. ``A @ A.T`` normalized.
+:class:`TwoTimeSource` never holds ``A`` in memory: it reads two blocks of
+``tile`` frames at a time, computes one ``tile x tile`` tile of every ROI
+with a matrix product and yields it, so the creator writes it straight into
+its (chunked) ``two_time_corr_func`` dataset.  The matrix is symmetric, so
+only the tiles of the upper half are computed; the lower half is its
+transpose (or not written at all, see :func:`creator.nx_twotime_xpcs.write_two_time`).
+Packed storage needs whole rows: :meth:`TwoTimeSource.iter_row_blocks`
+computes a block of rows of every ROI from one read of the frames.
+
+Only the bounding box of the ROI pixels is read, a few frames at a time
+(:data:`READ_FRACTION` of the memory budget); ``tile`` is chosen from the
+rest of the budget, which covers the two frame blocks, the result tiles of
+all ROIs and the temporaries of the matrix product.
+"""
+import logging
+
+import numpy as np
+
+from creator.nx_stream_xpcs import DEFAULT_BLOCK_BYTES, rows_per_block
+
+logger = logging.getLogger(__name__)
+
+TILE_MULTIPLE = 64  # tile edges are rounded down to a multiple of this
+READ_FRACTION = 0.25  # of the memory budget for the raw frames read at once
+PRODUCT_TEMPORARIES = 3  # tile x tile float64 arrays while one ROI is computed
+
+
+def tile_size(n_pixels, frames, max_bytes=DEFAULT_BLOCK_BYTES, n_q=1):
+    """
+    Largest tile edge whose frame blocks, result tiles and temporaries fit into ``max_bytes``
+
+    :param n_pixels: number of pixels in all ROIs
+    :param frames: number of frames (upper limit for the tile)
+    :param max_bytes: memory budget
+    :param n_q: number of ROIs (one float32 result tile each)
+    """
+    # 2 blocks of tile x n_pixels float64, n_q float32 result tiles twice (the
+    # consumer keeps the previous ones) and the float64 temporaries of one ROI
+    a = 2 * n_q * 4 + PRODUCT_TEMPORARIES * 8
+    b = 2 * n_pixels * 8
+    edge = int((-b + np.sqrt(b * b + 4 * a * max_bytes)) / (2 * a))
+    if edge >= TILE_MULTIPLE:
+        edge -= edge % TILE_MULTIPLE
+    return max(1, min(edge, frames))
+
+
+def _box(pixels, shape):
+    """
+    Bounding box of flat pixel indices
+
+    :return *tuple*: row slice, column slice and the flat indices of the pixels within the box
+    """
+    if len(pixels) == 0:
+        return slice(0, 0), slice(0, 0), pixels
+    y, x = np.unravel_index(pixels, shape)
+    rows, columns = slice(int(y.min()), int(y.max()) + 1), slice(int(x.min()), int(x.max()) + 1)
+    return rows, columns, (y - rows.start) * (columns.stop - columns.start) + (x - columns.start)
+
+
+def _correlation(x, y, n_pixels):
+    """normalized product of the intensities ``x`` (rows, pixels) and ``y`` (columns, pixels) of one ROI"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (x @ y.T) * n_pixels / np.outer(x.sum(axis=1), y.sum(axis=1))
+
+
+class TwoTimeSource:
+    """
+    Lazy two-time correlation function of a frame stack with the shape (q, frames, frames).
+
+    :param frames: frames with shape (n, rows, columns): ``h5py.Dataset``, ``numpy.memmap`` or array
+    :param dynamic_roi_map: ROI label of every pixel (1 .. n_q), 0 for pixels not used
+    :param max_bytes: memory budget for the frames read, the frame blocks and the result tiles
+    :param tile: edge of the tiles, default: the largest that fits into ``max_bytes``
+    :param units: units of the correlation function
+    """
+
+    source = None  # computed, never copied
+
+    def __init__(self, frames, dynamic_roi_map, max_bytes=DEFAULT_BLOCK_BYTES, tile=None, units="a.u."):
+        if tuple(frames.shape[1:]) != np.shape(dynamic_roi_map):
+            raise ValueError(f"frames of shape {tuple(frames.shape[1:])} do not match the "
+                             f"roi map of shape {np.shape(dynamic_roi_map)}")
+        self._frames = frames
+        roi_map = np.asarray(dynamic_roi_map).ravel()
+        n_q = int(roi_map.max(initial=0))
+        self.npix = np.bincount(roi_map, minlength=n_q + 1)[1:]
+        order = np.argsort(roi_map, kind="stable")
+        self._pixels = order[np.searchsorted(roi_map[order], 1):]  # ROI after ROI
+        self._starts = np.concatenate([[0], np.cumsum(self.npix)])
+        self._roi_box = _box(self._pixels, frames.shape[1:])
+        self._read_bytes = int(max_bytes * READ_FRACTION)
+        self._max_bytes = max_bytes - self._read_bytes
+        n_frames = frames.shape[0]
+        self.tile = tile or tile_size(len(self._pixels), n_frames, self._max_bytes, n_q)
+        self.shape = (n_q, n_frames, n_frames)
+        self.dtype = np.dtype(np.float32)
+        self.chunks = (1, self.tile, self.tile)
+        self.units = units
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape, dtype=np.int64)) * self.dtype.itemsize
+
+    def _read(self, start, stop, box=None):
+        """
+        ROI pixels of frames ``start:stop`` as float64 (frames, pixels)
+
+        Only the bounding box of the pixels is read, as many frames at a time as fit
+        into the read budget.
+
+        :param box: bounding box and pixels (see :func:`_box`), default: the pixels of all ROIs
+        """
+        rows, columns, pixels = box if box is not None else self._roi_box
+        block = np.empty((stop - start, len(pixels)))
+        if len(pixels) == 0:
+            return block
+        box_shape = (rows.stop - rows.start, columns.stop - columns.start)
+        # the box and its fancy-indexed copy
+        step = rows_per_block(box_shape, self._frames.dtype, self._read_bytes // 2)
+        for first in range(start, stop, step):
+            last = min(first + step, stop)
+            raw = np.asarray(self._frames[first:last, rows, columns]).reshape(last - first, -1)
+            block[first - start:last - start] = raw[:, pixels]
+        return block
+
+    def _correlate(self, a_i, a_j, out):
+        """correlation of every ROI of two frame blocks into ``out`` with shape (q, rows, columns)"""
+        for q in np.flatnonzero(self.npix):
+            pixels = slice(self._starts[q], self._starts[q + 1])
+            out[q] = _correlation(a_i[:, pixels], a_j[:, pixels], self.npix[q])
+
+    def _tiles(self):
+        """yield ``(rows, columns, tiles)`` of the upper half, ``tiles`` with shape (q, rows, columns)"""
+        frames, edge = self.shape[1], self.tile
+        for i in range(0, frames, edge):
+            rows = slice(i, min(i + edge, frames))
+            a_i = self._read(rows.start, rows.stop)
+            for j in range(i, frames, edge):
+                columns = slice(j, min(j + edge, frames))
+                a_j = a_i if j == i else self._read(columns.start, columns.stop)
+                tiles = np.full((self.shape[0], rows.stop - rows.start, columns.stop - columns.start),
+                                np.nan, dtype=self.dtype)
+                self._correlate(a_i, a_j, tiles)
+                # the next block is read only after this one is released
+                a_j = None
+                yield rows, columns, tiles
+
+    def iter_row_blocks(self, half="upper"):
+        """
+        Yield ``(rows, block)``: rows of every ROI, ``block`` with shape (q, rows, frames).
+
+        Only the columns of ``half`` (including the diagonal) are computed, the others
+        are NaN.  As many rows as fit into the budget are computed from one read of the
+        frames, at least one.
+
+        :param half: "upper" or "lower"
+        """
+        n_q, frames = self.shape[:2]
+        edge = self.tile
+        n_pixels = len(self._pixels)
+        # result rows of all ROIs (twice, the consumer keeps the previous block), the
+        # frame block of the rows and the product temporaries
+        row_bytes = 2 * n_q * frames * self.dtype.itemsize + n_pixels * 8 + PRODUCT_TEMPORARIES * edge * 8
+        n_rows = max(1, min(frames, (self._max_bytes - edge * n_pixels * 8) // row_bytes))
+        for i in range(0, frames, n_rows):
+            rows = slice(i, min(i + n_rows, frames))
+            a_i = self._read(rows.start, rows.stop)
+            block = np.full((n_q, rows.stop - rows.start, frames), np.nan, dtype=self.dtype)
+            first, last = (rows.start, frames) if half == "upper" else (0, rows.stop)
+            for j in range(first, last, edge):
+                columns = slice(j, min(j + edge, last))
+                self._correlate(a_i, self._read(columns.start, columns.stop), block[:, :, columns])
+            # the next rows are read only after these are released
+            a_i = None
+            yield rows, block
+
+    def iter_half_blocks(self, half="upper", max_bytes=None):
+        """
+        Yield ``(selection, block)`` pairs of the tiles of one half (including the diagonal tiles).
+
+        :param half: "upper" or "lower"
+        :param max_bytes: ignored, the tile size is fixed when the source is created
+        """
+        for rows, columns, tiles in self._tiles():
+            if half == "upper":
+                yield (slice(None), rows, columns), tiles
+            else:
+                yield (slice(None), columns, rows), tiles.transpose(0, 2, 1)
+
+    def iter_blocks(self, max_bytes=None):
+        """
+        Yield ``(selection, block)`` pairs covering the whole matrix, lower tiles are mirrored.
+
+        :param max_bytes: ignored, the tile size is fixed when the source is created
+        """
+        for rows, columns, tiles in self._tiles():
+            yield (slice(None), rows, columns), tiles
+            if rows != columns:
+                yield (slice(None), columns, rows), tiles.transpose(0, 2, 1)
+
+    def rows(self, q, start, stop):
+        """
+        Full rows ``start:stop`` of ROI ``q`` (0-based), computed one column tile at a time.
+
+        Reads the pixels of ROI ``q`` only; for the rows of all ROIs see :meth:`iter_row_blocks`.
+
+        :param q: index of the ROI
+        :param start: first row
+        :param stop: end of the rows
+        """
+        frames, edge = self.shape[1], self.tile
+        rows = np.full((stop - start, frames), np.nan, dtype=self.dtype)
+        if self.npix[q] == 0:
+            return rows
+        # only the pixels of this ROI are read
+        box = _box(self._pixels[self._starts[q]:self._starts[q + 1]], self._frames.shape[1:])
+        x = self._read(start, stop, box)
+        for j in range(0, frames, edge):
+            y = self._read(j, min(j + edge, frames), box)
+            rows[:, j:j + len(y)] = _correlation(x, y, self.npix[q])
+        return rows
+
+    def __getitem__(self, selection):
+        """
+        Compute a selection.  ``source[q]`` and ``source[q, start:stop]`` compute only
+        these rows, everything else computes the complete matrix first (only for small data).
+        """
+        if not isinstance(selection, tuple):
+            selection = (selection,)
+        if isinstance(selection[0], (int, np.integer)) and len(selection) <= 2:
+            rows = selection[1] if len(selection) == 2 else slice(None)
+            if isinstance(rows, slice) and rows.step in (None, 1):
+                start, stop, _ = rows.indices(self.shape[1])
+                return self.rows(int(selection[0]), start, stop)
+        return self.read()[selection]
+
+    def read(self):
+        """Compute the complete matrix (only for small data)."""
+        data = np.empty(self.shape, dtype=self.dtype)
+        for selection, block in self.iter_blocks():
+            data[selection] = block
+        return data
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.read()
+        return data if dtype is None else data.astype(dtype)
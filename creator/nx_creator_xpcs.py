@@ -1,10 +1,18 @@
 #!/usr/bin/env python
+import contextlib
 import datetime
 import h5py
 import logging
 import numpy as np
 import warnings
-import pint
+
+from creator.nx_library_xpcs import LIBRARY_FIELDS, MapLibrary, can_store
+from creator.nx_reference_xpcs import can_reference, write_virtual
+from creator.nx_series_xpcs import DIGEST_ATTR, content_digest, shared_groups
+from creator.nx_stream_xpcs import DEFAULT_BLOCK_BYTES, is_streamable, write_streamed
+from creator.nx_trace_xpcs import span, traced
+from creator.nx_twotime_xpcs import TWO_TIME_STORAGE, write_two_time
+from creator.nx_units import units_compatible
 
 logger = logging.getLogger(__name__)
 # logger.setLevel(logging.DEBUG)
@@ -29,27 +37,173 @@ class NXCreator:
     * 2-D SAXS
     * and may include other analyses
 
+    Each ``create_*`` method can be called on its own, in which case the output
+    file is opened and closed for that call.  Used as a context manager, the
+    creator opens the output file once for the whole session and all group
+    writers share that handle::
+
+        with NXCreator("results.nxs") as creator:
+            creator.init_file()
+            creator.create_entry_group()
+            creator.create_xpcs_group(**md_xpcs)
+
+    Large results (sources with an ``iter_blocks`` method, or input datasets
+    bigger than ``max_block_bytes``) are copied into a pre-allocated dataset one
+    block at a time, see :mod:`creator.nx_stream_xpcs`.
+
+    Chunking and compression of the datasets are chosen by an optional
+    :class:`~creator.nx_layout_xpcs.LayoutPolicy`.
+
+    The ``create_*`` methods, the units checks and the dataset writes run in
+    spans of :mod:`creator.nx_trace_xpcs` (recorded when tracing is on).
+
+    In reference mode, fields backed by datasets of the input file are not
+    copied but written as virtual datasets pointing into the input file, see
+    :mod:`creator.nx_reference_xpcs`.
+
+    For series files (many ``entry_N`` in one file) the instrument and masks
+    groups of an entry can be hard-linked to an identical group written before
+    (``share_identical``), see :mod:`creator.nx_series_xpcs`.
+
+    With a ``map_library`` the masks and q maps are kept once in a
+    content-addressed library and referenced, see :mod:`creator.nx_library_xpcs`.
+
+    With ``reuse_groups`` the results are added to groups already in the file,
+    e.g. those a :class:`~creator.nx_accumulator_xpcs.FrameAccumulator` wrote
+    during the acquisition.
+
+    :param output_filename: name of the NeXus file to write
+    :param max_block_bytes: memory budget for one block of a streamed dataset
+    :param layout: LayoutPolicy, default: contiguous datasets without compression
+    :param reference_mode: reference the input data instead of copying it
+    :param two_time_storage: "full", or "packed"/"tiles" to store only one half of
+                             two_time_corr_func (see :mod:`creator.nx_twotime_xpcs`)
+    :param two_time_half: "upper" or "lower", the half stored by "packed"/"tiles"
+    :param share_identical: hard-link instrument and masks groups whose content is already in the file
+    :param map_library: MapLibrary or its directory for the masks and q maps, default: write them into the file
+    :param reuse_groups: add to existing groups instead of failing on them
     """
 
-    def __init__(self, output_filename):
+    def __init__(self,
+                 output_filename,
+                 max_block_bytes=DEFAULT_BLOCK_BYTES,
+                 layout=None,
+                 reference_mode=False,
+                 two_time_storage="full",
+                 two_time_half="upper",
+                 share_identical=False,
+                 map_library=None,
+                 reuse_groups=False):
+        if two_time_storage not in TWO_TIME_STORAGE:
+            raise ValueError(f"unknown two-time storage '{two_time_storage}', use one of {TWO_TIME_STORAGE}")
         self._output_filename = output_filename
+        self.max_block_bytes = max_block_bytes
+        self.layout = layout
+        self.reference_mode = reference_mode
+        self.two_time_storage = two_time_storage
+        self.two_time_half = two_time_half
+        self.share_identical = share_identical
+        if map_library is not None and not isinstance(map_library, MapLibrary):
+            map_library = MapLibrary(map_library, max_bytes=max_block_bytes)
+        self.map_library = map_library
+        self.reuse_groups = reuse_groups
+        self._shared = None  # content digest -> path of the shared groups of the file
+        self._file = None
+        self._in_session = False
         self.entry_group = None
+        self.entry_group_name = None
         self.xpcs_group = None
         self.detector_group = None
         self.instrument_group = None
 
+    def __enter__(self):
+        self._in_session = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @traced("NXCreator.close")
+    def close(self):
+        """Flush and close the file of the current session (if any)."""
+        if self._file is not None:
+            self._file.flush()
+            self._file.close()
+        self._file = None
+        self._in_session = False
+        self._shared = None
+
+    @contextlib.contextmanager
+    def _open(self, mode="a"):
+        """
+        Yield the output file for one writer call.
+
+        Inside a session the file is opened on first use (with the mode of that
+        first call) and stays open until the session ends.  Outside a session
+        the file is opened and closed around each call.
+
+        :param mode: h5py file mode, ``"w"`` truncates the output file
+        """
+        if not self._in_session:
+            with h5py.File(self._output_filename, mode) as file:
+                yield file
+            return
+        if self._file is None:
+            self._file = h5py.File(self._output_filename, mode)
+        elif mode == "w":
+            # truncate the already open session file instead of re-opening it
+            for key in list(self._file):
+                del self._file[key]
+            self._file.attrs.clear()
+        yield self._file
+
     def _init_group(self, h5parent, name, NX_class):
-        """Common steps to initialize a NeXus HDF5 group."""
-        group = h5parent.create_group(name)
+        """
+        Common steps to initialize a NeXus HDF5 group.
+
+        With ``reuse_groups`` an existing group is reused instead of failing.
+        """
+        group = h5parent.require_group(name) if self.reuse_groups else h5parent.create_group(name)
         group.attrs["NX_class"] = NX_class
-        print(group.name)
+        logger.debug("group %s", group.name)
         return group
 
+    @contextlib.contextmanager
+    def _shared_group(self, h5parent, name, NX_class, values):
+        """
+        ``_init_group`` of a group that entries of a series may share.
+
+        With ``share_identical`` a group whose content was written before is
+        hard-linked instead of written again; the digest is stored once the
+        body has filled a new group.
+
+        :param values: the arguments that fill the group (see :func:`~creator.nx_series_xpcs.content_digest`)
+        :return *tuple*: the group and `True` if the body has to fill it
+        """
+        if not self.share_identical or name in h5parent:
+            yield self._init_group(h5parent, name, NX_class), True
+            return
+        file = h5parent.file
+        if self._shared is None or not self._in_session:
+            self._shared = shared_groups(file)
+        digest = content_digest(values, self.max_block_bytes)
+        path = self._shared.get(digest)
+        if path is not None and path in file:
+            h5parent[name] = file[path]
+            logger.debug("group %s/%s linked to %s", h5parent.name, name, path)
+            yield h5parent[name], False
+            return
+        group = self._init_group(h5parent, name, NX_class)
+        yield group, True
+        group.attrs[DIGEST_ATTR] = digest
+        self._shared[digest] = group.name
+
+    @traced("NXCreator.init_file")
     def init_file(self):
         """Write the complete NeXus file."""
-        with h5py.File(self._output_filename, "w") as self.file:
-            self.write_file_header(self.file)
-            self.file.close()
+        with self._open("w") as file:
+            self._shared = None
+            self.write_file_header(file)
 
     def write_file_header(self, output_file):
         """optional header metadata"""
@@ -67,15 +221,44 @@ class NXCreator:
     def _create_dataset(self, group, name, value, **kwargs):
         """
         use this to create datasets in different (sub-)groups
+
+        ``value`` may be an array, an ``h5py.Dataset`` or a lazy loader field
+        (see :class:`loader.nx_loader_base.LazyField`).
         """
         if value is None:
             return
-        ds = group.create_dataset(name, data=value)
+        with span("NXCreator.write_dataset", field=name):
+            return self._write_dataset(group, name, value, **kwargs)
+
+    def _write_dataset(self, group, name, value, **kwargs):
+        options = {}
+        if self.layout is not None:
+            array = value if hasattr(value, "dtype") else np.asarray(value)
+            options = self.layout.dataset_options(name, array.shape, array.dtype)
+        source = getattr(value, "source", None)
+        if self.map_library is not None and name in LIBRARY_FIELDS and can_store(value):
+            # masks and q maps: map onto the copy in the library
+            ds = self.map_library.write_reference(group, name, value)
+        elif self.reference_mode and can_reference(value):
+            # reference mode: map onto the input file instead of copying
+            ds = write_virtual(group, name, value)
+        elif source is not None and not options:
+            # lazy loader field: copy dataset-to-dataset inside HDF5, no intermediate array
+            group.copy(source, group, name=name, without_attrs=True)
+            ds = group[name]
+        elif is_streamable(value, self.max_block_bytes):
+            ds = write_streamed(group, name, value, self.max_block_bytes, **options)
+        else:
+            if hasattr(value, "read"):
+                value = value.read()
+            ds = group.create_dataset(name, data=value, **options)
         for k, v in kwargs.items():
-            ds.attrs[k] = v
+            if v is not None:
+                ds.attrs[k] = v
         ds.attrs["target"] = ds.name
         return ds
 
+    @traced("NXCreator.check_units")
     def _check_units(self, name, expected, supplied):
         """
         units check for supplied units
@@ -84,6 +267,7 @@ class NXCreator:
         units string can be mapped into the expected units for that field.
         If arbitrary units are supplied in form of 'au', 'a.u.' or 'a.u' no conversion is applied
         and pint if not used for the units check.
+        The check itself is cached per units pair, see :mod:`creator.nx_units`.
 
         :param name: name of field
         :param expected: expected units
@@ -91,27 +275,26 @@ class NXCreator:
         :return *bool*: `True` if units conversion is possible:
         """
 
+        if supplied is None:
+            logger.info("Info: no units supplied for '%s'", name)
+            return False
         # catch arbitrary units separately from pint --> point that out in documentation
         if supplied in ['au', 'a.u.', 'a.u']:
             logger.info("Info: arbitrary units supplied for '%s' in form of '%s' no units conversion applicable",
                         name,
                         supplied)
             return True
+        elif units_compatible(supplied, expected):
+            return True
         else:
-            ureg = pint.UnitRegistry()
-            user = 1.0 * ureg(supplied)
-            try:
-                user.to(expected)
-                return True
-            except pint.DimensionalityError:
-                logger.warning("WARNING: '%s': Supplied units (%s) do not match expected units (%s)",
-                               name,
-                               supplied,
-                               expected)
-                return False
-
-
-    def create_data_with_units(self, group, name, value, expected, supplied):
+            logger.warning("WARNING: '%s': Supplied units (%s) do not match expected units (%s)",
+                           name,
+                           supplied,
+                           expected)
+            return False
+
+
+    def create_data_with_units(self, group, name, value, expected, supplied, **kwargs):
         """
         Create datasets and check units if provided
 
@@ -120,13 +303,17 @@ class NXCreator:
         :param value: value for the dataset
         :param expected: expected units
         :param supplied: supplied units
+        :param kwargs: additional attributes for the dataset
         """
+        if value is None:
+            return
         if self._check_units(name, expected, supplied):
-            self._create_dataset(group, name, value, units=supplied)
+            self._create_dataset(group, name, value, units=supplied, **kwargs)
         else:
-            self._create_dataset(group, name, value)
+            self._create_dataset(group, name, value, **kwargs)
 
 
+    @traced("NXCreator.create_entry_group")
     def create_entry_group(self,
                            experiment_description: str = None,
                            title: str = None,
@@ -145,7 +332,7 @@ class NXCreator:
         else:
             entry_name = f"entry_{entry_index}"
 
-        with h5py.File(self._output_filename, "a") as file:
+        with self._open() as file:
             entry_group = self._init_group(file, name=entry_name, NX_class="NXentry")
             self.entry_group_name = entry_group.name
 
@@ -162,6 +349,7 @@ class NXCreator:
             file.attrs["default"] = entry_group.name
 
 
+    @traced("NXCreator.create_xpcs_group")
     def create_xpcs_group(self,
                           g2: np.ndarray = None,
                           g2_units: str = 'a.u',
@@ -178,6 +366,8 @@ class NXCreator:
                           #TODO: define python object to check against
                           delay_difference_units = None,
                           frame_sum: np.ndarray = None,
+                          frame_average: np.ndarray = None,
+                          frame_units: str = None,
                           mask: np.ndarray = None,
                           dynamic_roi_map: np.ndarray = None,
                           dynamic_q_list: np.ndarray = None,
@@ -225,7 +415,7 @@ class NXCreator:
             # here we check the plottable data
             elif i in ("g2", "twotime", "delay_difference"):
                 signal_dataset = i
-        with h5py.File(self._output_filename, "a") as file:
+        with self._open() as file:
             self.xpcs_group = self._init_group(file[self.entry_group_name], "XPCS", "NXprocess")
             #check that plottable data is assigned correctly
             if signal_dataset is None:
@@ -257,25 +447,45 @@ class NXCreator:
                                         'a.u.',
                                         supplied=g2_from_two_time_corr_units,
                                         baseline_reference=baseline_reference)
-            self.create_data_with_units(twotime_group,
-                                        "two_time_corr_func",
-                                        two_time_corr_func,
-                                        'a.u.',
-                                        supplied=two_time_corr_units,
-                                        baseline_reference=baseline_reference)
+            if self.two_time_storage == "full" or two_time_corr_func is None:
+                self.create_data_with_units(twotime_group,
+                                            "two_time_corr_func",
+                                            two_time_corr_func,
+                                            'a.u.',
+                                            supplied=two_time_corr_units,
+                                            baseline_reference=baseline_reference)
+            else:
+                # store only one half of the symmetric matrices
+                units_ok = self._check_units("two_time_corr_func", 'a.u.', two_time_corr_units)
+                ds = write_two_time(twotime_group,
+                                    "two_time_corr_func",
+                                    two_time_corr_func,
+                                    storage=self.two_time_storage,
+                                    half=self.two_time_half,
+                                    max_bytes=self.max_block_bytes,
+                                    units=two_time_corr_units if units_ok else None,
+                                    baseline_reference=baseline_reference)
+                ds.attrs["target"] = ds.name
 
             # create instrument group and masks group, add datasets
             instrument_group = self._init_group(self.xpcs_group, "instrument", "NXdata")
-            mask_group = self._init_group(instrument_group, "masks", "NXdata")
-            self._create_dataset(mask_group, "mask", mask, units="au")
-            self._create_dataset(mask_group, "dynamic_roi_map", dynamic_roi_map)
-            self._create_dataset(mask_group, "dynamic_q_list", dynamic_q_list, units="1/Angstrom")
-            self._create_dataset(mask_group, "dynamic_phi_list", dynamic_phi_list, units="1/Angstrom")
-            self._create_dataset(mask_group, "static_roi_map", static_roi_map)
-            self._create_dataset(mask_group, "static_q_list", static_q_list, units="1/Angstrom")
-            file.close()
-
-
+            masks = dict(mask=mask,
+                         dynamic_roi_map=dynamic_roi_map,
+                         dynamic_q_list=dynamic_q_list,
+                         dynamic_phi_list=dynamic_phi_list,
+                         static_roi_map=static_roi_map,
+                         static_q_list=static_q_list)
+            with self._shared_group(instrument_group, "masks", "NXdata", masks) as (mask_group, write):
+                if write:
+                    self._create_dataset(mask_group, "mask", mask, units="au")
+                    self._create_dataset(mask_group, "dynamic_roi_map", dynamic_roi_map)
+                    self._create_dataset(mask_group, "dynamic_q_list", dynamic_q_list, units="1/Angstrom")
+                    self._create_dataset(mask_group, "dynamic_phi_list", dynamic_phi_list, units="1/Angstrom")
+                    self._create_dataset(mask_group, "static_roi_map", static_roi_map)
+                    self._create_dataset(mask_group, "static_q_list", static_q_list, units="1/Angstrom")
+
+
+    @traced("NXCreator.create_saxs_1d_group")
     def create_saxs_1d_group(self,
                              I: np.ndarray = None,
                              I_units: str = None,
@@ -301,7 +511,7 @@ class NXCreator:
                 # TODO check what happens if type hint is violated
                 warnings.warn(f'Did not received expected {i.__name__} data - '
                               f'Cannot write complete SAXS 1D group')
-        with h5py.File(self._output_filename, "a") as file:
+        with self._open() as file:
             saxs_1d_group = self._init_group(file[self.entry_group_name], "SAXS_1D", "NXprocess")
             data_group = self._init_group(saxs_1d_group, "data", "NXdata")
             self.create_data_with_units(data_group, "I", I, 'a.u.', supplied=I_units)
@@ -310,6 +520,7 @@ class NXCreator:
 
 
 
+    @traced("NXCreator.create_saxs_2d_group")
     def create_saxs_2d_group(self,
                              I: np.ndarray = None,
                              *args,
@@ -325,12 +536,13 @@ class NXCreator:
                 # TODO check what happens if type hint is violated
                 warnings.warn(f'Did not received expected {i.__name__} data - '
                               f'Cannot write complete SAXS 2D group')
-        with h5py.File(self._output_filename, "a") as file:
+        with self._open() as file:
             saxs_2d_group = self._init_group(file[self.entry_group_name], "SAXS_2D", "NXprocess")
             data_group = self._init_group(saxs_2d_group, "data", "NXdata")
             self._create_dataset(data_group, "I", I, units="au")
 
 
+    @traced("NXCreator.create_instrument_group")
     def create_instrument_group(self,
                                 instrument_name: str = None,
                                 count_time: np.ndarray = None,
@@ -370,24 +582,29 @@ class NXCreator:
         :param : energy_units in units of energy
         """
 
-        with h5py.File(self._output_filename, "a") as file:
-            self.instrument_group = self._init_group(file[self.entry_group_name], "instrument", "NXinstrument")
-            #TODO how to add instrument name here
-            # self.instrument_group.attrs["instrument"] = instrument_name
-
-            # create detector group and add datasets
-            detector_group = self._init_group(self.instrument_group, "detector", "NXdetector")
-            self.create_data_with_units(detector_group, "count_time", count_time, 's', supplied=count_time_units)
-            self.create_data_with_units(detector_group, "frame_time", frame_time, 's', supplied=frame_time_units)
-            self._create_dataset(detector_group, "description", description)
-            self.create_data_with_units(detector_group, "distance", distance, 'mm', supplied=distance_units)
-            self.create_data_with_units(detector_group, "x_pixel_size", x_pixel_size, 'um', supplied=pixel_size_units)
-            self.create_data_with_units(detector_group, "y_pixel_size", y_pixel_size, 'um', supplied=pixel_size_units)
-            self.create_data_with_units(detector_group, "beam_center_x", beam_center_x, 'pixel', supplied=beam_center_units)
-            self.create_data_with_units(detector_group, "beam_center_y", beam_center_y, 'pixel', supplied=beam_center_units)
-
-            # create monochromator group and add datasets
-            mono_group = self._init_group(self.instrument_group, "monochromator", "NXmonochromator")
-            self.create_data_with_units(mono_group, "energy", energy, 'eV', supplied=energy_units)
+        shared = dict(locals())
+        del shared["self"]
+        with self._open() as file:
+            with self._shared_group(file[self.entry_group_name], "instrument", "NXinstrument",
+                                    shared) as (self.instrument_group, write):
+                if not write:
+                    return
+                #TODO how to add instrument name here
+                # self.instrument_group.attrs["instrument"] = instrument_name
+
+                # create detector group and add datasets
+                detector_group = self._init_group(self.instrument_group, "detector", "NXdetector")
+                self.create_data_with_units(detector_group, "count_time", count_time, 's', supplied=count_time_units)
+                self.create_data_with_units(detector_group, "frame_time", frame_time, 's', supplied=frame_time_units)
+                self._create_dataset(detector_group, "description", description)
+                self.create_data_with_units(detector_group, "distance", distance, 'mm', supplied=distance_units)
+                self.create_data_with_units(detector_group, "x_pixel_size", x_pixel_size, 'um', supplied=pixel_size_units)
+                self.create_data_with_units(detector_group, "y_pixel_size", y_pixel_size, 'um', supplied=pixel_size_units)
+                self.create_data_with_units(detector_group, "beam_center_x", beam_center_x, 'pixel', supplied=beam_center_units)
+                self.create_data_with_units(detector_group, "beam_center_y", beam_center_y, 'pixel', supplied=beam_center_units)
+
+                # create monochromator group and add datasets
+                mono_group = self._init_group(self.instrument_group, "monochromator", "NXmonochromator")
+                self.create_data_with_units(mono_group, "energy", energy, 'eV', supplied=energy_units)
 
 
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Dataset layout (chunking and compression) for the NeXus file.
+
+A :class:`LayoutPolicy` passed to the :class:`~creator.nx_creator_xpcs.NXCreator`
+decides, for every dataset written, the chunk shape from the expected access
+pattern of the field and the compression filter from the size and dtype of the
+array.  Without a policy the datasets are written contiguous and uncompressed.
+"""
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIONS = (None, "lzf", "gzip")
+
+
+def _q_slice_chunks(shape, itemsize, max_chunk_bytes):
+    """one q-slice (q, frames, frames) per chunk, tiled by rows if a slice is too big"""
+    if len(shape) != 3:
+        return None
+    row_nbytes = shape[2] * itemsize
+    rows = max(1, min(shape[1], max_chunk_bytes // max(row_nbytes, 1)))
+    return 1, rows, shape[2]
+
+
+def _q_column_chunks(shape, itemsize, max_chunk_bytes):
+    """one q column (delay, q) per chunk"""
+    if len(shape) != 2:
+        return None
+    rows = max(1, min(shape[0], max_chunk_bytes // itemsize))
+    return rows, 1
+
+
+def _frame_chunks(shape, itemsize, max_chunk_bytes):
+    """rows of a detector sized (y, x) image"""
+    if len(shape) != 2:
+        return None
+    row_nbytes = shape[1] * itemsize
+    rows = max(1, min(shape[0], max_chunk_bytes // max(row_nbytes, 1)))
+    return rows, shape[1]
+
+
+# chunk shape per field name, chosen by the expected access pattern
+FIELD_CHUNKS = {
+    "two_time_corr_func": _q_slice_chunks,
+    "g2": _q_column_chunks,
+    "g2_stderr": _q_column_chunks,
+    "G2_unnormalized": _q_column_chunks,
+    "g2_from_two_time_corr_func": _q_column_chunks,
+    "mask": _frame_chunks,
+    "dynamic_roi_map": _frame_chunks,
+    "static_roi_map": _frame_chunks,
+    "frame_sum": _frame_chunks,
+    "frame_average": _frame_chunks,
+}
+
+
+class LayoutPolicy:
+    """
+    Choose chunk shape and compression filter per dataset.
+
+    Arrays smaller than ``min_compress_bytes`` are written contiguous without
+    filters.  Larger floating point arrays use ``float_compression`` (``lzf`` by
+    default: fast, bundled with h5py), integer and boolean arrays (masks, roi
+    maps) use ``int_compression`` (``gzip``, they compress very well).  The
+    shuffle filter is applied in front of the compressor.
+
+    :param float_compression: compressor for floating point data: None, "lzf" or "gzip"
+    :param int_compression: compressor for integer and boolean data: None, "lzf" or "gzip"
+    :param gzip_level: compression level (0-9) used when the compressor is "gzip"
+    :param shuffle: apply the shuffle filter to compressed datasets
+    :param min_compress_bytes: arrays smaller than this are stored contiguous
+    :param max_chunk_bytes: upper limit for the size of one chunk
+    :param field_chunks: chunk rules per field name, overrides :data:`FIELD_CHUNKS`
+    """
+
+    def __init__(self,
+                 float_compression="lzf",
+                 int_compression="gzip",
+                 gzip_level=4,
+                 shuffle=True,
+                 min_compress_bytes=64 * 1024,
+                 max_chunk_bytes=4 * 1024 ** 2,
+                 field_chunks=None):
+        for compression in (float_compression, int_compression):
+            if compression not in COMPRESSIONS:
+                raise ValueError(f"unknown compression '{compression}', use one of {COMPRESSIONS}")
+        self.float_compression = float_compression
+        self.int_compression = int_compression
+        self.gzip_level = gzip_level
+        self.shuffle = shuffle
+        self.min_compress_bytes = min_compress_bytes
+        self.max_chunk_bytes = max_chunk_bytes
+        self.field_chunks = dict(FIELD_CHUNKS, **(field_chunks or {}))
+
+    def _compression(self, dtype):
+        if dtype.kind == "f" or dtype.kind == "c":
+            return self.float_compression
+        if dtype.kind in "iub":
+            return self.int_compression
+        return None
+
+    def dataset_options(self, name, shape, dtype):
+        """
+        Keyword arguments for ``create_dataset`` of field ``name``.
+
+        :param name: name of the field
+        :param shape: shape of the array
+        :param dtype: dtype of the array
+        :return *dict*: ``chunks``, ``compression``, ``compression_opts`` and ``shuffle`` as needed
+        """
+        dtype = np.dtype(dtype)
+        shape = tuple(shape)
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        compression = self._compression(dtype)
+        if len(shape) == 0 or nbytes < self.min_compress_bytes or compression is None:
+            return {}
+
+        options = dict(compression=compression, shuffle=self.shuffle)
+        if compression == "gzip":
+            options["compression_opts"] = self.gzip_level
+        rule = self.field_chunks.get(name)
+        chunks = rule(shape, dtype.itemsize, self.max_chunk_bytes) if rule is not None else None
+        # let h5py guess a chunk shape for fields without a known access pattern
+        options["chunks"] = chunks if chunks is not None else True
+        logger.debug("layout for '%s' %s: %s", name, shape, options)
+        return options
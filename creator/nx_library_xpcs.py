@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Content-addressed library of the masks and q maps shared by many NeXus files.
+
+Masks and q partition maps (:data:`LIBRARY_FIELDS`) are detector-sized but
+change rarely.  With ``NXCreator(..., map_library=directory)`` such a map is
+stored once in a :class:`MapLibrary`: one HDF5 file per map, named by the
+digest of its dtype, shape and data::
+
+    <library>/3f/3f2a...c1.h5       dataset "map", content_digest="3f2a...c1"
+
+The NeXus file gets a virtual dataset mapping onto the library file and the
+``content_digest`` attribute.  As in reference mode
+(:mod:`creator.nx_reference_xpcs`) a virtual dataset is used rather than an
+``h5py.ExternalLink`` because it keeps the attributes of the field.  Writing
+a map that is already in the library costs its digest only.
+
+Maps are written to a temporary file and renamed into place, so parallel
+conversions may share one library.  The library file names are absolute:
+NeXus files can be moved, the library stays.  :func:`~creator.nx_reference_xpcs.materialize`
+copies the maps into a self-contained file.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+
+import h5py
+import numpy as np
+
+from creator.nx_series_xpcs import DIGEST_ATTR, update_digest
+from creator.nx_stream_xpcs import DEFAULT_BLOCK_BYTES, write_streamed
+
+logger = logging.getLogger(__name__)
+
+LIBRARY_FIELDS = ("mask", "dynamic_roi_map", "static_roi_map")
+MAP_NAME = "map"  # the dataset of a library file
+
+
+def can_store(value):
+    """`True` if ``value`` can be kept in the library (an array of numbers)"""
+    if value is None:
+        return False
+    if not hasattr(value, "dtype"):
+        value = np.asarray(value)
+    return len(value.shape) > 0 and np.dtype(value.dtype).kind in "biuf"
+
+
+class MapLibrary:
+    """
+    Directory of maps keyed by their content digest, see the module documentation.
+
+    :param directory: library directory, created if missing
+    :param max_bytes: upper limit for the size of one block read or written
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_BLOCK_BYTES):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __repr__(self):
+        return f"MapLibrary({self.directory!r})"
+
+    def __contains__(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def __len__(self):
+        return sum(name.endswith(".h5") for _, _, names in os.walk(self.directory) for name in names)
+
+    def digest(self, value):
+        """hex digest of dtype, shape and data of ``value``"""
+        digest = hashlib.blake2b(digest_size=20)
+        update_digest(digest, value, self.max_bytes)
+        return digest.hexdigest()
+
+    def path(self, digest):
+        """library file of the map ``digest``"""
+        return os.path.join(self.directory, digest[:2], digest + ".h5")
+
+    def insert(self, value, digest=None):
+        """
+        Store ``value`` unless it is in the library already
+
+        :param value: array, dataset or lazy loader field
+        :param digest: digest of ``value`` if known
+        :return *str*: digest of ``value``
+        """
+        if not hasattr(value, "dtype"):
+            value = np.asarray(value)
+        digest = digest or self.digest(value)
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".map_", suffix=".h5.tmp")
+        os.close(fd)
+        try:
+            with h5py.File(tmp, "w") as f:
+                ds = write_streamed(f, MAP_NAME, value, self.max_bytes)
+                ds.attrs[DIGEST_ATTR] = digest
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        logger.debug("map %s inserted, shape %s", digest, value.shape)
+        return digest
+
+    def read(self, digest):
+        """the map ``digest`` as an array"""
+        with h5py.File(self.path(digest), "r") as f:
+            return f[MAP_NAME][()]
+
+    def write_reference(self, group, name, value):
+        """
+        Write ``value`` as a virtual dataset mapping onto its library file (inserted if missing)
+
+        :param group: h5parent
+        :param name: name of the dataset
+        :param value: array, dataset or lazy loader field (see :func:`can_store`)
+        :return *h5py.Dataset*: the virtual dataset, with the ``content_digest`` attribute
+        """
+        if not hasattr(value, "dtype"):
+            value = np.asarray(value)
+        digest = self.insert(value)
+        layout = h5py.VirtualLayout(shape=value.shape, dtype=value.dtype)
+        layout[...] = h5py.VirtualSource(self.path(digest), MAP_NAME, shape=value.shape, dtype=value.dtype)
+        ds = group.create_virtual_dataset(name, layout)
+        ds.attrs[DIGEST_ATTR] = digest
+        logger.debug("referenced %s -> map %s", ds.name, digest)
+        return ds
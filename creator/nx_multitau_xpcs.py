@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""
+Multi-tau intensity autocorrelation of a stream of detector frames.
+
+The frames are read block by block (from an ``h5py.Dataset``, a
+``numpy.memmap`` of a raw file or any source with ``iter_blocks``) and never
+held in memory as a stack.  The pixels of every dynamic ROI (label of the
+``dynamic_roi_map``) are correlated on a multi-tau ladder: level 0 holds the
+last ``buf`` frames and correlates the delays ``1 .. buf - 1``; every level
+above holds ``buf`` averages of two frames of the level below and
+correlates the delays ``buf / 2 .. buf - 1`` of its (doubled) time step.
+Memory is ``buf`` frames of ROI pixels per level plus a few sums per ROI and
+delay, independent of the number of frames.
+
+Per ROI and delay the sums of ``<I(t) I(t + tau)>``, ``<I(t)>`` and
+``<I(t + tau)>`` (averaged over the pixels of the ROI) are accumulated and
+
+    g2 = <I(t) I(t + tau)> / (<I(t)> <I(t + tau)>)
+
+``g2_stderr`` is the standard error of the mean over the frame pairs (which
+are not independent, so it is a lower bound).  The ROIs can be split across
+threads (``workers``); each thread correlates the pixels of its ROIs of the
+same blocks, NumPy releases the GIL for the arithmetic.
+"""
+import concurrent.futures
+import logging
+
+import numpy as np
+
+from creator.nx_pipeline_xpcs import PrefetchSource
+from creator.nx_stream_xpcs import DEFAULT_BLOCK_BYTES
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUF = 8  # frames per level, even
+
+
+def level_lags(buf, level):
+    """delays of one level, in units of the level's time step (``2**level`` frames)"""
+    return np.arange(1 if level == 0 else buf // 2, buf)
+
+
+def number_of_levels(n_frames, buf=DEFAULT_BUF):
+    """number of levels whose smallest delay is shorter than the run"""
+    levels = 1
+    while (buf // 2) * 2 ** levels < n_frames:
+        levels += 1
+    return levels
+
+
+def delays(n_frames, buf=DEFAULT_BUF):
+    """delays (in frames) of the multi-tau ladder with at least one pair of frames in a run of ``n_frames``"""
+    tau = []
+    for level in range(number_of_levels(n_frames, buf)):
+        lags = level_lags(buf, level)
+        # level ``level`` holds n_frames // 2**level (averaged) frames
+        tau.append(lags[lags < n_frames // 2 ** level] * 2 ** level)
+    return np.concatenate(tau)
+
+
+class MultiTau:
+    """
+    Multi-tau accumulator for the pixels of a set of ROIs.
+
+    The pixel vector passed to :meth:`add` holds the pixels of ROI 0, then
+    the pixels of ROI 1 and so on.  Sparse frames are passed to
+    :meth:`add_events` as positions in this vector and counts; they are
+    correlated event by event (and averaged into sparse frames of the next
+    level), the dense buffers only serve to look up the earlier frames.
+
+    :param npix: number of pixels of every ROI (all > 0)
+    :param n_frames: number of frames of the run
+    :param buf: frames per level, even
+    """
+
+    def __init__(self, npix, n_frames, buf=DEFAULT_BUF):
+        if buf < 2 or buf % 2:
+            raise ValueError(f"buf must be an even number >= 2, got {buf}")
+        self.npix = np.asarray(npix, dtype=np.int64)
+        if (self.npix <= 0).any():
+            raise ValueError("every ROI needs at least one pixel")
+        self.starts = np.concatenate([[0], np.cumsum(self.npix)[:-1]])
+        self.buf = buf
+        self.levels = number_of_levels(n_frames, buf)
+        n_roi, n_pix = len(self.npix), int(self.npix.sum())
+        self._frames = [np.zeros((buf, n_pix), dtype=np.float32) for _ in range(self.levels)]
+        self._means = [np.zeros((buf, n_roi)) for _ in range(self.levels)]
+        self._inserted = [0] * self.levels
+        self._lags = [level_lags(buf, level) for level in range(self.levels)]
+        self._G = [np.zeros((len(lags), n_roi)) for lags in self._lags]
+        self._G_sq = [np.zeros((len(lags), n_roi)) for lags in self._lags]
+        self._IP = [np.zeros((len(lags), n_roi)) for lags in self._lags]
+        self._IF = [np.zeros((len(lags), n_roi)) for lags in self._lags]
+        self._pairs = [np.zeros(len(lags), dtype=np.int64) for lags in self._lags]
+        self._roi_of = np.repeat(np.arange(n_roi), self.npix)  # ROI of every pixel position
+        self._events = [[None] * buf for _ in range(self.levels)]  # sparse mode: events of each slot
+
+    def _roi_means(self, pixels):
+        return np.add.reduceat(pixels, self.starts, axis=-1, dtype=np.float64) / self.npix
+
+    def add(self, frames):
+        """
+        Correlate the next frames.
+
+        :param frames: array with shape (n, pixels) in ROI order
+        """
+        for frame in frames:
+            self._add(0, np.asarray(frame, dtype=np.float32))
+
+    def _add(self, level, frame):
+        t = self._inserted[level]
+        slot = t % self.buf
+        self._frames[level][slot] = frame
+        self._means[level][slot] = self._roi_means(frame)
+        self._inserted[level] += 1
+
+        lags = self._lags[level]
+        valid = lags <= t
+        if valid.any():
+            past_slots = (t - lags[valid]) % self.buf
+            products = self._roi_means(self._frames[level][past_slots] * frame)
+            self._G[level][valid] += products
+            self._G_sq[level][valid] += products ** 2
+            self._IP[level][valid] += self._means[level][past_slots]
+            self._IF[level][valid] += self._means[level][slot]
+            self._pairs[level][valid] += 1
+
+        if t % 2 == 1 and level + 1 < self.levels:
+            previous = self._frames[level][(t - 1) % self.buf]
+            self._add(level + 1, (previous + frame) / 2)
+
+    def add_events(self, frame_ptr, position, count):
+        """
+        Correlate the next sparse frames.
+
+        :param frame_ptr: the events of frame ``i`` are ``frame_ptr[i]:frame_ptr[i + 1]``
+        :param position: position of every event in the pixel vector (ROI order)
+        :param count: photons of every event
+        """
+        count = np.asarray(count, dtype=np.float32)
+        for start, stop in zip(frame_ptr[:-1], frame_ptr[1:]):
+            self._add_events(0, position[start:stop], count[start:stop])
+
+    def _roi_sums(self, position, weights):
+        """sums per ROI of the weights (n, events) of the events at ``position``"""
+        n_roi = len(self.npix)
+        index = (np.arange(len(weights))[:, np.newaxis] * n_roi + self._roi_of[position]).ravel()
+        return np.bincount(index, weights=weights.ravel(), minlength=len(weights) * n_roi).reshape(-1, n_roi)
+
+    def _add_events(self, level, position, count):
+        t = self._inserted[level]
+        slot = t % self.buf
+        frame = self._frames[level][slot]
+        previous = self._events[level][slot]
+        if previous is not None:
+            frame[previous[0]] = 0
+        np.add.at(frame, position, count)  # positions may repeat above level 0
+        self._events[level][slot] = (position, count)
+        self._means[level][slot] = self._roi_sums(position, count[np.newaxis])[0] / self.npix
+        self._inserted[level] += 1
+
+        lags = self._lags[level]
+        valid = lags <= t
+        if valid.any():
+            past_slots = (t - lags[valid]) % self.buf
+            # the product vanishes where the current frame has no events
+            past = self._frames[level][past_slots[:, np.newaxis], position]
+            products = self._roi_sums(position, past * count) / self.npix
+            self._G[level][valid] += products
+            self._G_sq[level][valid] += products ** 2
+            self._IP[level][valid] += self._means[level][past_slots]
+            self._IF[level][valid] += self._means[level][slot]
+            self._pairs[level][valid] += 1
+
+        if t % 2 == 1 and level + 1 < self.levels:
+            earlier = self._events[level][(t - 1) % self.buf]
+            position = np.concatenate([earlier[0], position])
+            count = np.concatenate([earlier[1], count]) / 2
+            if len(position) > len(self._roi_of) // 4:
+                # merge repeated positions once the frames are no longer sparse
+                dense = np.bincount(position, weights=count, minlength=len(self._roi_of))
+                position = np.flatnonzero(dense)
+                count = dense[position].astype(np.float32)
+            self._add_events(level + 1, position, count)
+
+    def result(self):
+        """
+        ``(delays, g2, g2_stderr, G2)``, delays in frames, the others with shape (delays, ROIs)
+
+        Delays without any pair of frames are left out.
+        """
+        tau, G, G_sq, IP, IF, pairs = [], [], [], [], [], []
+        for level in range(self.levels):
+            tau.append(self._lags[level] * 2 ** level)
+            G.append(self._G[level])
+            G_sq.append(self._G_sq[level])
+            IP.append(self._IP[level])
+            IF.append(self._IF[level])
+            pairs.append(self._pairs[level])
+        pairs = np.concatenate(pairs)
+        used = pairs > 0
+        n = pairs[used, np.newaxis]
+        G, G_sq = np.concatenate(G)[used] / n, np.concatenate(G_sq)[used] / n
+        norm = (np.concatenate(IP)[used] / n) * (np.concatenate(IF)[used] / n)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            g2 = G / norm
+            stderr = np.sqrt(np.maximum(G_sq - G ** 2, 0) / n) / norm
+        return np.concatenate(tau)[used], g2, stderr, G
+
+
+def _split_rois(npix, workers):
+    """contiguous groups of ROIs with about the same number of pixels"""
+    bounds = np.searchsorted(np.cumsum(npix), np.arange(1, workers) * npix.sum() / workers)
+    return [group for group in np.split(np.arange(len(npix)), bounds) if len(group)]
+
+
+def multi_tau(frames, dynamic_roi_map, buf=DEFAULT_BUF, workers=1, max_bytes=DEFAULT_BLOCK_BYTES,
+              frame_time=None, frame_time_units="s"):
+    """
+    Correlate a stack of frames per dynamic ROI.
+
+    :param frames: frames with shape (n, rows, columns): ``h5py.Dataset``, ``numpy.memmap``,
+                   array, source with ``iter_blocks`` or sparse frames with ``iter_events``
+                   (see :class:`creator.nx_sparse_xpcs.SparseFrames`)
+    :param dynamic_roi_map: ROI label of every pixel (1 .. n_q), 0 for pixels not used
+    :param buf: frames per level of the multi-tau ladder (even)
+    :param workers: number of threads, the ROIs are split between them
+    :param max_bytes: upper limit for the frames read at once
+    :param frame_time: time between frame starts, if given the delays are written in its units
+    :param frame_time_units: units of ``frame_time``
+    :return *dict*: ``g2``, ``g2_stderr``, ``G2_unnormalized`` (shape (delays, n_q)),
+                    ``delay_difference`` and ``delay_difference_units`` for ``create_xpcs_group``
+    """
+    roi_map = np.asarray(dynamic_roi_map).ravel()
+    n_frames = frames.shape[0]
+    if tuple(frames.shape[1:]) != np.shape(dynamic_roi_map):
+        raise ValueError(f"frames of shape {tuple(frames.shape[1:])} do not match the "
+                         f"roi map of shape {np.shape(dynamic_roi_map)}")
+    n_q = int(roi_map.max(initial=0))
+    npix = np.bincount(roi_map, minlength=n_q + 1)[1:]
+    rois = np.flatnonzero(npix) + 1  # labels of the populated ROIs
+
+    # pixels of every populated ROI, ROI after ROI
+    order = np.argsort(roi_map, kind="stable")
+    order = order[np.searchsorted(roi_map[order], 1):]
+    groups = _split_rois(npix[rois - 1], max(1, workers))
+    offsets = np.concatenate([[0], np.cumsum(npix[rois - 1])])
+    pixel_groups = [order[offsets[group[0]]:offsets[group[-1] + 1]] for group in groups]
+    correlators = [MultiTau(npix[rois[group] - 1], n_frames, buf) for group in groups]
+    logger.debug("correlating %d frames of %d ROIs in %d groups", n_frames, len(rois), len(groups))
+
+    def correlate(index, block):
+        correlators[index].add(block[:, pixel_groups[index]])
+
+    # sparse frames: position of every detector pixel in the pixel vector of its group, -1 if unused
+    positions = []
+    for pixels in pixel_groups:
+        position = np.full(len(roi_map), -1, dtype=np.int64)
+        position[pixels] = np.arange(len(pixels))
+        positions.append(position)
+
+    def correlate_events(index, events):
+        frame_ptr, pixel_index, count = events
+        position = positions[index][pixel_index]
+        used = position >= 0
+        kept = np.concatenate([[0], np.cumsum(used)])[frame_ptr]
+        correlators[index].add_events(kept, position[used], count[used])
+
+    if not groups:
+        # no ROI has pixels: nothing to correlate, the frames are not read
+        logger.warning("dynamic_roi_map has no ROI pixels, nothing to correlate")
+        results, tau = [], delays(n_frames, buf)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(groups)) as pool:
+            if hasattr(frames, "iter_events"):
+                for _, _, *events in frames.iter_events(max_bytes):
+                    list(pool.map(correlate_events, range(len(groups)), [events] * len(groups)))
+            else:
+                for _, block in PrefetchSource(frames).iter_blocks(max_bytes):
+                    block = np.asarray(block).reshape(len(block), -1)
+                    list(pool.map(correlate, range(len(groups)), [block] * len(groups)))
+        results = [c.result() for c in correlators]
+        tau = results[0][0]
+    g2, stderr, G2 = (np.full((len(tau), n_q), np.nan) for _ in range(3))
+    for group, (_, g, s, G) in zip(groups, results):
+        columns = rois[group] - 1
+        g2[:, columns], stderr[:, columns], G2[:, columns] = g, s, G
+
+    if frame_time is None:
+        delay, units = tau, None
+    else:
+        delay, units = tau * float(np.asarray(frame_time)), frame_time_units
+    return dict(g2=g2,
+                g2_stderr=stderr,
+                G2_unnormalized=G2,
+                delay_difference=delay,
+                delay_difference_units=units)
+
+
+def write_multi_tau(creator, frames, dynamic_roi_map, dynamic_q_list=None, **options):
+    """
+    Correlate the frames and write the results to the XPCS group of the NeXus file.
+
+    :param creator: NXCreator with an entry group
+    :param frames: frames with shape (n, rows, columns), see :func:`multi_tau`
+    :param dynamic_roi_map: ROI label of every pixel (1 .. n_q), 0 for pixels not used
+    :param dynamic_q_list: q value of every ROI
+    :param options: keyword arguments of :func:`multi_tau`
+    """
+    results = multi_tau(frames, dynamic_roi_map, **options)
+    creator.create_xpcs_group(dynamic_roi_map=dynamic_roi_map, dynamic_q_list=dynamic_q_list, **results)
+    return results
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""
+Static and dynamic q/phi partitions of the detector (port of ``getimgpartition.m``).
+
+The maps (``q``, ``phi``, ``qx``, ``qy``, ``qz``, ``qr``) are computed from the
+detector geometry written by
+:meth:`~creator.nx_creator_xpcs.NXCreator.create_instrument_group`.  Each
+partition name is split into ``npt`` bins, evenly spaced in linear
+(``method=1``) or log10 scale (``method=2``), over the range of the unmasked
+pixels.  The bin index of every pixel is found with ``np.digitize`` and the
+labels, pixel counts and mean map values of all bins are computed in one
+pass with ``np.bincount`` (instead of a loop over the bins).
+
+Labels follow ``getimgpartition.m``: for two names with ``npt = (n1, n2)``
+the pixels of bin ``(n, m)`` (1-based) get the label ``(n - 1) * n2 + m``,
+masked pixels and pixels outside of the spans get ``0``.
+"""
+import logging
+
+import numpy as np
+
+from creator.nx_units import conversion_factor
+
+logger = logging.getLogger(__name__)
+
+MAP_NAMES = ("q", "phi", "qx", "qy", "qz", "qr")
+LINEAR = 1  # evenly spaced bins
+LOG10 = 2  # evenly spaced in log10 scale (equal dq/q)
+HC_KEV_ANGSTROM = 12.398419843320026  # photon wavelength [angstrom] * energy [keV]
+
+
+def detector_maps(shape,
+                  distance,
+                  x_pixel_size,
+                  y_pixel_size,
+                  beam_center_x,
+                  beam_center_y,
+                  energy,
+                  distance_units="mm",
+                  pixel_size_units="um",
+                  energy_units="keV",
+                  names=MAP_NAMES):
+    """
+    Maps of the scattering vector of every pixel of a detector normal to the beam.
+
+    ``q`` and its components are in 1/angstrom, ``phi`` (azimuth, counter-clockwise
+    from the x axis) in degrees.  x runs along the columns, y along the rows.
+
+    :param shape: (rows, columns) of the detector
+    :param distance: sample to detector distance
+    :param x_pixel_size: pixel size in x direction
+    :param y_pixel_size: pixel size in y direction
+    :param beam_center_x: beam center (column) in pixels
+    :param beam_center_y: beam center (row) in pixels
+    :param energy: photon energy of the incident beam
+    :param distance_units: units of distance
+    :param pixel_size_units: units of the pixel sizes
+    :param energy_units: units of energy
+    :param names: maps to compute, subset of :data:`MAP_NAMES`
+    :return *dict*: ``{name: float64 array with shape}``
+    """
+    unknown = set(names) - set(MAP_NAMES)
+    if unknown:
+        raise ValueError(f"unknown map names {sorted(unknown)}, use {MAP_NAMES}")
+    distance_mm = float(np.asarray(distance)) * conversion_factor(distance_units, "mm")
+    to_mm = conversion_factor(pixel_size_units, "mm")
+    wavelength = HC_KEV_ANGSTROM / (float(np.asarray(energy)) * conversion_factor(energy_units, "keV"))
+    k = 2 * np.pi / wavelength
+
+    rows, columns = shape
+    dx = (np.arange(columns) - float(np.asarray(beam_center_x))) * float(np.asarray(x_pixel_size)) * to_mm
+    dy = (np.arange(rows) - float(np.asarray(beam_center_y))) * float(np.asarray(y_pixel_size)) * to_mm
+    dx, dy = np.meshgrid(dx, dy)
+    r = np.sqrt(dx ** 2 + dy ** 2 + distance_mm ** 2)
+
+    maps = {}
+    if "qx" in names or "qr" in names:
+        maps["qx"] = k * dx / r
+    if "qy" in names or "qr" in names:
+        maps["qy"] = k * dy / r
+    if "qz" in names:
+        maps["qz"] = k * (distance_mm / r - 1)
+    if "qr" in names:
+        maps["qr"] = np.hypot(maps["qx"], maps["qy"])
+    if "q" in names:
+        # |k_out - k_in| = 2 k sin(theta) = k sqrt(2 - 2 cos(2 theta))
+        maps["q"] = k * np.sqrt(2 - 2 * distance_mm / r)
+    if "phi" in names:
+        maps["phi"] = np.degrees(np.arctan2(dy, dx))
+    return {name: maps[name] for name in names}
+
+
+def continuous_phi(phi):
+    """
+    Shift angles (degrees) by 360 so that the largest gap between them lies at the ends.
+
+    Masks that cover the -180/180 discontinuity (e.g. a sector around -x)
+    would otherwise get one partition spanning the whole circle.
+
+    :param phi: angles in degrees, in [-180, 180]
+    """
+    values = np.unique(phi)
+    if values.size < 2:
+        return phi
+    gaps = np.diff(values)
+    largest = int(np.argmax(gaps))
+    if gaps[largest] <= 360 - (values[-1] - values[0]):
+        return phi
+    start = values[largest + 1]
+    return np.where(phi < start, phi + 360, phi)
+
+
+def partition_span(values, npt, method=LINEAR):
+    """
+    Edges of ``npt`` bins over the range of ``values``.
+
+    Log10 spacing falls back to linear spacing if the range is not positive.
+
+    :param values: map values of the unmasked pixels
+    :param npt: number of bins
+    :param method: ``LINEAR`` (1) or ``LOG10`` (2), the ``smethod``/``dmethod`` values
+    """
+    if method not in (LINEAR, LOG10):
+        raise ValueError(f"unknown partition method {method}, use {LINEAR} (linear) or {LOG10} (log10)")
+    low, high = float(np.min(values)), float(np.max(values))
+    if method == LOG10 and 0 < low < high:
+        return np.logspace(np.log10(low), np.log10(high), npt + 1)
+    return np.linspace(low, high, npt + 1)
+
+
+class Partition:
+    """
+    One (static or dynamic) partition of the detector.
+
+    :param roi_map: labels of the pixels, 0 for masked pixels
+    :param names: partition names, e.g. ("q", "phi")
+    :param spans: bin edges of every name
+    :param mean: mean map value of every name and bin, shape (len(names), *npt)
+    :param counts: number of pixels of every bin, shape npt
+    """
+
+    def __init__(self, roi_map, names, spans, mean, counts):
+        self.roi_map = roi_map
+        self.names = tuple(names)
+        self.spans = spans
+        self.mean = mean
+        self.counts = counts
+
+    def __repr__(self):
+        return f"Partition(names={self.names}, npt={self.counts.shape})"
+
+    def mean_of(self, name):
+        """mean value of map ``name`` for every label (1, 2, ...) as 1-D array"""
+        return self.mean[self.names.index(name)].ravel()
+
+
+def partition(maps, mask=None, names=("q", "phi"), npt=(36, 1), method=(LINEAR, LINEAR)):
+    """
+    Label the pixels by bins of one or more maps.
+
+    Empty bins get the center of their span as mean value (as in ``getimgpartition.m``).
+
+    :param maps: dictionary of maps, see :func:`detector_maps`
+    :param mask: user mask, nonzero for the pixels to use (default: all pixels)
+    :param names: partition names (keys of ``maps``)
+    :param npt: number of bins per name
+    :param method: ``LINEAR`` or ``LOG10`` spacing per name
+    :return *Partition*:
+    """
+    if not len(names) == len(npt) == len(method):
+        raise ValueError("names, npt and method must have the same length")
+    shape = maps[names[0]].shape
+    valid = np.ones(shape, dtype=bool) if mask is None else np.asarray(mask) != 0
+    if not valid.any():
+        raise ValueError("the mask excludes all pixels")
+
+    values, spans, bins = [], [], []
+    for name, n, m in zip(names, npt, method):
+        v = maps[name][valid].astype(np.float64)
+        if name == "phi":
+            v = continuous_phi(v)
+        span = partition_span(v, n, m)
+        # log10 spans may miss the extreme pixels by rounding
+        span[0], span[-1] = min(span[0], v.min()), max(span[-1], v.max())
+        # bin n holds span[n - 1] <= v < span[n], the last bin includes its upper edge
+        b = np.digitize(v, span)
+        b[v == span[-1]] = n
+        values.append(v)
+        spans.append(span)
+        bins.append(b)
+
+    inside = np.all([(b >= 1) & (b <= n) for b, n in zip(bins, npt)], axis=0)
+    labels = np.zeros(valid.sum(), dtype=np.int64)
+    labels[inside] = np.ravel_multi_index(tuple(b[inside] - 1 for b in bins), tuple(npt)) + 1
+
+    n_labels = int(np.prod(npt)) + 1
+    counts = np.bincount(labels, minlength=n_labels)[1:]
+    mean = np.empty((len(names),) + tuple(npt))
+    for i, (v, span) in enumerate(zip(values, spans)):
+        sums = np.bincount(labels, weights=v, minlength=n_labels)[1:]
+        centers = (span[:-1] + span[1:]) / 2
+        index = [np.newaxis] * len(names)
+        index[i] = slice(None)
+        fill = np.broadcast_to(centers[tuple(index)], tuple(npt)).ravel()
+        mean[i] = np.where(counts > 0, sums / np.maximum(counts, 1), fill).reshape(npt)
+
+    roi_map = np.zeros(shape, dtype=np.int32)
+    roi_map[valid] = labels
+    logger.debug("partition %s %s: %d of %d bins populated", names, tuple(npt), np.count_nonzero(counts), counts.size)
+    return Partition(roi_map, names, spans, mean, counts.reshape(npt))
+
+
+def xpcs_partition_kwargs(shape,
+                          mask=None,
+                          names=("q", "phi"),
+                          snpt=(36, 1),
+                          dnpt=(9, 1),
+                          smethod=(LINEAR, LINEAR),
+                          dmethod=(LINEAR, LINEAR),
+                          **instrument):
+    """
+    Static and dynamic partitions as keyword arguments of ``NXCreator.create_xpcs_group``.
+
+    ``instrument`` takes the geometry keywords of ``create_instrument_group``
+    (``distance``, ``x_pixel_size``, ``y_pixel_size``, ``beam_center_x``,
+    ``beam_center_y``, ``energy`` and their units); other keywords are ignored.
+
+    :param shape: (rows, columns) of the detector
+    :param mask: user mask, nonzero for the pixels to use
+    :param names: partition names, "q" must be one of them
+    :param snpt: number of static bins per name
+    :param dnpt: number of dynamic bins per name
+    :param smethod: static spacing per name, ``LINEAR`` or ``LOG10``
+    :param dmethod: dynamic spacing per name, ``LINEAR`` or ``LOG10``
+    :return *dict*: roi maps, q lists (and phi list) and the mask
+    """
+    geometry = {key: instrument[key] for key in
+                ("distance", "x_pixel_size", "y_pixel_size", "beam_center_x", "beam_center_y", "energy")}
+    for key in ("distance_units", "pixel_size_units", "energy_units"):
+        if instrument.get(key) is not None:
+            geometry[key] = instrument[key]
+    maps = detector_maps(shape, names=tuple(names), **geometry)
+    static = partition(maps, mask, names, snpt, smethod)
+    dynamic = partition(maps, mask, names, dnpt, dmethod)
+    kwargs = dict(mask=None if mask is None else (np.asarray(mask) != 0).astype(np.int32),
+                  dynamic_roi_map=dynamic.roi_map,
+                  dynamic_q_list=dynamic.mean_of("q"),
+                  static_roi_map=static.roi_map,
+                  static_q_list=static.mean_of("q"))
+    if "phi" in names:
+        kwargs["dynamic_phi_list"] = dynamic.mean_of("phi")
+    return kwargs
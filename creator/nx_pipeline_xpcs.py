@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Pipelined conversion: overlap reading the input with writing the NeXus file.
+
+A reader thread asks the loader for the data of the next group while the
+calling (writer) thread writes the current group with the
+:class:`~creator.nx_creator_xpcs.NXCreator`.  Small fields are read by the
+reader thread; large fields are wrapped in a :class:`PrefetchSource`, whose
+own reader thread reads the next blocks while the writer writes the current
+one.  All queues are bounded, so memory stays at ``queue_size`` groups of
+small fields plus ``depth`` blocks per large field.
+
+Note that h5py serializes calls into the HDF5 library, so the overlap comes
+from the work done outside of it (decompression in the OS, NumPy copies,
+Python overhead, waiting for the disk between requests).
+"""
+import logging
+import queue
+import threading
+
+import h5py
+import numpy as np
+
+from creator.nx_stream_xpcs import iter_blocks
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 2  # groups read ahead
+DEFAULT_DEPTH = 2  # blocks read ahead per large field
+
+_DONE = object()
+
+
+class _Failure:
+    """exception raised in a reader thread, re-raised by the consumer"""
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _put(q, item, stop):
+    """put ``item`` into the bounded queue unless the consumer stopped; `False` if stopped"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _drain(q, thread, stop):
+    """yield the items of the queue until the reader is done"""
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class PrefetchSource:
+    """
+    Wrap a large source so that its blocks are read ahead in a thread.
+
+    :param value: source, lazy field or ``h5py.Dataset``
+    :param depth: number of blocks read ahead
+    """
+
+    source = None  # always stream (never copy inside HDF5)
+
+    def __init__(self, value, depth=DEFAULT_DEPTH):
+        self._value = value
+        self.depth = depth
+        self.shape = tuple(value.shape)
+        self.dtype = np.dtype(value.dtype)
+        self.units = getattr(value, "units", None)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape, dtype=np.int64)) * self.dtype.itemsize
+
+    def __getitem__(self, selection):
+        return self._value[selection]
+
+    def read(self):
+        return self._value.read() if hasattr(self._value, "read") else self._value[()]
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.asarray(self.read())
+        return data if dtype is None else data.astype(dtype)
+
+    def iter_blocks(self, max_bytes):
+        """Yield ``(selection, block)`` pairs, read ahead by a reader thread."""
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def reader():
+            try:
+                for item in iter_blocks(self._value, max_bytes):
+                    if not _put(q, item, stop):
+                        return
+                _put(q, _DONE, stop)
+            except BaseException as exc:
+                _put(q, _Failure(exc), stop)
+
+        thread = threading.Thread(target=reader, name="nx-prefetch", daemon=True)
+        thread.start()
+        yield from _drain(q, thread, stop)
+
+
+def prefetch_fields(md, max_bytes, depth=DEFAULT_DEPTH):
+    """
+    Read the small fields of ``md`` and wrap the large ones in a :class:`PrefetchSource`.
+
+    :param md: keyword arguments of one creator method
+    :param max_bytes: fields larger than this are streamed
+    :param depth: number of blocks read ahead per large field
+    """
+    prefetched = {}
+    for key, value in md.items():
+        if hasattr(value, "iter_blocks") or isinstance(value, h5py.Dataset):
+            if len(value.shape) > 0 and value.nbytes > max_bytes:
+                value = PrefetchSource(value, depth)
+            elif hasattr(value, "read"):
+                value = value.read()
+            else:
+                value = value[()]
+        prefetched[key] = value
+    return prefetched
+
+
+def run_pipelined(creator, stages, queue_size=DEFAULT_QUEUE_SIZE, depth=DEFAULT_DEPTH):
+    """
+    Write all ``stages`` with the creator while the next ones are read.
+
+    :param creator: NXCreator (ideally inside a session)
+    :param stages: list of ``(creator method name, function returning its keyword arguments)``
+    :param queue_size: number of groups read ahead
+    :param depth: number of blocks read ahead per large field
+    """
+    q = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def reader():
+        try:
+            for method, produce in stages:
+                kwargs = prefetch_fields(produce(), creator.max_block_bytes, depth)
+                if not _put(q, (method, kwargs), stop):
+                    return
+            _put(q, _DONE, stop)
+        except BaseException as exc:
+            _put(q, _Failure(exc), stop)
+
+    thread = threading.Thread(target=reader, name="nx-reader", daemon=True)
+    thread.start()
+    for method, kwargs in _drain(q, thread, stop):
+        logger.debug("writing %s", method)
+        getattr(creator, method)(**kwargs)
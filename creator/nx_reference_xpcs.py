@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Reference mode: point into the source file instead of copying its data.
+
+With ``NXCreator(..., reference_mode=True)`` every field backed by a dataset of
+the input file (and the stacked two-time data) is written as an HDF5 virtual
+dataset (VDS) that maps onto the source file.  Virtual datasets are used
+rather than ``h5py.ExternalLink`` because they are datasets of the NeXus file
+and keep its attributes (``units``, ``target``, ...).  The source file name
+is stored relative to the NeXus file, so both may be moved together.
+
+:func:`materialize` turns such a reference file into a self-contained copy::
+
+    python -m creator.nx_reference_xpcs reference.nxs archive.nxs
+"""
+import logging
+import os
+import sys
+
+import h5py
+
+from creator.nx_stream_xpcs import DEFAULT_BLOCK_BYTES, write_streamed
+
+logger = logging.getLogger(__name__)
+
+
+def _source_datasets(value):
+    """Datasets of the input file behind ``value``, or None if it cannot be referenced"""
+    source = getattr(value, "source", None)
+    if source is not None:
+        datasets = [source]
+    elif hasattr(value, "datasets"):
+        datasets = list(value.datasets)
+    else:
+        return None
+    for ds in datasets:
+        # virtual datasets need a dataspace and a fixed-size type
+        if not isinstance(ds, h5py.Dataset) or ds.ndim == 0 or ds.dtype.kind not in "biufc":
+            return None
+    return datasets
+
+
+def can_reference(value):
+    """`True` if ``value`` can be written as a virtual dataset"""
+    return _source_datasets(value) is not None
+
+
+def write_virtual(group, name, value):
+    """
+    Write ``value`` as a virtual dataset mapping onto its source file(s).
+
+    :param group: h5parent
+    :param name: name of the dataset
+    :param value: lazy field with a ``source`` dataset, or a stacked source
+    """
+    datasets = _source_datasets(value)
+    if datasets is None:
+        raise ValueError(f"'{name}' is not backed by a dataset of an input file")
+    directory = os.path.dirname(os.path.abspath(group.file.filename))
+
+    layout = h5py.VirtualLayout(shape=value.shape, dtype=value.dtype)
+    stacked = getattr(value, "source", None) is None
+    for index, ds in enumerate(datasets):
+        filename = os.path.relpath(os.path.abspath(ds.file.filename), directory)
+        vsource = h5py.VirtualSource(filename, ds.name, shape=ds.shape, dtype=ds.dtype)
+        if stacked:
+            layout[index] = vsource
+        else:
+            layout[...] = vsource
+    ds = group.create_virtual_dataset(name, layout)
+    logger.debug("referenced %s -> %s", ds.name, [d.name for d in datasets])
+    return ds
+
+
+def materialize(input_filename, output_filename, max_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Copy a NeXus file and replace all virtual datasets by their data.
+
+    Ordinary datasets are copied inside HDF5, virtual datasets are streamed
+    block by block, so memory is bounded by ``max_bytes``.  Hard links (e.g.
+    the shared groups of a series file) stay hard links.
+
+    :param input_filename: NeXus file written in reference mode
+    :param output_filename: self-contained NeXus file to write
+    :param max_bytes: upper limit for the size of one block
+    """
+    with h5py.File(input_filename, "r") as src, h5py.File(output_filename, "w") as dst:
+        dst.attrs.update(src.attrs)
+        copied = {}  # multiply linked source object -> its path in dst
+        linked = []  # paths of hard links in dst, their members are copied already
+
+        def visitor(name, link):
+            if any(name.startswith(prefix) for prefix in linked):
+                return
+            if not isinstance(link, h5py.HardLink):
+                # soft and external links are kept as they are
+                dst[name] = link
+                return
+            obj = src[name]
+            if obj.id in copied:
+                # another name of an object copied before (e.g. a shared group of a series file)
+                dst[name] = dst[copied[obj.id]]
+                linked.append(name + "/")
+                return
+            if h5py.h5o.get_info(obj.id).rc > 1:
+                copied[obj.id] = name
+            if isinstance(obj, h5py.Group):
+                dst.create_group(name).attrs.update(obj.attrs)
+            elif obj.is_virtual:
+                ds = write_streamed(dst, name, obj, max_bytes)
+                ds.attrs.update(obj.attrs)
+            else:
+                parent, _, base = name.rpartition("/")
+                dst.copy(obj, dst[parent or "/"], name=base)
+
+        # every link, also the second name of a hard-linked object (visititems skips those)
+        src.visititems_links(visitor)
+
+
+def get_user_parameters():
+    """configure user's command line parameters from sys.argv"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=sys.argv[0], description="materialize a NXxpcs reference file"
+    )
+    parser.add_argument(
+        "Reference_file",
+        action="store",
+        help="NXxpcs file written in reference mode",
+    )
+    parser.add_argument(
+        "NeXus_file",
+        action="store",
+        help="self-contained NXxpcs (output) file",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    options = get_user_parameters()
+    materialize(options.Reference_file, options.NeXus_file)
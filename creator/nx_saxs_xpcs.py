@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+SAXS 1D reduction of a frame stack over the ``static_roi_map``.
+
+One streaming pass over the frames: the frames of the current time slice are
+summed pixel by pixel into one float64 image (split into pixel ranges over
+``workers`` threads, NumPy releases the GIL for the sums).  When a slice is
+complete, its image is reduced to the mean intensity of every static ROI with
+one ``np.bincount`` over the flattened ``static_roi_map``.  ``I`` is the mean
+over all slices, ``I_partial`` holds the slices.  Sparse frames (see
+:class:`creator.nx_sparse_xpcs.SparseFrames`) are reduced from their events.
+"""
+import concurrent.futures
+import logging
+
+import numpy as np
+
+from creator.nx_pipeline_xpcs import PrefetchSource
+from creator.nx_stream_xpcs import DEFAULT_BLOCK_BYTES
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SLICES = 10  # time slices of I_partial
+
+
+def slice_edges(n_frames, slices=DEFAULT_SLICES):
+    """first frame of every time slice and the end of the last one"""
+    if not 0 < slices <= n_frames:
+        raise ValueError(f"cannot split {n_frames} frames into {slices} slices")
+    return np.linspace(0, n_frames, slices + 1).round().astype(np.int64)
+
+
+def _pixel_ranges(n_pixels, workers):
+    edges = np.linspace(0, n_pixels, workers + 1).astype(np.int64)
+    return [slice(a, b) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+def saxs_1d(frames, static_roi_map, static_q_list=None, slices=DEFAULT_SLICES, workers=1,
+            max_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Azimuthally averaged intensity of every static ROI, in total and per time slice.
+
+    :param frames: frames with shape (n, rows, columns): ``h5py.Dataset``, ``numpy.memmap``,
+                   array, source with ``iter_blocks`` or sparse frames with ``iter_events``
+    :param static_roi_map: static ROI label of every pixel (1 .. n), 0 for pixels not used
+    :param static_q_list: q value of every static ROI (``Q``)
+    :param slices: number of time slices of ``I_partial``
+    :param workers: number of threads summing the frames
+    :param max_bytes: upper limit for the frames read at once
+    :return *dict*: keyword arguments for ``create_saxs_1d_group``,
+                    ``I`` with shape (n,) and ``I_partial`` with shape (slices, n)
+    """
+    labels = np.asarray(static_roi_map).ravel()
+    n_frames = frames.shape[0]
+    if tuple(frames.shape[1:]) != np.shape(static_roi_map):
+        raise ValueError(f"frames of shape {tuple(frames.shape[1:])} do not match the "
+                         f"roi map of shape {np.shape(static_roi_map)}")
+    n_roi = int(labels.max())
+    npix = np.bincount(labels, minlength=n_roi + 1)[1:]
+    edges = slice_edges(n_frames, slices)
+    sums = np.zeros((slices, n_roi))
+
+    if hasattr(frames, "iter_events"):
+        for start, stop, ptr, pixel_index, count in frames.iter_events(max_bytes):
+            frame = start + np.repeat(np.arange(stop - start), np.diff(ptr))
+            label = labels[pixel_index]
+            used = label > 0
+            index = (np.searchsorted(edges, frame[used], side="right") - 1) * n_roi + label[used] - 1
+            sums += np.bincount(index, weights=count[used], minlength=slices * n_roi).reshape(slices, n_roi)
+    else:
+        image = np.zeros(len(labels))
+        ranges = _pixel_ranges(len(labels), max(1, workers))
+
+        def accumulate(pixels, block):
+            image[pixels] += block[:, pixels].sum(axis=0, dtype=np.float64)
+
+        current = 0  # time slice of the image
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            for (selection,), block in PrefetchSource(frames).iter_blocks(max_bytes):
+                block = np.asarray(block).reshape(len(block), -1)
+                start = selection.start
+                while start < selection.stop:
+                    stop = min(selection.stop, edges[current + 1])
+                    part = block[start - selection.start:stop - selection.start]
+                    list(pool.map(accumulate, ranges, [part] * len(ranges)))
+                    start = stop
+                    if stop == edges[current + 1]:
+                        sums[current] = np.bincount(labels, weights=image, minlength=n_roi + 1)[1:]
+                        image[:] = 0
+                        current += 1
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        I_partial = sums / (npix * np.diff(edges)[:, np.newaxis])
+        I = sums.sum(axis=0) / (npix * n_frames)
+    logger.debug("reduced %d frames onto %d static ROIs in %d slices", n_frames, n_roi, slices)
+    return dict(I=I,
+                I_units="a.u.",
+                Q=static_q_list,
+                Q_units=None if static_q_list is None else "1/angstrom",
+                I_partial=I_partial,
+                I_partial_units="a.u.")
+
+
+def write_saxs_1d(creator, frames, static_roi_map, static_q_list=None, **options):
+    """
+    Reduce the frames and write the SAXS_1D group of the NeXus file.
+
+    :param creator: NXCreator with an entry group
+    :param frames: frames with shape (n, rows, columns), see :func:`saxs_1d`
+    :param static_roi_map: static ROI label of every pixel (1 .. n), 0 for pixels not used
+    :param static_q_list: q value of every static ROI
+    :param options: keyword arguments of :func:`saxs_1d`
+    """
+    results = saxs_1d(frames, static_roi_map, static_q_list, **options)
+    creator.create_saxs_1d_group(**results)
+    return results
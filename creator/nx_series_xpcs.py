@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Series files: many scans as the entries ``entry_1`` ... ``entry_N`` of one NeXus file.
+
+Scans of one series usually share the instrument setup and the masks and q
+maps, the largest metadata of a result.  With
+``NXCreator(..., share_identical=True)`` the groups :data:`SHARED_GROUPS` of
+an entry are written only once per distinct content: the digest of the
+arguments that fill such a group (:func:`content_digest`) is stored in its
+``content_digest`` attribute, and a later entry with the same digest gets a
+hard link to that group instead of a copy::
+
+    /entry_1/instrument                 NXinstrument, content_digest="3f2a..."
+    /entry_2/instrument  -> (hard link to the same group)
+
+The ``target`` attributes of the shared fields keep the path they were
+written at, as for any NeXus link.  The digests are read back from the file
+(:func:`shared_groups`), so scans appended in a later session are linked to
+the groups of the earlier ones.
+"""
+import hashlib
+import logging
+import re
+
+import numpy as np
+
+from creator.nx_stream_xpcs import DEFAULT_BLOCK_BYTES, iter_blocks
+
+logger = logging.getLogger(__name__)
+
+DIGEST_ATTR = "content_digest"
+# groups shared between the entries of a series, relative to the entry
+SHARED_GROUPS = ("instrument", "XPCS/instrument/masks")
+ENTRY_PATTERN = re.compile(r"entry_(\d+)$")
+
+
+def update_digest(digest, value, max_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Feed dtype, shape and data of one value into a hashlib digest, block by block
+
+    :param digest: hashlib object
+    :param value: array, dataset, lazy field, number, string or None
+    :param max_bytes: upper limit for the size of one block
+    """
+    if value is None:
+        digest.update(b"None\0")
+        return
+    if not hasattr(value, "dtype"):
+        value = np.asarray(value)
+    digest.update(f"{np.dtype(value.dtype).str}{tuple(value.shape)}\0".encode())
+    for _, block in iter_blocks(value, max_bytes):
+        block = np.asarray(block)
+        if block.dtype.kind == "O":
+            # variable-length strings of an input file
+            digest.update(repr(block.tolist()).encode())
+        else:
+            digest.update(np.ascontiguousarray(block).tobytes())
+
+
+def content_digest(values, max_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Digest of the values that fill a group
+
+    Arrays, datasets and lazy loader fields are hashed block by block (with
+    dtype and shape), so memory is bounded by ``max_bytes``.
+
+    :param values: dict name -> value (array, dataset, lazy field, number, string or None)
+    :param max_bytes: upper limit for the size of one block
+    :return *str*: hex digest
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    for name in sorted(values):
+        digest.update(f"{name}\0".encode())
+        update_digest(digest, values[name], max_bytes)
+    return digest.hexdigest()
+
+
+def shared_groups(file):
+    """
+    Shared groups already in a file
+
+    :param file: open ``h5py.File``
+    :return *dict*: content digest -> HDF5 path of the group holding that content
+    """
+    index = {}
+    for entry in file.values():
+        for path in SHARED_GROUPS:
+            group = entry.get(path) if hasattr(entry, "get") else None
+            if group is None or DIGEST_ATTR not in group.attrs:
+                continue
+            digest = group.attrs[DIGEST_ATTR]
+            index.setdefault(digest.decode() if isinstance(digest, bytes) else str(digest), group.name)
+    return index
+
+
+def next_entry_index(file):
+    """
+    Index of the next entry of a series
+
+    :param file: open ``h5py.File``
+    :return *int*: 1 + the largest N of the ``entry_N`` groups, 1 if there is none
+    """
+    indices = [int(match.group(1)) for match in map(ENTRY_PATTERN.match, file) if match]
+    return max(indices, default=0) + 1
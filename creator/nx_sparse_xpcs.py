@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+Sparse photon-event frames for low-count (photon counting) detectors.
+
+Most pixels of a frame of a photon counting detector are 0.  The events of a
+frame stack are stored in CSR layout in one HDF5 group:
+
+* ``frame_ptr`` (frames + 1): the events of frame ``i`` are ``frame_ptr[i]:frame_ptr[i + 1]``
+* ``pixel_index`` (events): flat index of the pixel (row * columns + column)
+* ``count`` (events): photons of the event
+
+The group attribute ``frame_shape`` holds (rows, columns).
+:class:`SparseFrames` reads the events block by block.  The frame based
+stages use the events directly: :meth:`SparseFrames.pixel_sum` and
+:meth:`SparseFrames.frame_totals` (frame sum), :meth:`SparseFrames.roi_sums`
+(SAXS) and :func:`creator.nx_multitau_xpcs.multi_tau` (correlator).  Other
+consumers can slice it like a dense ``(frames, rows, columns)`` stack, which
+densifies only the selected frames.
+"""
+import logging
+
+import numpy as np
+
+from creator.nx_stream_xpcs import DEFAULT_BLOCK_BYTES, rows_per_block
+
+logger = logging.getLogger(__name__)
+
+EVENT_BYTES = 8 + 4  # pixel_index and count of one event, for the block budget
+
+
+class SparseFrames:
+    """
+    Frame stack stored as photon events (CSR layout), see the module documentation.
+
+    :param group: ``h5py.Group`` with ``frame_ptr``, ``pixel_index`` and ``count``
+    :param units: units of the counts
+    """
+
+    source = None  # never copied as a dataset
+
+    def __init__(self, group, units="counts"):
+        self.group = group
+        self.frame_ptr = group["frame_ptr"][()]
+        self._pixel_index = group["pixel_index"]
+        self._count = group["count"]
+        self.frame_shape = tuple(int(n) for n in group.attrs["frame_shape"])
+        self.shape = (len(self.frame_ptr) - 1,) + self.frame_shape
+        self.dtype = np.dtype(self._count.dtype)
+        self.units = units
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        """size of the dense stack"""
+        return int(np.prod(self.shape, dtype=np.int64)) * self.dtype.itemsize
+
+    @property
+    def nnz(self):
+        """number of events"""
+        return int(self.frame_ptr[-1])
+
+    @property
+    def n_pixels(self):
+        return int(np.prod(self.frame_shape))
+
+    def events(self, start, stop):
+        """
+        Events of frames ``start:stop``
+
+        :return *tuple*: ``(frame_ptr, pixel_index, count)``, ``frame_ptr`` relative to the block
+        """
+        first, last = self.frame_ptr[start], self.frame_ptr[stop]
+        return (self.frame_ptr[start:stop + 1] - first,
+                self._pixel_index[first:last],
+                self._count[first:last])
+
+    def iter_events(self, max_bytes=DEFAULT_BLOCK_BYTES):
+        """
+        Yield ``(start, stop, frame_ptr, pixel_index, count)`` for blocks of frames
+
+        A block holds at least one frame and at most ``max_bytes`` of events otherwise.
+
+        :param max_bytes: upper limit for the events read at once
+        """
+        frames = len(self)
+        start = 0
+        while start < frames:
+            limit = self.frame_ptr[start] + max(1, max_bytes // EVENT_BYTES)
+            stop = int(np.searchsorted(self.frame_ptr, limit, side="right")) - 1
+            stop = min(max(stop, start + 1), frames)
+            yield (start, stop) + self.events(start, stop)
+            start = stop
+
+    def dense(self, start, stop):
+        """frames ``start:stop`` as a dense array"""
+        ptr, pixel_index, count = self.events(start, stop)
+        block = np.zeros((stop - start, self.n_pixels), dtype=self.dtype)
+        frame = np.repeat(np.arange(stop - start), np.diff(ptr))
+        np.add.at(block, (frame, pixel_index), count)
+        return block.reshape((stop - start,) + self.frame_shape)
+
+    def __getitem__(self, selection):
+        """Dense frames, e.g. ``frames[10:20]`` or ``frames[3, 100:200]``."""
+        if not isinstance(selection, tuple):
+            selection = (selection,)
+        first = selection[0]
+        if isinstance(first, (int, np.integer)):
+            index = int(first) + len(self) if first < 0 else int(first)
+            return self.dense(index, index + 1)[0][selection[1:]]
+        if isinstance(first, slice) and first.step in (None, 1):
+            start, stop, _ = first.indices(len(self))
+            return self.dense(start, max(start, stop))[(slice(None),) + selection[1:]]
+        return self.read()[selection]
+
+    def iter_blocks(self, max_bytes=DEFAULT_BLOCK_BYTES):
+        """Yield dense ``(selection, block)`` pairs, for consumers of dense stacks."""
+        rows = rows_per_block(self.frame_shape, self.dtype, max_bytes)
+        for start in range(0, len(self), rows):
+            stop = min(start + rows, len(self))
+            yield (slice(start, stop),), self.dense(start, stop)
+
+    def read(self):
+        """The complete dense stack (only for small data)."""
+        return self.dense(0, len(self))
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.read()
+        return data if dtype is None else data.astype(dtype)
+
+    def pixel_sum(self, max_bytes=DEFAULT_BLOCK_BYTES):
+        """sum of all frames (``frame_sum``), float64 with the frame shape"""
+        total = np.zeros(self.n_pixels)
+        for _, _, _, pixel_index, count in self.iter_events(max_bytes):
+            total += np.bincount(pixel_index, weights=count, minlength=self.n_pixels)
+        return total.reshape(self.frame_shape)
+
+    def frame_totals(self):
+        """total counts of every frame"""
+        totals = np.empty(len(self))
+        for start, stop, ptr, _, count in self.iter_events():
+            cumulative = np.concatenate([[0], np.cumsum(count, dtype=np.float64)])
+            totals[start:stop] = cumulative[ptr[1:]] - cumulative[ptr[:-1]]
+        return totals
+
+    def roi_sums(self, roi_map, n_roi=None, max_bytes=DEFAULT_BLOCK_BYTES):
+        """
+        Counts of every ROI in every frame, e.g. for SAXS over the ``static_roi_map``
+
+        :param roi_map: label of every pixel (1 .. n_roi), 0 for pixels not used
+        :param n_roi: number of ROIs, default: the largest label
+        :return *ndarray*: shape (frames, n_roi)
+        """
+        labels = np.asarray(roi_map).ravel()
+        n_roi = int(labels.max()) if n_roi is None else n_roi
+        sums = np.zeros((len(self), n_roi))
+        for start, stop, ptr, pixel_index, count in self.iter_events(max_bytes):
+            frame = np.repeat(np.arange(stop - start), np.diff(ptr))
+            label = labels[pixel_index]
+            used = label > 0
+            index = frame[used] * n_roi + label[used] - 1
+            sums[start:stop] = np.bincount(index, weights=count[used],
+                                           minlength=(stop - start) * n_roi).reshape(-1, n_roi)
+        return sums
+
+
+def _check_counts(counts, dtype):
+    """
+    Raise ValueError unless ``counts`` fit into ``dtype`` unchanged
+
+    HDF5 saturates on the conversion, e.g. 70000 is stored as 65535 in uint16.
+    Negative values (e.g. bad pixel flags) are never photon counts.
+    """
+    if counts.size == 0:
+        return
+    low, high = counts.min(), counts.max()
+    if low < 0:
+        raise ValueError(f"negative count {low}, mask flagged pixels before converting to events")
+    if dtype == counts.dtype:
+        return
+    if dtype.kind in "iu":
+        if counts.dtype.kind == "f" and not np.all(np.mod(counts, 1) == 0):
+            raise ValueError(f"non-integer counts cannot be stored as {dtype}")
+        limit = np.iinfo(dtype).max
+    else:
+        limit = np.finfo(dtype).max
+    if high > limit:
+        raise ValueError(f"count {high} does not fit into {dtype} (at most {limit})")
+
+
+def write_sparse(group, frames, max_bytes=DEFAULT_BLOCK_BYTES, count_dtype=None, compression="gzip"):
+    """
+    Convert a dense frame stack into photon events.
+
+    :param group: ``h5py.Group`` to write ``frame_ptr``, ``pixel_index`` and ``count`` into
+    :param frames: dense stack with shape (frames, rows, columns), dataset or array
+    :param max_bytes: upper limit for the dense frames read at once
+    :param count_dtype: dtype of the counts, default: the dtype of ``frames``; every block
+                        is checked to fit into it (ValueError otherwise, also for negative counts)
+    :param compression: compression of the event datasets
+    :return *SparseFrames*:
+    """
+    count_dtype = np.dtype(frames.dtype if count_dtype is None else count_dtype)
+    n_frames, frame_shape = frames.shape[0], tuple(frames.shape[1:])
+    chunk = 1024 ** 2 // EVENT_BYTES
+    index_dtype = np.int32 if np.prod(frame_shape) < 2 ** 31 else np.int64
+    options = dict(maxshape=(None,), chunks=(chunk,), compression=compression, shuffle=compression is not None)
+    pixel_index = group.create_dataset("pixel_index", shape=(0,), dtype=index_dtype, **options)
+    count = group.create_dataset("count", shape=(0,), dtype=count_dtype, **options)
+    frame_ptr = np.zeros(n_frames + 1, dtype=np.int64)
+    rows = rows_per_block(frame_shape, frames.dtype, max_bytes)
+    for start in range(0, n_frames, rows):
+        stop = min(start + rows, n_frames)
+        block = np.asarray(frames[start:stop]).reshape(stop - start, -1)
+        frame, pixel = np.nonzero(block)
+        frame_ptr[start + 1:stop + 1] = frame_ptr[start] + np.cumsum(np.bincount(frame, minlength=stop - start))
+        counts = block[frame, pixel]
+        _check_counts(counts, count_dtype)
+        n, new = len(pixel_index), len(pixel)
+        if new:
+            pixel_index.resize((n + new,))
+            count.resize((n + new,))
+            pixel_index[n:] = pixel
+            count[n:] = counts
+    group.create_dataset("frame_ptr", data=frame_ptr)
+    group.attrs["frame_shape"] = frame_shape
+    logger.debug("%d frames with %d events written to %s", n_frames, frame_ptr[-1], group.name)
+    return SparseFrames(group)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Stream large arrays into the NeXus file block by block.
+
+Loaders hand large results (e.g. the two-time correlation stack) to the
+:class:`~creator.nx_creator_xpcs.NXCreator` as *sources* instead of arrays.
+The creator pre-allocates the target dataset from ``shape`` and ``dtype`` and
+then copies one block at a time, so peak memory is bounded by the block budget
+and not by the size of the result.
+"""
+import logging
+
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_BYTES = 256 * 1024 ** 2  # memory budget for one block
+
+
+def rows_per_block(row_shape, dtype, max_bytes):
+    """Number of rows (along the first axis) that fit into ``max_bytes``, at least one."""
+    row_nbytes = int(np.prod(row_shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+    return max(1, max_bytes // max(row_nbytes, 1))
+
+
+class StackedSource:
+    """
+    Lazy stack of equally shaped datasets along a new first axis.
+
+    APS result files store the two-time correlation function as one dataset
+    per q-bin (``exchange/C2T_all/<key>``).  The stack has the shape
+    ``(q, frames, frames)`` but is never held in memory: :meth:`iter_blocks`
+    reads one q-bin, or one tile of rows of a q-bin, at a time.
+
+    :param datasets: datasets (or arrays) of the same shape
+    :param units: units of the stacked data
+    """
+
+    source = None  # no single dataset to copy from
+
+    def __init__(self, datasets, units=None):
+        self._datasets = list(datasets)
+        self.units = units
+        if len(self._datasets) == 0:
+            raise ValueError("StackedSource needs at least one dataset")
+        first = self._datasets[0]
+        for ds in self._datasets[1:]:
+            if ds.shape != first.shape:
+                raise ValueError(f"cannot stack datasets of shape {ds.shape} and {first.shape}")
+        self.shape = (len(self._datasets),) + tuple(first.shape)
+        self.dtype = np.dtype(first.dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def datasets(self):
+        """the stacked datasets, in stacking order"""
+        return tuple(self._datasets)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape, dtype=np.int64)) * self.dtype.itemsize
+
+    def iter_blocks(self, max_bytes=DEFAULT_BLOCK_BYTES):
+        """
+        Yield ``(selection, block)`` pairs covering the whole stack.
+
+        :param max_bytes: upper limit for the size of one block
+        """
+        for index, ds in enumerate(self._datasets):
+            if ds.ndim == 0:
+                yield (index,), np.asarray(ds[()])
+                continue
+            rows = rows_per_block(ds.shape[1:], self.dtype, max_bytes)
+            for start in range(0, ds.shape[0], rows):
+                stop = min(start + rows, ds.shape[0])
+                yield (index, slice(start, stop)), ds[start:stop]
+
+    def __getitem__(self, selection):
+        """Read a selection whose first index is one q-bin, e.g. ``stack[q, start:stop]``."""
+        if not isinstance(selection, tuple):
+            selection = (selection,)
+        if isinstance(selection[0], (int, np.integer)):
+            return self._datasets[selection[0]][selection[1:] or ()]
+        return self.read()[selection]
+
+    def read(self):
+        """Materialize the complete stack (only for small data)."""
+        data = np.empty(self.shape, dtype=self.dtype)
+        for selection, block in self.iter_blocks():
+            data[selection] = block
+        return data
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.read()
+        return data if dtype is None else data.astype(dtype)
+
+
+def iter_blocks(value, max_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Yield ``(selection, block)`` pairs for a source or an ``h5py.Dataset``.
+
+    :param value: object with an ``iter_blocks`` method or a dataset sliced along its first axis
+    :param max_bytes: upper limit for the size of one block
+    """
+    if hasattr(value, "iter_blocks"):
+        yield from value.iter_blocks(max_bytes)
+        return
+    if value.ndim == 0:
+        yield (), value[()]
+        return
+    rows = rows_per_block(value.shape[1:], value.dtype, max_bytes)
+    for start in range(0, value.shape[0], rows):
+        stop = min(start + rows, value.shape[0])
+        yield (slice(start, stop),), value[start:stop]
+
+
+def is_streamable(value, max_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    `True` if ``value`` should be written block by block.
+
+    Sources and datasets of an input file are streamed if they do not fit into
+    one block.
+    """
+    if hasattr(value, "iter_blocks") or isinstance(value, h5py.Dataset):
+        return len(value.shape) > 0 and value.nbytes > max_bytes
+    return False
+
+
+def write_streamed(group, name, value, max_bytes=DEFAULT_BLOCK_BYTES, **kwargs):
+    """
+    Pre-allocate dataset ``name`` in ``group`` and copy ``value`` into it block by block.
+
+    :param group: h5parent
+    :param name: name of the dataset
+    :param value: source (see :func:`iter_blocks`)
+    :param max_bytes: upper limit for the size of one block
+    :param kwargs: additional keyword arguments for ``create_dataset``
+    """
+    if "chunks" not in kwargs and getattr(value, "chunks", None):
+        # sources written tile by tile suggest their tiles as chunks
+        kwargs["chunks"] = value.chunks
+    ds = group.create_dataset(name, shape=value.shape, dtype=value.dtype, **kwargs)
+    for selection, block in iter_blocks(value, max_bytes):
+        ds[selection] = block
+    logger.debug("streamed %s with shape %s", ds.name, ds.shape)
+    return ds
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""
+Named spans with wall time, I/O bytes and peak RSS of a conversion.
+
+The loader methods (see :class:`loader.nx_loader_base.NXLoader`), the
+``create_*`` methods of the :class:`~creator.nx_creator_xpcs.NXCreator`, its
+unit checks and dataset writes run in spans.  Tracing is off by default; then
+a span is one attribute lookup.  Switched on, every span records::
+
+    {"span": "NXCreator.create_xpcs_group", "parent": null, "depth": 0,
+     "labels": {}, "start": 1625140800.0, "seconds": 0.12,
+     "bytes_read": 1048576, "bytes_written": 2097152, "peak_rss_bytes": 73400320}
+
+Bytes and peak RSS are those of the whole process (``/proc/self/io`` and
+``VmHWM`` of ``/proc/self/status``, Linux only, else None): the peak is reset
+when a span starts, after handing the peak so far to the enclosing span; a
+span reports the largest peak of itself and its children.  Spans of
+concurrent threads (e.g. the pipelined reader) see each other's I/O and
+memory.
+
+The records are exported as JSON lines (:func:`write_jsonl`) and as a
+Prometheus textfile for the node exporter's textfile collector
+(:func:`write_prometheus`), with the totals per span name and labels::
+
+    with tracing(jsonl="conversion.jsonl", prometheus="/var/lib/node_exporter/nxxpcs.prom"):
+        convert_file(...)
+"""
+import contextlib
+import functools
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "nxxpcs_span"
+
+
+def io_counters():
+    """bytes passed to read() and write() by this process (Linux), else None"""
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def reset_peak_rss():
+    """reset the peak RSS of this process (Linux), `False` if not supported"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_bytes():
+    """peak RSS since the last reset (Linux) or since the start of the process"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class _Span:
+    """one running span"""
+
+    def __init__(self, tracer, name, labels):
+        self.tracer = tracer
+        self.name = name
+        self.labels = labels
+        self.children_peak = 0
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        if self.parent is not None:
+            # the reset below drops the peak the parent reached so far
+            self.parent.children_peak = max(self.parent.children_peak, peak_rss_bytes())
+        reset_peak_rss()
+        self.io = io_counters()
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.t0
+        io = io_counters()
+        peak = max(peak_rss_bytes(), self.children_peak)
+        self.tracer._stack().pop()
+        if self.parent is not None:
+            self.parent.children_peak = max(self.parent.children_peak, peak)
+        record = dict(span=self.name,
+                      parent=None if self.parent is None else self.parent.name,
+                      depth=0 if self.parent is None else len(self.tracer._stack()),
+                      labels=self.labels,
+                      start=self.start,
+                      seconds=seconds,
+                      bytes_read=None if io is None or self.io is None else io[0] - self.io[0],
+                      bytes_written=None if io is None or self.io is None else io[1] - self.io[1],
+                      peak_rss_bytes=peak)
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        self.tracer.records.append(record)
+        return False
+
+
+class Tracer:
+    """
+    Collects the records of the spans, see the module documentation.
+
+    :param enabled: record spans
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.records = []
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def span(self, name, **labels):
+        """context manager of the span ``name``, a no-op when tracing is off"""
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name, labels)
+
+    def clear(self):
+        self.records = []
+
+
+_NO_SPAN = contextlib.nullcontext()
+TRACER = Tracer(enabled=bool(os.environ.get("NXXPCS_TRACE")))
+
+
+def span(name, **labels):
+    """
+    Context manager recording the span ``name`` with the global tracer
+
+    :param name: name of the span, e.g. ``"NXCreator.create_xpcs_group"``
+    :param labels: labels of the span (Prometheus labels), e.g. ``field="g2"``
+    """
+    if not TRACER.enabled:
+        return _NO_SPAN
+    return _Span(TRACER, name, labels)
+
+
+def traced(name=None):
+    """
+    Decorator running the function in a span
+
+    :param name: name of the span, default: qualified name of the function
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return func(*args, **kwargs)
+            with _Span(TRACER, span_name, {}):
+                return func(*args, **kwargs)
+
+        wrapper.__traced__ = True
+        return wrapper
+    return decorator
+
+
+def enable(clear=True):
+    """switch tracing on (and forget the previous records)"""
+    if clear:
+        TRACER.clear()
+    TRACER.enabled = True
+
+
+def disable():
+    TRACER.enabled = False
+
+
+def records():
+    """the records of the global tracer"""
+    return list(TRACER.records)
+
+
+def write_jsonl(filename, records_=None, append=True):
+    """
+    Write the records as JSON lines
+
+    :param filename: output file
+    :param records_: records to write, default: those of the global tracer
+    :param append: append to an existing file
+    """
+    records_ = TRACER.records if records_ is None else records_
+    with open(filename, "a" if append else "w") as f:
+        for record in records_:
+            f.write(json.dumps(record) + "\n")
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+def prometheus_text(records_=None):
+    """
+    The totals per span (name and labels) in the Prometheus text format
+
+    :param records_: records, default: those of the global tracer
+    """
+    records_ = TRACER.records if records_ is None else records_
+    totals = {}
+    for record in records_:
+        labels = dict(span=record["span"], **record["labels"])
+        key = tuple(sorted(labels.items()))
+        total = totals.setdefault(key, dict(calls=0, seconds=0.0, bytes_read=0, bytes_written=0,
+                                            peak_rss_bytes=0))
+        total["calls"] += 1
+        total["seconds"] += record["seconds"]
+        total["bytes_read"] += record["bytes_read"] or 0
+        total["bytes_written"] += record["bytes_written"] or 0
+        total["peak_rss_bytes"] = max(total["peak_rss_bytes"], record["peak_rss_bytes"] or 0)
+
+    metrics = (("calls", "counter", "number of calls"),
+               ("seconds", "counter", "wall time in seconds"),
+               ("bytes_read", "counter", "bytes read by the process"),
+               ("bytes_written", "counter", "bytes written by the process"),
+               ("peak_rss_bytes", "gauge", "largest peak resident set size in bytes"))
+    lines = []
+    for metric, kind, text in metrics:
+        suffix = "_total" if kind == "counter" else ""
+        full_name = f"{METRIC_PREFIX}_{metric}{suffix}"
+        lines.append(f"# HELP {full_name} {text} per NXxpcs conversion span")
+        lines.append(f"# TYPE {full_name} {kind}")
+        for key, total in totals.items():
+            lines.append(f"{full_name}{_label_text(dict(key))} {total[metric]}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(filename, records_=None):
+    """
+    Write the Prometheus textfile atomically (the collector never reads a partial file)
+
+    :param filename: output file, should end with ``.prom`` for the textfile collector
+    :param records_: records, default: those of the global tracer
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".nxxpcs_", suffix=".prom.tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(prometheus_text(records_))
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+@contextlib.contextmanager
+def tracing(jsonl=None, prometheus=None):
+    """
+    Trace the body and export its records
+
+    :param jsonl: append the records to this JSON lines file
+    :param prometheus: write the Prometheus textfile
+    """
+    was_enabled = TRACER.enabled
+    enable()
+    try:
+        yield TRACER
+    finally:
+        TRACER.enabled = was_enabled
+        if jsonl is not None:
+            write_jsonl(jsonl)
+        if prometheus is not None:
+            write_prometheus(prometheus)
+        logger.debug("%d spans recorded", len(TRACER.records))
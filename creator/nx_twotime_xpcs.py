@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+"""
+Half-matrix storage of the two-time correlation function.
+
+``two_time_corr_func`` is symmetric, so NXxpcs allows to populate only the
+upper or lower half of each ``frames x frames`` matrix (``populated_elements``).
+Two storage modes write one half only:
+
+* ``packed``: the half of each q-bin is stored row by row as one packed 1-D
+  array, the dataset has the shape ``(q, frames * (frames + 1) / 2)``
+  (``storage_mode="other"``, ``packing="triangular_rows"``)
+* ``tiles``: the dataset keeps the shape ``(q, frames, frames)`` but is chunked
+  in square tiles and only the tiles of one half are written; HDF5 does not
+  allocate the skipped chunks (``storage_mode="one_array_q_first"``)
+
+Both are written one tile of rows at a time.  :class:`TwoTimeReader` returns
+the full symmetric matrix of one q-bin on demand for every storage mode.
+
+:func:`g2_from_two_time` derives ``g2_from_two_time_corr_func`` (the mean of
+every diagonal ``C(t, t + tau)``) and its age-resolved partials from the
+upper half, one q-slice and one block of rows at a time.
+"""
+import logging
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from creator.nx_stream_xpcs import DEFAULT_BLOCK_BYTES, rows_per_block
+
+logger = logging.getLogger(__name__)
+
+TWO_TIME_STORAGE = ("full", "packed", "tiles")
+TWO_TIME_HALF = ("upper", "lower")
+TIME_ORIGIN_LOCATION = "upper_left"  # row 0, column 0 is the first frame
+DEFAULT_TILE = 256
+DEFAULT_PARTIALS = 4  # age windows of g2_from_two_time_corr_func_partials
+
+
+def packed_size(frames):
+    """number of elements of one packed half of a ``frames x frames`` matrix"""
+    return frames * (frames + 1) // 2
+
+
+def _row_offset(row, frames, half):
+    """start of ``row`` in the packed array"""
+    if half == "upper":
+        return row * frames - row * (row - 1) // 2
+    return row * (row + 1) // 2
+
+
+def _row_span(row, frames, half):
+    """columns of ``row`` that belong to the populated half"""
+    return (row, frames) if half == "upper" else (0, row + 1)
+
+
+def pack_rows(rows, first_row, frames, half="upper"):
+    """
+    Pack a tile of full matrix rows into its (contiguous) part of the packed array.
+
+    :param rows: array with shape (n_rows, frames)
+    :param first_row: index of the first row of the tile
+    :param frames: number of frames (matrix size)
+    :param half: "upper" or "lower"
+    """
+    parts = []
+    for i, row in enumerate(rows):
+        start, stop = _row_span(first_row + i, frames, half)
+        parts.append(row[start:stop])
+    return np.concatenate(parts)
+
+
+def unpack(packed, frames, half="upper"):
+    """
+    Full symmetric ``frames x frames`` matrix from one packed half.
+
+    :param packed: 1-D packed array of one q-bin
+    :param frames: number of frames (matrix size)
+    :param half: "upper" or "lower"
+    """
+    matrix = np.empty((frames, frames), dtype=packed.dtype)
+    for row in range(frames):
+        offset = _row_offset(row, frames, half)
+        start, stop = _row_span(row, frames, half)
+        values = packed[offset:offset + stop - start]
+        matrix[row, start:stop] = values
+        matrix[start:stop, row] = values
+    return matrix
+
+
+def _read_rows(value, q, start, stop):
+    """rows ``start:stop`` of q-bin ``q`` of an array, dataset or lazy source"""
+    if value.ndim == 2:
+        return np.asarray(value[start:stop])
+    return np.asarray(value[q, start:stop])
+
+
+def write_two_time(group, name, value, storage="packed", half="upper",
+                   max_bytes=DEFAULT_BLOCK_BYTES, tile=DEFAULT_TILE, **kwargs):
+    """
+    Write one half of the two-time correlation function.
+
+    :param group: h5parent
+    :param name: name of the dataset
+    :param value: array, dataset or source with the shape (q, frames, frames) or (frames, frames)
+    :param storage: "packed" or "tiles"
+    :param half: "upper" or "lower"
+    :param max_bytes: upper limit for the rows read at once (packed storage)
+    :param tile: edge length of the square chunks (tiles storage)
+    :param kwargs: additional attributes for the dataset
+    """
+    if storage not in ("packed", "tiles"):
+        raise ValueError(f"unknown two-time storage '{storage}', use 'packed' or 'tiles'")
+    if half not in TWO_TIME_HALF:
+        raise ValueError(f"unknown half '{half}', use one of {TWO_TIME_HALF}")
+    shape = tuple(value.shape)
+    if shape[-1] != shape[-2]:
+        raise ValueError(f"two-time matrices must be square, got shape {shape}")
+    n_q = 1 if len(shape) == 2 else shape[0]
+    frames = shape[-1]
+
+    if storage == "packed":
+        ds = group.create_dataset(name, shape=(n_q, packed_size(frames)), dtype=value.dtype)
+        rows = rows_per_block((frames,), value.dtype, max_bytes)
+        ds.attrs["storage_mode"] = "other"
+        ds.attrs["packing"] = "triangular_rows"
+    else:
+        # computed sources (see creator.nx_c2t_xpcs) bring their own tile size
+        edge = min(getattr(value, "tile", tile), frames)
+        ds = group.create_dataset(name, shape=(n_q, frames, frames), dtype=value.dtype,
+                                  chunks=(1, edge, edge), fillvalue=0)
+        rows = edge
+        ds.attrs["storage_mode"] = "one_array_q_first"
+
+    if storage == "tiles" and hasattr(value, "iter_half_blocks"):
+        # computed sources yield the tiles of the populated half directly
+        for selection, block in value.iter_half_blocks(half, max_bytes):
+            ds[selection] = block
+    elif storage == "packed" and hasattr(value, "iter_row_blocks"):
+        # computed sources yield the rows of all q-bins from one pass over the frames
+        for block_rows, block in value.iter_row_blocks(half):
+            start, stop = block_rows.start, block_rows.stop
+            for q in range(n_q):
+                ds[q, _row_offset(start, frames, half):_row_offset(stop, frames, half)] = \
+                    pack_rows(block[q], start, frames, half)
+    else:
+        for q in range(n_q):
+            for start in range(0, frames, rows):
+                stop = min(start + rows, frames)
+                block = _read_rows(value, q, start, stop)
+                if storage == "packed":
+                    ds[q, _row_offset(start, frames, half):_row_offset(stop, frames, half)] = \
+                        pack_rows(block, start, frames, half)
+                elif half == "upper":
+                    # columns left of the diagonal tile are never written
+                    ds[q, start:stop, start:] = block[:, start:]
+                else:
+                    ds[q, start:stop, :stop] = block[:, :stop]
+
+    ds.attrs["frames"] = frames
+    ds.attrs["populated_elements"] = f"{half}_half"
+    ds.attrs["time_origin_location"] = TIME_ORIGIN_LOCATION
+    for k, v in kwargs.items():
+        if v is not None:
+            ds.attrs[k] = v
+    logger.debug("wrote %s half of %s as %s", half, ds.name, storage)
+    return ds
+
+
+class TwoTimeReader:
+    """
+    Read the full symmetric two-time matrix of one q-bin on demand.
+
+    Works for packed, tiled and full storage::
+
+        reader = TwoTimeReader(nx["/entry/XPCS/twotime/two_time_corr_func"])
+        c2t = reader[3]     # frames x frames matrix of the fourth q-bin
+
+    :param dataset: the ``two_time_corr_func`` dataset
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.populated_elements = _attr_str(dataset, "populated_elements", "all")
+        self.packed = _attr_str(dataset, "packing", None) is not None
+        self.frames = int(dataset.attrs["frames"]) if "frames" in dataset.attrs else dataset.shape[-1]
+
+    def __len__(self):
+        return 1 if self.dataset.ndim == 2 and not self.packed else self.dataset.shape[0]
+
+    def __getitem__(self, q):
+        half = self.populated_elements.split("_")[0]
+        if self.packed:
+            return unpack(self.dataset[q], self.frames, half)
+        matrix = self.dataset[()] if self.dataset.ndim == 2 else self.dataset[q]
+        if half == "upper":
+            return np.triu(matrix) + np.triu(matrix, 1).T
+        if half == "lower":
+            return np.tril(matrix) + np.tril(matrix, -1).T
+        return matrix
+
+
+def _attr_str(dataset, name, default):
+    if not hasattr(dataset, "attrs"):
+        return default
+    value = dataset.attrs.get(name, default)
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _diagonals(rows, first_row, frames):
+    """
+    Strided view ``D[i, tau] = C(first_row + i, first_row + i + tau)`` of a block of rows.
+
+    The rows are copied once into a zero padded buffer, so elements beyond the
+    last column are 0.
+    """
+    n = len(rows)
+    padded = np.zeros((n, 2 * frames))
+    padded[:, :frames] = rows
+    row_stride, column_stride = padded.strides
+    return as_strided(padded[:, first_row:], shape=(n, frames),
+                      strides=(row_stride + column_stride, column_stride), writeable=False)
+
+
+def _upper_rows(value, q, start, stop, frames, packed, half, rows):
+    """
+    Rows ``start:stop`` of the upper half of q-bin ``q``, for every storage mode.
+
+    Only the columns from the diagonal on are filled.  A lower half is read
+    column-wise (packed: ``rows`` rows at a time), so the memory stays that of
+    one block of rows.
+    """
+    if not packed and half != "lower":
+        return _read_rows(value, q, start, stop)
+    block = np.zeros((stop - start, frames))
+    if not packed:
+        # the rows of the upper half are the columns of the lower half
+        block[:, start:] = (value[start:, start:stop] if value.ndim == 2 else value[q, start:, start:stop]).T
+    elif half == "upper":
+        packed_rows = value[q, _row_offset(start, frames, half):_row_offset(stop, frames, half)]
+        for row in range(start, stop):
+            offset = _row_offset(row, frames, half) - _row_offset(start, frames, half)
+            block[row - start, row:] = packed_rows[offset:offset + frames - row]
+    else:
+        for first in range(start, frames, rows):
+            last = min(first + rows, frames)
+            packed_rows = value[q, _row_offset(first, frames, half):_row_offset(last, frames, half)]
+            for row in range(first, last):
+                offset = _row_offset(row, frames, half) - _row_offset(first, frames, half)
+                high = min(stop, row + 1)
+                block[:high - start, row] = packed_rows[offset + start:offset + high]
+    return block
+
+
+def age_windows(frames, partials=DEFAULT_PARTIALS):
+    """
+    Edges of the age windows (in frames) of the partials.
+
+    :param frames: number of frames
+    :param partials: number of equal windows or the edges themselves
+    """
+    if np.ndim(partials) == 0:
+        edges = np.linspace(0, frames, int(partials) + 1).round().astype(np.int64)
+    else:
+        edges = np.asarray(partials, dtype=np.int64)
+    if edges[0] != 0 or edges[-1] != frames or np.any(np.diff(edges) <= 0):
+        raise ValueError(f"age windows must increase from 0 to {frames}, got {edges}")
+    return edges
+
+
+def g2_from_two_time(value, partials=DEFAULT_PARTIALS, max_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Diagonal means of the two-time correlation function and their age-resolved partials.
+
+    ``g2[tau, q]`` is the mean of ``C(q, t, t + tau)`` over all ``t``, ``partials[tau, q, w]``
+    the mean over the ``t`` of age window ``w``.  Only the upper half is read, one q-slice
+    and one block of rows at a time; the diagonal sums of a block come from one cumulative
+    sum over a strided view of the rows.
+
+    :param value: dataset, source or array with the shape (q, frames, frames) or (frames, frames)
+    :param partials: number of equal age windows or their edges in frames
+    :param max_bytes: upper limit for the memory of one block of rows
+    :return *tuple*: ``g2`` with shape (frames, q) and ``partials`` with shape (frames, q, windows)
+    """
+    packed = _attr_str(value, "packing", None) is not None
+    half = _attr_str(value, "populated_elements", "all").split("_")[0]
+    if packed:
+        n_q, frames = value.shape[0], int(value.attrs["frames"])
+    else:
+        shape = tuple(value.shape)
+        if len(shape) < 2 or shape[-1] != shape[-2]:
+            raise ValueError(f"two-time matrices must be square, got shape {shape}")
+        n_q = 1 if len(shape) == 2 else shape[0]
+        frames = shape[-1]
+    edges = age_windows(frames, partials)
+    n_windows = len(edges) - 1
+    tau = np.arange(frames)
+    counts = np.clip(np.minimum(edges[1:, np.newaxis], frames - tau) - edges[:-1, np.newaxis], 0, None)
+
+    g2 = np.empty((frames, n_q))
+    g2_partials = np.empty((frames, n_q, n_windows))
+    rows = rows_per_block((3 * frames,), np.float64, max_bytes)
+    for q in range(n_q):
+        total = np.zeros(frames)
+        window_sums = np.zeros((n_windows, frames))
+        for start in range(0, frames, rows):
+            stop = min(start + rows, frames)
+            block = _upper_rows(value, q, start, stop, frames, packed, half, rows)
+            cumulative = np.zeros((stop - start + 1, frames))
+            np.cumsum(_diagonals(block, start, frames), axis=0, out=cumulative[1:])
+            total += cumulative[-1]
+            for w in range(n_windows):
+                low, high = max(edges[w], start), min(edges[w + 1], stop)
+                if low < high:
+                    window_sums[w] += cumulative[high - start] - cumulative[low - start]
+        g2[:, q] = total / (frames - tau)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            g2_partials[:, q] = (window_sums / counts).T
+    return g2, g2_partials
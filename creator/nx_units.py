@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Process-wide units handling for the NeXus creator.
+
+Importing pint and creating a ``pint.UnitRegistry`` (which parses pint's
+complete definitions file) are the slowest steps of starting a conversion, so
+pint is imported with the single registry on first use, shared by all callers.
+The units of the loaders are mostly the expected ones or differ by an SI
+prefix only (keV and eV, ms and s): these are decided by :func:`prefixed_unit`
+without pint.  The result of a compatibility check is cached per
+``(supplied, expected)`` pair.
+"""
+import functools
+import threading
+
+UNITS_CACHE_SIZE = 256
+
+# decimal exponents of the SI prefixes
+SI_PREFIXES = {"": 0, "p": -12, "n": -9, "u": -6, "\u00b5": -6, "m": -3, "c": -2, "k": 3, "M": 6, "G": 9}
+# base units decided without pint, no two of the same dimension
+PREFIXED_UNITS = ("eV", "Hz", "m", "s")
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_unit_registry():
+    """Return the shared ``pint.UnitRegistry``, created on first use."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                import pint
+
+                _registry = pint.UnitRegistry()
+    return _registry
+
+
+def prefixed_unit(units):
+    """
+    Split an SI prefixed base unit of :data:`PREFIXED_UNITS`, e.g. ``"keV"`` -> ``("eV", 3)``
+
+    :param units: units string
+    :return *tuple*: base unit and decimal exponent of the prefix, None for other units
+    """
+    for base in PREFIXED_UNITS:
+        prefix = units[:-len(base)]
+        if units.endswith(base) and prefix in SI_PREFIXES:
+            return base, SI_PREFIXES[prefix]
+    return None
+
+
+@functools.lru_cache(maxsize=UNITS_CACHE_SIZE)
+def units_compatible(supplied, expected):
+    """
+    `True` if the ``supplied`` units can be converted into the ``expected`` units.
+
+    Undefined units raise ``pint.UndefinedUnitError`` (which is not cached).
+
+    :param supplied: units string that was supplied
+    :param expected: expected units
+    """
+    if supplied == expected:
+        return True
+    prefixed = prefixed_unit(supplied), prefixed_unit(expected)
+    if None not in prefixed:
+        return prefixed[0][0] == prefixed[1][0]
+    ureg = get_unit_registry()
+    import pint  # loaded with the registry
+
+    try:
+        (1.0 * ureg(supplied)).to(expected)
+        return True
+    except pint.DimensionalityError:
+        return False
+
+
+def units_cache_info():
+    """
+    Hit and miss counters of the units cache.
+
+    :return *dict*: ``hits``, ``misses``, ``maxsize`` and ``currsize``
+    """
+    return units_compatible.cache_info()._asdict()
+
+
+def clear_units_cache():
+    """Forget all cached units checks and conversion factors and reset the counters."""
+    units_compatible.cache_clear()
+    conversion_factor.cache_clear()
+
+
+@functools.lru_cache(maxsize=UNITS_CACHE_SIZE)
+def conversion_factor(supplied, expected):
+    """
+    Factor converting values in the ``supplied`` units into the ``expected`` units.
+
+    Only for multiplicative units (no offset units like degC).
+
+    :param supplied: units string that was supplied
+    :param expected: expected units
+    """
+    prefixed = prefixed_unit(supplied), prefixed_unit(expected)
+    if None not in prefixed and prefixed[0][0] == prefixed[1][0]:
+        return 10.0 ** (prefixed[0][1] - prefixed[1][1])
+    ureg = get_unit_registry()
+    return float((1.0 * ureg(supplied)).to(expected).magnitude)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+"""
+Validate a written NeXus file against the NXxpcs application definition.
+
+The NXDL files of the ``NeXus`` directory (NXxpcs and the mask definitions
+NXarraymask and NXparameterizedmask) are parsed once into an index of
+:class:`Spec` per NXDL path (kind, type, units, whether it is required and the
+enumerated values), cached until one of the files changes.
+
+:func:`validate` walks the links of the file once (``H5Lvisit``, so a group
+hard-linked into several entries of a series file is checked in each of them)
+and maps every HDF5 object to its NXDL path: groups by name, otherwise by
+``NX_class``.  Soft and external links count as present but are not opened.  The
+creator writes the XPCS results into the NXprocess group ``<entry>/XPCS``;
+the children of the groups in :data:`PROCESS_GROUPS` are matched as children
+of the entry.  Objects without a definition are ignored.  Afterwards the
+required fields and groups of every group found are checked; a missing one
+is reported at its path in the file, below the group found.
+
+Reported are missing required fields and groups, values and attributes
+outside their enumeration (e.g. ``storage_mode``, ``baseline_reference``) as
+errors, and a ``NX_class`` or dtype that does not match the definition as
+warnings.
+"""
+import collections
+import functools
+import logging
+import pathlib
+import sys
+import xml.etree.ElementTree as ET
+
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+NXDL_DIR = pathlib.Path(__file__).resolve().parent.parent / "NeXus"
+NXDL_NS = {"nx": "http://definition.nexusformat.org/nxdl/3.1"}
+APPLICATION = "NXxpcs"
+MASK_DEFINITIONS = ("NXarraymask", "NXparameterizedmask")
+PROCESS_GROUPS = ("XPCS",)  # NXprocess groups holding NXxpcs results of the entry
+
+# dtype kinds of the NXDL types, types not listed (e.g. NX_CHAR) are not checked
+NX_TYPE_KINDS = {
+    "NX_INT": "iu",
+    "NX_POSINT": "iu",
+    "NX_UINT": "u",
+    "NX_FLOAT": "f",
+    "NX_NUMBER": "iuf",
+    "NX_BOOLEAN": "bui",
+}
+
+Spec = collections.namedtuple("Spec", "kind name nx_type units required enumeration")
+Spec.__doc__ = """
+One field, group or attribute of a definition.
+
+:param kind: "field", "group" or "attribute"
+:param name: name in the HDF5 file
+:param nx_type: NXDL type (NX_CHAR, NX_INT, ...) or NX_class of a group
+:param units: units category (NX_LENGTH, ...) or None
+:param required: the parent is incomplete without it
+:param enumeration: tuple of the allowed values (as strings) or None
+"""
+
+Issue = collections.namedtuple("Issue", "severity path message")
+
+
+def _spec(element, kind, min_occurs):
+    name = element.get("name")
+    nx_type = element.get("type")
+    if kind == "field":
+        nx_type = nx_type or "NX_CHAR"
+    if kind == "group" and name is None:
+        name = nx_type[2:]  # e.g. NXdata -> data
+    if kind == "attribute":
+        required = element.get("optional", "true") == "false"
+    else:
+        required = element.get("minOccurs", min_occurs) != "0"
+    items = element.findall("nx:enumeration/nx:item", NXDL_NS)
+    enumeration = tuple(item.get("value") for item in items) or None
+    return Spec(kind, name, nx_type, element.get("units"), required, enumeration)
+
+
+def _index_group(element, path, index, min_occurs):
+    for kind in ("field", "group", "attribute"):
+        for child in element.findall(f"nx:{kind}", NXDL_NS):
+            spec = _spec(child, kind, min_occurs)
+            separator = "@" if kind == "attribute" else "/"
+            child_path = f"{path}{separator}{spec.name}"
+            index[child_path] = spec
+            if kind != "attribute":
+                _index_group(child, child_path, index, min_occurs)
+
+
+def parse_nxdl(filename):
+    """
+    Index of one NXDL file
+
+    Fields and groups of application definitions are required unless ``minOccurs="0"``,
+    those of base (and contributed) classes are optional unless ``minOccurs`` is given.
+
+    :param filename: NXDL file
+    :return *tuple*: name of the definition and a dict NXDL path -> :class:`Spec`,
+                     paths relative to the definition (``""``), e.g. ``/entry/data/g2``
+                     or ``/entry/twotime/two_time_corr_func@storage_mode``
+    """
+    root = ET.parse(filename).getroot()
+    index = {}
+    _index_group(root, "", index, "1" if root.get("category") == "application" else "0")
+    return root.get("name"), index
+
+
+@functools.lru_cache(maxsize=4)
+def _definitions(directory, stamp):
+    definitions = {}
+    for name in (APPLICATION,) + MASK_DEFINITIONS:
+        definition, index = parse_nxdl(pathlib.Path(directory) / f"{name}.nxdl.xml")
+        children = collections.defaultdict(list)
+        enumerated = collections.defaultdict(list)
+        for path, spec in index.items():
+            if spec.kind != "attribute":
+                children[path.rsplit("/", 1)[0]].append(path)
+            elif spec.enumeration is not None:
+                enumerated[path.rsplit("@", 1)[0]].append(spec)
+        definitions[definition] = (index, dict(children), dict(enumerated))
+    logger.debug("indexed %s", ", ".join(definitions))
+    return definitions
+
+
+def definitions(directory=NXDL_DIR):
+    """
+    Index of the NXxpcs and mask definitions, parsed once per change of the NXDL files
+
+    :param directory: directory of the NXDL files
+    :return *dict*: name -> ``(index, children, enumerated)``, see :func:`parse_nxdl`;
+                    ``children`` maps a group path to the paths of its fields and groups,
+                    ``enumerated`` a path to the specs of its attributes with an enumeration
+    """
+    names = (APPLICATION,) + MASK_DEFINITIONS
+    stamp = tuple(pathlib.Path(directory, f"{name}.nxdl.xml").stat().st_mtime_ns for name in names)
+    return _definitions(str(directory), stamp)
+
+
+def _str(value):
+    """attribute or dataset value as a string for the comparison with an enumeration"""
+    if isinstance(value, np.ndarray) and value.size == 1:
+        value = value.item()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def _nx_class(obj):
+    nx_class = obj.attrs.get("NX_class")
+    return _str(nx_class) if nx_class is not None else None
+
+
+class _Walk:
+    """state of one pass over a file"""
+
+    def __init__(self, root, defs):
+        self.root = root
+        self.defs = defs
+        self.context = {}  # HDF5 path of a group -> (definition, NXDL path, HDF5 path of the instance)
+        self.found = collections.defaultdict(set)  # (instance, NXDL group path) -> names found
+        self.paths = {}  # (instance, NXDL group path) -> HDF5 path of the group found
+        self.issues = []
+        self.linked_groups = set()  # addresses of the multiply linked groups entered
+        self.replaying = False
+
+    def issue(self, severity, path, message):
+        self.issues.append(Issue(severity, path, message))
+
+    def match(self, definition, parent, name, nx_class):
+        """NXDL path of the child ``name`` of the NXDL group ``parent``, None if not defined"""
+        index, children, _ = self.defs[definition]
+        candidates = children.get(parent, ())
+        path = f"{parent}/{name}"
+        if path in index:
+            return path
+        if nx_class is not None:
+            for candidate in candidates:
+                spec = index[candidate]
+                if spec.kind == "group" and spec.nx_type == nx_class:
+                    return candidate
+        return None
+
+    def __call__(self, name, info):
+        """callback of the link visit, opens groups and the datasets of the definitions only"""
+        if name == b".":
+            return None
+        hdf_path = "/" + name.decode()
+        parent_name, _, base = hdf_path.rpartition("/")
+        parent_name = parent_name or "/"
+        if info.type != h5py.h5l.TYPE_HARD:
+            self.other_link(parent_name, base)
+            return None
+        info = h5py.h5o.get_info(self.root.id, name)
+        is_group = info.type == h5py.h5o.TYPE_GROUP
+        self.check_object(hdf_path, is_group)
+        if is_group and info.rc > 1 and not self.replaying:
+            if info.addr not in self.linked_groups:
+                self.linked_groups.add(info.addr)
+                return None
+            # H5Lvisit enters a group only once: walk its members again under this name
+            self.replaying = True
+            try:
+                self.root.id.links.visit(lambda member, link: self(name + b"/" + member, link),
+                                         info=True, obj_name=name)
+            finally:
+                self.replaying = False
+        return None
+
+    def check_object(self, hdf_path, is_group):
+        """map the object of a hard link onto the definitions and check it"""
+        parent_name, _, base = hdf_path.rpartition("/")
+        parent_name = parent_name or "/"
+        obj = self.root[hdf_path] if is_group else None
+        nx_class = _nx_class(obj) if is_group else None
+        if nx_class in MASK_DEFINITIONS:
+            # a mask group starts a new instance of its own definition
+            self.context[hdf_path] = (nx_class, "", hdf_path)
+            self.add_group(hdf_path, "", hdf_path)
+            self.check_attributes(nx_class, "", hdf_path, obj)
+            return
+        context = self.context.get(parent_name)
+        if context is None:
+            if parent_name == "/" and nx_class == "NXentry":
+                self.context[hdf_path] = (APPLICATION, "/entry", hdf_path)
+                self.add_group(hdf_path, "/entry", hdf_path)
+                self.check_attributes(APPLICATION, "/entry", hdf_path, obj)
+            return
+        definition, parent, instance = context
+        if definition == APPLICATION and parent == "/entry" and base in PROCESS_GROUPS:
+            self.context[hdf_path] = context  # transparent
+            return
+        path = self.match(definition, parent, base, nx_class)
+        if path is None:
+            return
+        spec = self.defs[definition][0][path]
+        self.found[(instance, parent)].add(spec.name)
+        if spec.kind == "group":
+            if not is_group:
+                self.issue("error", hdf_path, f"is a dataset, expected group {spec.nx_type}")
+                return
+            if nx_class != spec.nx_type:
+                self.issue("warning", hdf_path, f"NX_class is {nx_class}, expected {spec.nx_type}")
+            self.context[hdf_path] = (definition, path, instance)
+            self.add_group(instance, path, hdf_path)
+        else:
+            if is_group:
+                self.issue("error", hdf_path, "is a group, expected a field")
+                return
+            obj = self.root[hdf_path]
+            self.check_field(spec, hdf_path, obj)
+        self.check_attributes(definition, path, hdf_path, obj)
+
+    def add_group(self, instance, path, hdf_path):
+        """a group of the NXDL path ``path`` found at ``hdf_path``, its required children are checked"""
+        self.found[(instance, path)]
+        self.paths[(instance, path)] = hdf_path
+
+    def other_link(self, parent_name, base):
+        """a soft or external link below a group of a definition satisfies a required field"""
+        context = self.context.get(parent_name)
+        if context is None:
+            return
+        definition, parent, instance = context
+        path = self.match(definition, parent, base, None)
+        if path is not None:
+            self.found[(instance, parent)].add(self.defs[definition][0][path].name)
+
+    def check_field(self, spec, hdf_path, obj):
+        kinds = NX_TYPE_KINDS.get(spec.nx_type)
+        if kinds is not None and obj.dtype.kind not in kinds:
+            self.issue("warning", hdf_path, f"dtype {obj.dtype} does not match {spec.nx_type}")
+        if spec.enumeration is not None:
+            value = _str(obj[()])
+            if value not in spec.enumeration:
+                self.issue("error", hdf_path, f"value {value!r} is not one of {list(spec.enumeration)}")
+
+    def check_attributes(self, definition, path, hdf_path, obj):
+        """attributes with an enumeration, only these are read"""
+        for spec in self.defs[definition][2].get(path, ()):
+            if spec.name not in obj.attrs:
+                continue
+            value = _str(obj.attrs[spec.name])
+            if value not in spec.enumeration:
+                self.issue("error", f"{hdf_path}@{spec.name}",
+                           f"value {value!r} is not one of {list(spec.enumeration)}")
+
+    def check_required(self):
+        """required children of every group found"""
+        for (instance, parent), names in self.found.items():
+            definition = self.context[instance][0]
+            index, children, _ = self.defs[definition]
+            # the HDF5 path of the group, e.g. below the transparent process group
+            group = self.paths[(instance, parent)]
+            for path in children.get(parent, ()):
+                spec = index[path]
+                if spec.required and spec.name not in names:
+                    self.issue("error", f"{group.rstrip('/')}/{spec.name}", f"required {spec.kind} is missing")
+
+
+def validate(nexus_file, directory=NXDL_DIR):
+    """
+    Check a NeXus file against the NXxpcs definition (see module documentation)
+
+    :param nexus_file: name of the file or an open ``h5py.File``
+    :param directory: directory of the NXDL files
+    :return *list*: :class:`Issue` tuples ``(severity, path, message)``, empty for a valid file
+    """
+    if not isinstance(nexus_file, h5py.Group):
+        with h5py.File(nexus_file, "r") as file:
+            return validate(file, directory)
+    walk = _Walk(nexus_file.file, definitions(directory))
+    # H5Lvisit, like visititems_links, but without an h5py object for every link
+    walk.root.id.links.visit(walk, info=True)
+    if not any(parent == "/entry" for _, parent in walk.found):
+        walk.issue("error", "/", "no NXentry group")
+    walk.check_required()
+    for issue in walk.issues:
+        logger.debug("%s: %s %s", *issue)
+    return walk.issues
+
+
+def main(argv=None):
+    """print the issues of the files given on the command line, exit status 1 on errors"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Validate NeXus files against NXxpcs")
+    parser.add_argument("NeXus_files", nargs="+", help="NeXus file names")
+    parser.add_argument("--errors", action="store_true", help="report only errors")
+    options = parser.parse_args(argv)
+    status = 0
+    for filename in options.NeXus_files:
+        for severity, path, message in validate(filename):
+            if severity == "error":
+                status = 1
+            elif options.errors:
+                continue
+            print(f"{filename}:{path}: {severity}: {message}")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
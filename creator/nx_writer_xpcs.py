@@ -11,6 +11,10 @@ class Writer():
     took the dict (without data) and a generator for the data? The a Loader
     like this could send that generator as a parameter and write out chunks to be read.
     Heck, maybe instead of an input 
+
+    The streaming part of this idea is implemented in creator.nx_stream_xpcs:
+    loaders return sources with an ``iter_blocks`` method (e.g. StackedSource
+    for the APS two-time data) and the NXCreator copies them block by block.
     """
     def __init__(self, nxcreator: NXCreator):
         self._creator = nxcreator
@@ -1,63 +1,62 @@
-import h5py
-import numpy as np
+from creator.nx_stream_xpcs import StackedSource
+from loader.nx_loader_base import NXLoader
 
 
-class APSLoader():
+class APSLoader(NXLoader):
     def __init__(self, input_file):
-        self.data_file = h5py.File(input_file, 'r')
+        super().__init__(input_file)
 
     def _get_c2t(self):
-        c2t_list = []
-        if self.data_file.get("exchange/C2T_all") is not None:
-            for key in self.data_file.get("exchange/C2T_all"):
-                c2t_list.append(self.data_file.get(f"exchange/C2T_all/{key}")[()])
-                print(f"add twotime data {key}")
-                # currently using first index as running index for slicing
-                # TODO if last index is preferred, add transformation here
-            c2t_all = np.asarray(c2t_list)
-        else:
-            c2t_all = None
-        return c2t_all
+        """
+        Two-time correlation functions of all q-bins as one lazy ``(q, frames, frames)`` stack.
+
+        Nothing is read here, the creator copies one q-bin (or tile of rows) at a time.
+        """
+        c2t_group = self.data_file.get("exchange/C2T_all")
+        if c2t_group is None or len(c2t_group) == 0:
+            return None
+        # currently using first index as running index for slicing
+        # TODO if last index is preferred, add transformation here
+        return StackedSource((c2t_group[key] for key in c2t_group), units='a.u.')
 
     def xpcs_md(self):
         xpcs = dict(
-            g2=self.data_file.get("/exchange/norm-0-g2"),
+            g2=self._field("/exchange/norm-0-g2", 'a.u.'),
             g2_units='a.u.',
-            g2_stderr=self.data_file.get("/exchange/norm-0-stderr"),
-            delay_difference=self.data_file.get("/exchange/tau"),
+            g2_stderr=self._field("/exchange/norm-0-stderr", 'a.u.'),
+            delay_difference=self._field("/exchange/tau", 's'),
             delay_difference_units='s',
-            g2_partials_twotime=self.data_file.get("/exchange/g2partials"),
+            g2_partials_twotime=self._field("/exchange/g2partials", 'a.u.'),
             g2_partials_twotime_units='a.u.',
-            g2_twotime=self.data_file.get("/exchange/g2full"),
+            g2_twotime=self._field("/exchange/g2full", 'a.u.'),
             g2_twotime_units='a.u.',
             baseline_reference=1,
-            # TODO figure out how to access large amount of data
             twotime=self._get_c2t(),
             twotime_units='a.u.',
-            mask=self.data_file.get("/xpcs/mask"),
-            dynamic_roi_map=self.data_file.get("/xpcs/dqmap"),
-            dynamic_q_list=self.data_file.get("/xpcs/dqlist"),
-            dynamic_phi_list=self.data_file.get("/xpcs/dphilist"),
-            static_roi_map=self.data_file.get("/xpcs/sqmap"),
-            # static_q_list=self.data_file.get("/xpcs/sqlist"),
-            static_phi_list=self.data_file.get("/xpcs/sphilist")
+            mask=self._field("/xpcs/mask"),
+            dynamic_roi_map=self._field("/xpcs/dqmap"),
+            dynamic_q_list=self._field("/xpcs/dqlist", '1/angstrom'),
+            dynamic_phi_list=self._field("/xpcs/dphilist"),
+            static_roi_map=self._field("/xpcs/sqmap"),
+            # static_q_list=self._field("/xpcs/sqlist"),
+            static_phi_list=self._field("/xpcs/sphilist")
         )
         return xpcs
 
     def saxs1d_md(self):
         saxs1d = dict(
-            I=self.data_file.get("/exchange/partition-mean-total"),
+            I=self._field("/exchange/partition-mean-total", 'a.u.'),
             I_units='a.u.',
-            Q=self.data_file.get("/xpcs/sqlist"),
+            Q=self._field("/xpcs/sqlist", '1/angstrom'),
             Q_units= '1/angstrom',
-            I_partial=self.data_file.get("/exchange/partition-mean-partial"),
+            I_partial=self._field("/exchange/partition-mean-partial", 'a.u.'),
             I_partial_units='a.u.'
         )
         return saxs1d
 
     def saxs2d_md(self):
         saxs2d = dict(
-            I=self.data_file.get("/exchange/pixelSum"),
+            I=self._field("/exchange/pixelSum", 'a.u.'),
             I_units='a.u.'
         )
         return saxs2d
@@ -65,23 +64,21 @@ class APSLoader():
     def instrument_md(self):
         instrument = dict(
         #TODO add instrument name e.g. as input when running the converter
-            count_time=self.data_file.get("/measurement/instrument/detector/exposure_time"),
+            count_time=self._field("/measurement/instrument/detector/exposure_time", 's'),
             count_time_units='s',
-            description=self.data_file.get("/measurement/instrument/detector/manufacturer"),
-            distance=self.data_file.get("/measurement/instrument/detector/distance"),
+            description=self._field("/measurement/instrument/detector/manufacturer"),
+            distance=self._field("/measurement/instrument/detector/distance", 'mm'),
             distance_units='mm',
-            energy=self.data_file.get("/measurement/instrument/source_begin/energy"),
+            energy=self._field("/measurement/instrument/source_begin/energy", 'keV'),
             energy_units='keV',
-            frame_time=self.data_file.get("/measurement/instrument/detector/exposure_period"),
+            frame_time=self._field("/measurement/instrument/detector/exposure_period", 's'),
             frame_time_units='s',
-            x_pixel_size=self.data_file.get("/measurement/instrument/detector/x_pixel_size"),
-            y_pixel_size=self.data_file.get("/measurement/instrument/detector/y_pixel_size"),
+            x_pixel_size=self._field("/measurement/instrument/detector/x_pixel_size", 'um'),
+            y_pixel_size=self._field("/measurement/instrument/detector/y_pixel_size", 'um'),
             pixel_size_units='um',
-            beam_center_x=self.data_file.get('/measurement/instrument/acquisition/beam_center_x'),
+            beam_center_x=self._field('/measurement/instrument/acquisition/beam_center_x', 'pixel'),
             beam_center_x_units='pixel',
-            beam_center_y=self.data_file.get('/measurement/instrument/acquisition/beam_center_y'),
+            beam_center_y=self._field('/measurement/instrument/acquisition/beam_center_y', 'pixel'),
             beam_center_y_units='pixel'
         )
         return instrument
-
-
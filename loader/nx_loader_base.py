@@ -0,0 +1,158 @@
+import h5py
+import numpy as np
+
+from creator.nx_stream_xpcs import DEFAULT_BLOCK_BYTES, iter_blocks
+from creator.nx_trace_xpcs import traced
+
+# methods of the loaders that run in a span (see creator.nx_trace_xpcs)
+TRACED_METHODS = ("__init__", "get_entry_data", "xpcs_md", "saxs1d_md", "saxs2d_md", "instrument_md",
+                  "_get_c2t")
+
+
+class LazyField:
+    """
+    Descriptor of one field of a loader: shape, dtype, units and a read function.
+
+    Nothing is read when the descriptor is created, so the creator can size and
+    allocate its outputs first.  Fields backed by a dataset of the input file
+    keep it as ``source``; the creator copies those dataset-to-dataset without
+    an intermediate NumPy array.
+
+    :param read: function returning the complete value
+    :param shape: shape of the value
+    :param dtype: dtype of the value
+    :param units: units of the value (or None)
+    :param source: ``h5py.Dataset`` holding the value (or None)
+    """
+
+    def __init__(self, read, shape, dtype, units=None, source=None):
+        self._read = read
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.units = units
+        self.source = source
+
+    @classmethod
+    def from_dataset(cls, dataset, units=None):
+        """Descriptor of an ``h5py.Dataset`` of the input file."""
+        return cls(lambda: dataset[()],
+                   dataset.shape,
+                   dataset.dtype,
+                   units=units,
+                   source=dataset)
+
+    @classmethod
+    def from_value(cls, value, units=None):
+        """Descriptor of a small value already in memory (attributes, lists)."""
+        array = np.asarray(value)
+        return cls(lambda: value, array.shape, array.dtype, units=units)
+
+    def __repr__(self):
+        return f"LazyField(shape={self.shape}, dtype={self.dtype}, units={self.units!r})"
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape, dtype=np.int64)) * self.dtype.itemsize
+
+    def read(self):
+        """Read the complete value."""
+        return self._read()
+
+    def __getitem__(self, selection):
+        """Read a selection only, e.g. ``field[q, start:stop]``."""
+        if self.source is not None:
+            return self.source[selection]
+        return np.asarray(self.read())[selection]
+
+    def iter_blocks(self, max_bytes=DEFAULT_BLOCK_BYTES):
+        """Yield ``(selection, block)`` pairs, see :func:`creator.nx_stream_xpcs.iter_blocks`."""
+        yield from iter_blocks(self.source if self.source is not None else np.asarray(self.read()),
+                               max_bytes)
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.asarray(self.read())
+        return data if dtype is None else data.astype(dtype)
+
+
+class NXLoader:
+    """
+    Common base of the loaders.
+
+    The ``*_md()`` methods return dictionaries of :class:`LazyField`
+    descriptors (plus the ``*_units`` strings expected by the creator).
+    Missing fields are ``None``.
+
+    The :data:`TRACED_METHODS` of every loader class run in a span named
+    ``<class>.<method>`` (see :mod:`creator.nx_trace_xpcs`).
+
+    :param input_file: name of the input (results) file
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in TRACED_METHODS:
+            method = cls.__dict__.get(name)
+            if method is not None and not getattr(method, "__traced__", False):
+                setattr(cls, name, traced(f"{cls.__name__}.{name}")(method))
+
+    def __init__(self, input_file):
+        self.data_file = h5py.File(input_file, "r")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.data_file.close()
+
+    def _field(self, path, units=None):
+        """Lazy field of the dataset at ``path`` (None if missing)"""
+        dataset = self.data_file.get(path)
+        if not isinstance(dataset, h5py.Dataset):
+            return None
+        return LazyField.from_dataset(dataset, units=units)
+
+    def _attr_field(self, path, name, units=None):
+        """Lazy field of attribute ``name`` of the object at ``path`` (None if missing)"""
+        obj = self.data_file.get(path)
+        if obj is None or name not in obj.attrs:
+            return None
+        return LazyField.from_value(obj.attrs[name], units=units)
+
+    def xpcs_md(self):
+        raise NotImplementedError
+
+    def saxs1d_md(self):
+        raise NotImplementedError
+
+    def saxs2d_md(self):
+        raise NotImplementedError
+
+    def instrument_md(self):
+        raise NotImplementedError
+
+    def describe(self):
+        """
+        Shape, dtype and units of all fields, without reading any data
+
+        :return *dict*: ``{md name: {field: (shape, dtype, units)}}``
+        """
+        description = {}
+        for md_name in ("xpcs_md", "saxs1d_md", "saxs2d_md", "instrument_md"):
+            md = getattr(self, md_name)()
+            description[md_name] = {key: (value.shape, value.dtype, value.units)
+                                    for key, value in md.items()
+                                    if hasattr(value, "read")}
+        return description
+
+    def nbytes(self):
+        """Total size of all fields in bytes"""
+        return sum(int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+                   for fields in self.describe().values()
+                   for shape, dtype, _ in fields.values())
@@ -1,9 +1,9 @@
-import h5py
+from loader.nx_loader_base import LazyField, NXLoader
 
 
-class NSLSLoader:
+class NSLSLoader(NXLoader):
     def __init__(self, input_file, use_q_values=True):
-        self.data_file = h5py.File(input_file, "r")
+        super().__init__(input_file)
         self.use_q_values = use_q_values  # use q values or indices for dynamic_q_list
 
     def get_entry_data(self):
@@ -19,77 +19,77 @@ class NSLSLoader:
 
     def xpcs_md(self):
         xpcs_data = {}
-        xpcs_data['frameSum'] = self.data_file.get('imgsum')
+        xpcs_data['frameSum'] = self._field('imgsum', 'a.u')
         xpcs_data['frameSum_units'] = 'a.u'
-        xpcs_data['g2'] = self.data_file.get('g2')
+        xpcs_data['g2'] = self._field('g2', 'a.u')
         xpcs_data['g2_units'] = 'a.u'
-        xpcs_data['g2_stderr'] = self.data_file.get('g2_stderr')
-        xpcs_data['tau'] = self.data_file.get('taus')
+        xpcs_data['g2_stderr'] = self._field('g2_stderr', 'a.u')
+        xpcs_data['tau'] = self._field('taus', 's')
         xpcs_data['tau_units'] = 's'
         # TODO: C2 or twotime?
-        xpcs_data['twotime'] = self.data_file.get('g12b')
+        xpcs_data['twotime'] = self._field('g12b', 'a.u')
         xpcs_data['twotime_units'] = 'a.u'
-        xpcs_data['g2_from_two_time_corr_func'] = self.data_file.get('g2_from_two_time_corr_func')
+        xpcs_data['g2_from_two_time_corr_func'] = self._field('g2_from_two_time_corr_func', 'a.u')
         xpcs_data['g2_from_two_time_corr_units'] = 'a.u'
-        xpcs_data['g2_from_two_time_corr_func_partials'] = self.data_file.get('g2_from_two_time_corr_func_partials')
+        xpcs_data['g2_from_two_time_corr_func_partials'] = self._field('g2_from_two_time_corr_func_partials', 'a.u')
         xpcs_data['g2_partials_twotime_units'] = 'a.u'
 
-        xpcs_data['mask'] = self.data_file.get('mask')
+        xpcs_data['mask'] = self._field('mask')
 
-        xpcs_data['dynamic_roi_map'] = self.data_file.get('roi_mask')
+        xpcs_data['dynamic_roi_map'] = self._field('roi_mask')
 
         # Option to let user pick between q value
         # or q index for dynamic_q_list
         d = {int(k): v for k, v in self.data_file.get('qval_dict').attrs.items()}
         q_vals = [d[i][0] for i in sorted(d.keys())]
         if self.use_q_values:
-            xpcs_data['dynamic_q_list'] = q_vals
+            xpcs_data['dynamic_q_list'] = LazyField.from_value(q_vals, units='1/angstrom')
             xpcs_data['dynamic_q_list_unit'] = '1/angstrom'
         else:
             q_index_list = [i + 1 for i in range(len(q_vals))]
             # This is an integer pointer; doesn't need a unit
-            xpcs_data['dynamic_q_list'] = q_index_list
+            xpcs_data['dynamic_q_list'] = LazyField.from_value(q_index_list)
 
         # Angle measurement
-        xpcs_data['dphi'] = self.data_file.get('dphi')
+        xpcs_data['dphi'] = self._field('dphi')
 
-        xpcs_data['static_roi_map'] = self.data_file.get('static_roi_map')
+        xpcs_data['static_roi_map'] = self._field('static_roi_map')
 
         return xpcs_data
 
     def saxs1d_md(self):
         saxs_1d_data = {}
-        saxs_1d_data['I'] = self.data_file.get('iq_saxs')
+        saxs_1d_data['I'] = self._field('iq_saxs', 'a.u')
         saxs_1d_data['I_units'] = 'a.u'
-        saxs_1d_data['Q'] = self.data_file.get('q_saxs')
+        saxs_1d_data['Q'] = self._field('q_saxs', '1/angstrom')
         saxs_1d_data['Q_units'] = '1/angstrom'
-        saxs_1d_data['I_partial'] = self.data_file.get('I_partial')
+        saxs_1d_data['I_partial'] = self._field('I_partial', 'a.u')
         saxs_1d_data['I_partial_units'] = 'a.u'
         return saxs_1d_data
 
     def saxs2d_md(self):
         saxs_2d_data = {}
-        saxs_2d_data['I'] = self.data_file.get('avg_img')
+        saxs_2d_data['I'] = self._field('avg_img', 'a.u')
         saxs_2d_data['I_units'] = 'a.u'
         return saxs_2d_data
 
     def instrument_md(self):
         instrument_data = {}
         #TODO add instrument name e.g. as input when running the converter
-        instrument_data['energy'] = self.data_file.get('md').attrs['eiger4m_single_photon_energy']
+        instrument_data['energy'] = self._attr_field('md', 'eiger4m_single_photon_energy', 'eV')
         instrument_data['energy_units'] = 'eV'
-        instrument_data['description'] = self.data_file.get('md').attrs['detector']
-        instrument_data['distance'] = self.data_file.get('md').attrs['detector_distance']
+        instrument_data['description'] = self._attr_field('md', 'detector')
+        instrument_data['distance'] = self._attr_field('md', 'detector_distance', 'm')
         instrument_data['distance_units'] = 'm'
-        instrument_data['count_time'] = self.data_file.get('md').attrs['count_time']
+        instrument_data['count_time'] = self._attr_field('md', 'count_time', 'ms')
         instrument_data['count_time_units'] = 'ms'
-        instrument_data['frame_time'] = self.data_file.get('md').attrs['frame_time']
+        instrument_data['frame_time'] = self._attr_field('md', 'frame_time', 'ms')
         instrument_data['frame_time_units'] = 'ms'
-        instrument_data['beam_center_x'] = self.data_file.get('md').attrs['beam_center_x']
+        instrument_data['beam_center_x'] = self._attr_field('md', 'beam_center_x', 'pixel')
         instrument_data['beam_center_x_units'] = 'pixel'
-        instrument_data['beam_center_y'] = self.data_file.get('md').attrs['beam_center_y']
+        instrument_data['beam_center_y'] = self._attr_field('md', 'beam_center_y', 'pixel')
         instrument_data['beam_center_y_units'] = 'pixel'
-        instrument_data['x_pixel_size'] = self.data_file.get('md').attrs['x_pixel_size']
-        instrument_data['y_pixel_size'] = self.data_file.get('md').attrs['y_pixel_size']
+        instrument_data['x_pixel_size'] = self._attr_field('md', 'x_pixel_size', 'um')
+        instrument_data['y_pixel_size'] = self._attr_field('md', 'y_pixel_size', 'um')
         instrument_data['pixel_size_units'] = 'um'
         return instrument_data
@@ -1,18 +1,28 @@
+import contextlib
+import logging
+import os
 import sys
 
-from creator.nx_creator_xpcs import NXCreator
-from loader.nx_loader_aps import APSLoader
-from loader.nx_loader_nslsii import NSLSLoader
+from conversion_cache import ConversionCache, file_stat
+from creator.nx_trace_xpcs import tracing
 
 """
 usage: python simple_converter.py inputfile outputfile loader_id
+
+The conversion is also a function, :func:`convert`, for workflows that
+convert many files in one process.  Only the standard library is imported
+with this module: NumPy, h5py, the creator and the loaders are imported by
+the first conversion, pint by the first units check that needs it, so
+``--help`` and argument errors return at once.
 """
 
+logger = logging.getLogger(__name__)
+
 
 # TODO add logging and other stuff if desired
 # TODO add option to pass input in prompt if not given as sys args
-def get_user_parameters():
-    """configure user's command line parameters from sys.argv"""
+def get_user_parameters(argv=None):
+    """configure user's command line parameters from sys.argv (or ``argv``)"""
     import argparse
 
     parser = argparse.ArgumentParser(
@@ -60,76 +70,427 @@ def get_user_parameters():
         action="store_true",
         help="Use this to use q values for dynamic_q_list instead of index values",
     )
-    return parser.parse_args()
-
-
-options = get_user_parameters()
-output_filename = options.NeXus_file
-
-input_filename = options.Input_file
-loader_id = options.Loader_id
-use_q_values = options.use_q_values
-# TODO add logic to select loader based on file suffix/user input
-# TODO: add additional keyword arguments to have standard signature
-if loader_id.lower() == "aps":
-    loader = APSLoader(input_file=input_filename)
-elif loader_id.lower() == "nslsii":
-    # TODO: handle use_q_values in parser
-    loader = NSLSLoader(input_file=input_filename, use_q_values=use_q_values)
-
-### GETTING THE DATA IS FLEXIBLE --> Choose best way depedning on data
-# Get data dictionaries from selected loader
-md_xpcs = loader.xpcs_md()
-md_saxs1d = loader.saxs1d_md()
-md_saxs2d = loader.saxs2d_md()
-md_instrument = loader.instrument_md()
-
-
-### Instanciate Creator Class
-creator = NXCreator(output_filename)
-
-# TODO what to do if file exists (and is still opened elsewhere)? Append?
-creator.init_file()
-creator.create_entry_group()
-creator.create_xpcs_group(
-                          g2=md_xpcs.get('g2'),
-                          g2_units=md_xpcs.get('g2_units'),
-                          g2_stderr=md_xpcs.get('g2_stderr'),
-                          g2_from_two_time_corr_func_partials=md_xpcs.get('g2_from_two_time_corr_func_partials'),
-                          g2_partials_twotime_units=md_xpcs.get('g2_partials_twotime_units'),
-                          g2_from_two_time_corr_func=md_xpcs.get('g2_from_two_time_corr_func'),
-                          g2_from_two_time_corr_units=md_xpcs.get('g2_from_two_time_corr_units'),
-                          # TODO find a better name for this entry: e.g. twotime_corr, twotime, C2T_all...?
-                          twotime=md_xpcs.get('twotime'),
-                          twotime_units=md_xpcs.get('twotime_units'),
-                          tau=md_xpcs.get('tau'),
-                          tau_units=md_xpcs.get('tau_units'),
-                          mask=md_xpcs.get('mask'),
-                          dynamic_roi_map=md_xpcs.get('dynamic_roi_map'),
-                          dynamic_q_list=md_xpcs.get('dynamic_q_list'),
-                          dynamic_phi_list=md_xpcs.get('dynamic_phi_list'),
-                          static_roi_map=md_xpcs.get('static_roi_map')
-                          )
-creator.create_saxs_1d_group(
-                             I=md_saxs1d.get("I"),
-                             I_units=md_saxs1d.get("I_units"),
-                             Q=md_saxs1d.get("Q"),
-                             Q_units=md_saxs1d.get("Q_units"),
-                             I_partial=md_saxs1d.get("I_partial"),
-                             I_partial_units=md_saxs1d.get("I_partial_units"))
-creator.create_saxs_2d_group(I=md_saxs2d.get("I"))
-creator.create_instrument_group(
-                                count_time=md_instrument.get("count_time"),
-                                count_time_units=md_instrument.get("count_time_units"),
-                                frame_time=md_instrument.get("frame_time"),
-                                frame_time_units=md_instrument.get("frame_time_units"),
-                                description=md_instrument.get("description"),
-                                distance=md_instrument.get("distance"),
-                                distance_units=md_instrument.get("distance_units"),
-                                x_pixel_size=md_instrument.get("x_pixel_size"),
-                                y_pixel_size=md_instrument.get("y_pixel_size"),
-                                pixel_size_units=md_instrument.get("y_pixel_size_units"),
-                                energy=md_instrument.get("energy"),
-                                energy_units=md_instrument.get("energy_units"))
+
+    parser.add_argument(
+        "--reference",
+        action="store_true",
+        help="Reference the input data (virtual datasets) instead of copying it",
+    )
+
+    parser.add_argument(
+        "--two_time_storage",
+        choices=("full", "packed", "tiles"),
+        default="full",
+        help="Store two_time_corr_func as full matrices or only their upper half",
+    )
+
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        help="Overlap reading the input file with writing the NeXus file",
+    )
+
+    parser.add_argument(
+        "--find_beam_center",
+        action="store_true",
+        help="Estimate the beam center from the time-averaged SAXS 2D image",
+    )
+
+    parser.add_argument(
+        "--trace",
+        help="Append the timing, I/O and memory of every stage to this JSON lines file",
+    )
+
+    parser.add_argument(
+        "--prometheus",
+        help="Write the totals of the stages to this Prometheus textfile (*.prom)",
+    )
+
+    parser.add_argument(
+        "--cache",
+        help="SQLite file of the conversions, skip the conversion if the NeXus file is current",
+    )
+
+    parser.add_argument(
+        "--digest",
+        action="store_true",
+        help="Compare the content of touched input files (sha256) with the cache",
+    )
+
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Append the conversion as the next entry_N of the NeXus file (series file), "
+             "instrument and masks groups identical to earlier entries are hard-linked",
+    )
+
+    parser.add_argument(
+        "--map_library",
+        help="Directory of the shared masks and q maps, reference them instead of copying",
+    )
+
+    parser.add_argument(
+        "--derive_g2",
+        action="store_true",
+        help="Derive g2_from_two_time_corr_func from the two-time correlation function "
+             "if the input file lacks it (reads the whole two-time stack)",
+    )
+    return parser.parse_args(argv)
+
+
+def get_loader(input_filename, loader_id, use_q_values=False):
+    """
+    Select the loader for ``input_filename``
+
+    :param input_filename: name of the input (results) file
+    :param loader_id: "aps" or "nslsii"
+    :param use_q_values: use q values instead of indices for dynamic_q_list (NSLS-II only)
+    """
+    # TODO add logic to select loader based on file suffix/user input
+    # TODO: add additional keyword arguments to have standard signature
+    if loader_id.lower() == "aps":
+        from loader.nx_loader_aps import APSLoader
+
+        return APSLoader(input_file=input_filename)
+    elif loader_id.lower() == "nslsii":
+        from loader.nx_loader_nslsii import NSLSLoader
+
+        return NSLSLoader(input_file=input_filename, use_q_values=use_q_values)
+    raise ValueError(f"unknown loader id '{loader_id}', use 'aps' or 'nslsii'")
+
+
+def xpcs_group_kwargs(md_xpcs):
+    """map the loader's xpcs_md() onto the arguments of NXCreator.create_xpcs_group"""
+    return dict(
+                g2=md_xpcs.get('g2'),
+                g2_units=md_xpcs.get('g2_units'),
+                g2_stderr=md_xpcs.get('g2_stderr'),
+                # the APS loader names them g2_partials_twotime and g2_twotime
+                g2_from_two_time_corr_func_partials=md_xpcs.get('g2_from_two_time_corr_func_partials',
+                                                                md_xpcs.get('g2_partials_twotime')),
+                g2_partials_twotime_units=md_xpcs.get('g2_partials_twotime_units'),
+                g2_from_two_time_corr_func=md_xpcs.get('g2_from_two_time_corr_func',
+                                                       md_xpcs.get('g2_twotime')),
+                g2_from_two_time_corr_units=md_xpcs.get('g2_from_two_time_corr_units',
+                                                        md_xpcs.get('g2_twotime_units')),
+                # TODO find a better name for this entry: e.g. twotime_corr, twotime, C2T_all...?
+                two_time_corr_func=md_xpcs.get('twotime'),
+                two_time_corr_units=md_xpcs.get('twotime_units'),
+                tau=md_xpcs.get('tau'),
+                tau_units=md_xpcs.get('tau_units'),
+                mask=md_xpcs.get('mask'),
+                dynamic_roi_map=md_xpcs.get('dynamic_roi_map'),
+                dynamic_q_list=md_xpcs.get('dynamic_q_list'),
+                dynamic_phi_list=md_xpcs.get('dynamic_phi_list'),
+                static_roi_map=md_xpcs.get('static_roi_map')
+                )
+
+
+def derive_two_time_g2(kwargs):
+    """
+    Fill g2_from_two_time_corr_func and its partials from two_time_corr_func
+
+    NSLS-II results files do not always contain them; fields supplied by the loader are kept.
+    The derivation reads the whole two-time stack, so it is opt-in (``derive_g2``).
+    """
+    two_time = kwargs.get("two_time_corr_func")
+    missing = [key for key in ("g2_from_two_time_corr_func", "g2_from_two_time_corr_func_partials")
+               if kwargs.get(key) is None]
+    if two_time is None or not missing:
+        return kwargs
+    from creator.nx_twotime_xpcs import g2_from_two_time
+
+    g2, g2_partials = g2_from_two_time(two_time)
+    derived = dict(g2_from_two_time_corr_func=g2, g2_from_two_time_corr_func_partials=g2_partials)
+    for key in missing:
+        kwargs[key] = derived[key]
+    if kwargs.get("g2_from_two_time_corr_units") is None:
+        kwargs["g2_from_two_time_corr_units"] = "a.u."
+    return kwargs
+
+
+def saxs_1d_group_kwargs(md_saxs1d):
+    """map the loader's saxs1d_md() onto the arguments of NXCreator.create_saxs_1d_group"""
+    return dict(
+                I=md_saxs1d.get("I"),
+                I_units=md_saxs1d.get("I_units"),
+                Q=md_saxs1d.get("Q"),
+                Q_units=md_saxs1d.get("Q_units"),
+                I_partial=md_saxs1d.get("I_partial"),
+                I_partial_units=md_saxs1d.get("I_partial_units"))
+
+
+def saxs_2d_group_kwargs(md_saxs2d):
+    """map the loader's saxs2d_md() onto the arguments of NXCreator.create_saxs_2d_group"""
+    return dict(I=md_saxs2d.get("I"))
+
+
+def instrument_group_kwargs(md_instrument):
+    """map the loader's instrument_md() onto the arguments of NXCreator.create_instrument_group"""
+    return dict(
+                count_time=md_instrument.get("count_time"),
+                count_time_units=md_instrument.get("count_time_units"),
+                frame_time=md_instrument.get("frame_time"),
+                frame_time_units=md_instrument.get("frame_time_units"),
+                description=md_instrument.get("description"),
+                distance=md_instrument.get("distance"),
+                distance_units=md_instrument.get("distance_units"),
+                x_pixel_size=md_instrument.get("x_pixel_size"),
+                y_pixel_size=md_instrument.get("y_pixel_size"),
+                pixel_size_units=md_instrument.get("y_pixel_size_units"),
+                beam_center_x=md_instrument.get("beam_center_x"),
+                beam_center_y=md_instrument.get("beam_center_y"),
+                beam_center_units=md_instrument.get("beam_center_x_units"),
+                energy=md_instrument.get("energy"),
+                energy_units=md_instrument.get("energy_units"))
+
+
+def estimate_beam_center(kwargs, loader):
+    """
+    Replace the beam center of the instrument group by the estimate from the
+    time-averaged SAXS 2D image (and the mask) of the loader
+
+    Without a SAXS 2D image the beam center of the loader is kept.
+    """
+    import numpy as np
+
+    from creator.nx_beamcenter_xpcs import beam_center_kwargs
+
+    image = loader.saxs2d_md().get("I")
+    if image is None:
+        logger.warning("no SAXS 2D image, cannot estimate the beam center")
+        return kwargs
+    mask = loader.xpcs_md().get("mask")
+    kwargs.update(beam_center_kwargs(np.asarray(image), None if mask is None else np.asarray(mask)))
+    return kwargs
+
+
+def conversion_stages(loader, find_beam_center=False, derive_g2=False):
+    """
+    The groups to write, in order
+
+    :param find_beam_center: estimate the beam center from the SAXS 2D image
+    :param derive_g2: derive missing g2_from_two_time_corr_func (and partials) from the two-time
+                      correlation function, see :func:`derive_two_time_g2`
+    :return *list*: ``(creator method name, function returning its keyword arguments)``
+    """
+    def xpcs():
+        kwargs = xpcs_group_kwargs(loader.xpcs_md())
+        return derive_two_time_g2(kwargs) if derive_g2 else kwargs
+
+    def instrument():
+        kwargs = instrument_group_kwargs(loader.instrument_md())
+        return estimate_beam_center(kwargs, loader) if find_beam_center else kwargs
+
+    return [
+        ("create_xpcs_group", xpcs),
+        ("create_saxs_1d_group", lambda: saxs_1d_group_kwargs(loader.saxs1d_md())),
+        ("create_saxs_2d_group", lambda: saxs_2d_group_kwargs(loader.saxs2d_md())),
+        ("create_instrument_group", instrument),
+    ]
+
+
+def output_options(use_q_values=False, reference_mode=False, two_time_storage="full",
+                   find_beam_center=False, map_library=None, derive_g2=False):
+    """the options of :func:`convert_file` that change the NeXus file (key of the conversion cache)"""
+    return dict(use_q_values=use_q_values,
+                reference_mode=reference_mode,
+                two_time_storage=two_time_storage,
+                find_beam_center=find_beam_center,
+                map_library=None if map_library is None else os.path.abspath(map_library),
+                derive_g2=derive_g2 and not reference_mode)
+
+
+def _derive_in(reference_mode, derive_g2):
+    """derive_g2 unless in reference mode, which reads no data"""
+    if derive_g2 and reference_mode:
+        logger.warning("g2_from_two_time_corr_func is not derived in reference mode")
+    return derive_g2 and not reference_mode
+
+
+def convert_file(input_filename,
+                 output_filename,
+                 loader_id,
+                 use_q_values=False,
+                 reference_mode=False,
+                 two_time_storage="full",
+                 pipelined=False,
+                 find_beam_center=False,
+                 map_library=None,
+                 derive_g2=False,
+                 cache=None):
+    """
+    Convert one results file into a NeXus file
+
+    :param input_filename: name of the input (results) file
+    :param output_filename: name of the NeXus file to write
+    :param loader_id: "aps" or "nslsii"
+    :param use_q_values: use q values instead of indices for dynamic_q_list (NSLS-II only)
+    :param reference_mode: write virtual datasets pointing into the input file instead of copies
+    :param two_time_storage: "full", "packed" or "tiles" (upper half only) for two_time_corr_func
+    :param pipelined: read the next group in a thread while writing the current one
+                      (ignored in reference mode, which reads no data)
+    :param find_beam_center: estimate the beam center from the SAXS 2D image instead of
+                             using the one of the input file
+    :param map_library: directory of the shared masks and q maps (see :mod:`creator.nx_library_xpcs`),
+                        default: copy them into the NeXus file
+    :param derive_g2: derive g2_from_two_time_corr_func and its partials from the two-time
+                      correlation function if the input file lacks them (ignored in reference mode)
+    :param cache: :class:`conversion_cache.ConversionCache`, skip the conversion if the
+                  NeXus file is current, record the conversion otherwise
+    :return *bool*: `False` if the conversion was skipped
+    """
+    options = output_options(use_q_values, reference_mode, two_time_storage, find_beam_center, map_library,
+                             derive_g2)
+    if cache is not None:
+        if cache.is_current(input_filename, output_filename, loader_id, **options):
+            logger.info("%s is current, not converted again", output_filename)
+            return False
+        stat = file_stat(input_filename)
+    from creator.nx_creator_xpcs import NXCreator
+    from creator.nx_pipeline_xpcs import run_pipelined
+
+    loader = get_loader(input_filename, loader_id, use_q_values=use_q_values)
+    try:
+        ### Instanciate Creator Class
+        # an existing output file is overwritten (unless the cache finds it current)
+        # TODO what if it is still opened elsewhere?
+        with NXCreator(output_filename,
+                       reference_mode=reference_mode,
+                       two_time_storage=two_time_storage,
+                       map_library=map_library) as creator:
+            creator.init_file()
+            creator.create_entry_group()
+            ### GETTING THE DATA IS FLEXIBLE --> Choose best way depedning on data
+            # Get data dictionaries from selected loader, group by group
+            stages = conversion_stages(loader, find_beam_center=find_beam_center,
+                                       derive_g2=_derive_in(reference_mode, derive_g2))
+            if pipelined and not reference_mode:
+                run_pipelined(creator, stages)
+            else:
+                for method, produce in stages:
+                    getattr(creator, method)(**produce())
+    finally:
+        loader.close()
+    if cache is not None:
+        cache.record(input_filename, output_filename, loader_id, stat=stat, **options)
+    return True
+
+
+def convert_series(input_filenames,
+                   output_filename,
+                   loader_id,
+                   use_q_values=False,
+                   reference_mode=False,
+                   two_time_storage="full",
+                   find_beam_center=False,
+                   map_library=None,
+                   derive_g2=False,
+                   pipelined=False):
+    """
+    Append results files as the entries ``entry_N`` of one NeXus file (series file)
+
+    The entries are numbered after those already in the file.  Instrument and
+    masks groups identical to one written before are hard-linked instead of
+    copied, see :mod:`creator.nx_series_xpcs`.
+
+    :param input_filenames: names of the input (results) files, in order
+    :param output_filename: name of the NeXus file, created if missing
+    :param loader_id: "aps" or "nslsii"
+    :param use_q_values: use q values instead of indices for dynamic_q_list (NSLS-II only)
+    :param reference_mode: write virtual datasets pointing into the input files instead of copies
+    :param two_time_storage: "full", "packed" or "tiles" (upper half only) for two_time_corr_func
+    :param find_beam_center: estimate the beam center from the SAXS 2D image
+    :param map_library: directory of the shared masks and q maps, default: copy them into the file
+    :param derive_g2: derive missing g2_from_two_time_corr_func from the two-time correlation
+                      function (ignored in reference mode)
+    :param pipelined: read the next group in a thread while writing the current one
+                      (ignored in reference mode, which reads no data)
+    :return *list*: names of the entries written
+    """
+    import h5py
+
+    from creator.nx_creator_xpcs import NXCreator
+    from creator.nx_pipeline_xpcs import run_pipelined
+    from creator.nx_series_xpcs import next_entry_index
+
+    index = 1
+    exists = os.path.exists(output_filename)
+    if exists:
+        with h5py.File(output_filename, "r") as file:
+            index = next_entry_index(file)
+    derive_g2 = _derive_in(reference_mode, derive_g2)
+    entries = []
+    with NXCreator(output_filename,
+                   reference_mode=reference_mode,
+                   two_time_storage=two_time_storage,
+                   share_identical=True,
+                   map_library=map_library) as creator:
+        if not exists:
+            creator.init_file()
+        for index, input_filename in enumerate(input_filenames, start=index):
+            loader = get_loader(input_filename, loader_id, use_q_values=use_q_values)
+            try:
+                creator.create_entry_group(title=os.path.basename(input_filename), entry_index=index)
+                stages = conversion_stages(loader, find_beam_center=find_beam_center, derive_g2=derive_g2)
+                if pipelined and not reference_mode:
+                    run_pipelined(creator, stages)
+                else:
+                    for method, produce in stages:
+                        getattr(creator, method)(**produce())
+            finally:
+                loader.close()
+            entries.append(creator.entry_group_name)
+            logger.info("%s -> %s:%s", input_filename, output_filename, creator.entry_group_name)
+    return entries
+
+
+def convert(input_filename, output_filename, loader_id, append=False, **options):
+    """
+    Convert one results file, the API behind the command line
+
+    :param input_filename: name of the input (results) file
+    :param output_filename: name of the NeXus file
+    :param loader_id: "aps" or "nslsii"
+    :param append: append the results as the next ``entry_N`` of ``output_filename``
+                   (:func:`convert_series`) instead of writing a new file (:func:`convert_file`)
+    :param options: keyword arguments of :func:`convert_file` or :func:`convert_series`
+    :return *bool*: `False` if the conversion was skipped (the NeXus file is current)
+    """
+    if append:
+        if options.get("cache") is not None:
+            # the cache keys whole files, a series file is never current
+            raise ValueError("a conversion cache cannot be used with append")
+        options.pop("cache", None)
+        convert_series([input_filename], output_filename, loader_id, **options)
+        return True
+    return convert_file(input_filename, output_filename, loader_id, **options)
+
+
+def main(argv=None):
+    options = get_user_parameters(argv)
+    traced = options.trace is not None or options.prometheus is not None
+    cache = None
+    if options.cache is not None:
+        cache = ConversionCache(options.cache, digest="sha256" if options.digest else None)
+    try:
+        with tracing(options.trace, options.prometheus) if traced else contextlib.nullcontext():
+            convert(options.Input_file,
+                    options.NeXus_file,
+                    options.Loader_id,
+                    append=options.append,
+                    use_q_values=options.use_q_values,
+                    reference_mode=options.reference,
+                    two_time_storage=options.two_time_storage,
+                    pipelined=options.pipelined,
+                    find_beam_center=options.find_beam_center,
+                    map_library=options.map_library,
+                    derive_g2=options.derive_g2,
+                    cache=cache)
+    finally:
+        if cache is not None:
+            cache.close()
 
 
+if __name__ == "__main__":
+    main()
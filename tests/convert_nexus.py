@@ -1,38 +1,92 @@
+import itertools
+import logging
 import time
-from treelib import Tree
 import h5py
 import json
+import numpy as np
 
+logger = logging.getLogger(__name__)
 
-def create_nx_worker(h5f, tree, nid, md):
+SCALAR_MODES = (None, "attributes", "compound")
+# HDF5 object header messages are limited to 64 KiB, the datatype of one
+# compound dataset stays below this (with margin for the message overhead)
+MAX_COMPOUND_TYPE_BYTES = 48 * 1024
+
+
+def _is_scalar(value):
+    """small scalar (number or string) that may be batched"""
+    return np.ndim(value) == 0 and isinstance(value, (int, float, complex, str, bytes, np.generic))
+
+
+def _parent(key):
+    return key.rsplit('/', 1)[0] or '/'
+
+
+def _type_bytes(field, dtype):
+    """size of the HDF5 datatype description of one compound field"""
+    return len(h5py.h5t.py_create(np.dtype([(field, dtype)]), logical=True).encode())
+
+
+def _write_compound(group, name, items):
     """
-    recursively create the structure using dfs;
+    write the scalars of one group as compound datasets with a field per key;
+    the fields are split over ``name``, ``name_1``, ``name_2``, ... so the
+    datatype of each dataset fits into the object header
     Args:
-        h5f: the input nexus/hdf5 file handler, must be writable;
-        tree: tree structure that represent the data structure;
-        nid: the root path to begin with
-        md: dictionary containing the data
-    Return:
-        None
+        group: h5py group to write into;
+        name: name of the (first) compound dataset;
+        items: list of (field name, value);
     """
-    # x is a Tree.Node type
-    for x in tree.children(nid):
-        if not x.is_leaf():
-            h5f.create_group(x.identifier)
-            create_nx_worker(h5f, tree, x.identifier, md=md)
-        else:
-            h5f.create_dataset(x.identifier, data=md[x.identifier])
-
-
-def nexus_from_dictionary(output_fname, md, show_tree=False):
+    chunks = [[]]
+    size = 0
+    for field, value in items:
+        dtype = h5py.string_dtype() if isinstance(value, (str, bytes)) else np.asarray(value).dtype
+        field_bytes = _type_bytes(field, dtype)
+        if chunks[-1] and size + field_bytes > MAX_COMPOUND_TYPE_BYTES:
+            chunks.append([])
+            size = 0
+        chunks[-1].append((field, dtype, value))
+        size += field_bytes
+    for index, chunk in enumerate(chunks):
+        data = np.empty((), dtype=[(field, dtype) for field, dtype, _ in chunk])
+        for field, _, value in chunk:
+            data[field] = value
+        group.create_dataset(name if index == 0 else f"{name}_{index}", data=data)
+
+
+def show_paths(keys):
+    """print the hierarchy of the (sorted) keys, one line per group or dataset"""
+    print('/')
+    shown = set()
+    for key in keys:
+        parts = key.split('/')[1:]
+        for n in range(1, len(parts) + 1):
+            path = '/'.join(parts[:n])
+            if path not in shown:
+                shown.add(path)
+                print('    ' * n + parts[n - 1])
+
+
+def nexus_from_dictionary(output_fname, md, show_tree=False, scalars=None,
+                          compound_name="metadata"):
     """
     convert a dictionary to nexus fileformat;
+
+    The keys are sorted by group, so the keys of a group are next to each
+    other, and written in one pass without recursion; the groups are created once with
+    ``require_group``.  A key that is also the parent of other keys is a group,
+    its value is not written.
     Args:
         output_fname: filename for the output file; it will overwrite
             any existing files;
         md: the dictionary that contains the data; the keys are defined in the
             nexus file format;
         show_tree: [True, False] to show the hierarch tree or not;
+        scalars: [None, "attributes", "compound"] write small scalars (numbers
+            and strings) as datasets, as attributes of their group (dense
+            attribute storage) or as compound datasets, one per group unless
+            its fields exceed the object header (see ``_write_compound``);
+        compound_name: name of the compound dataset of the scalars of a group;
     Return:
         None
 
@@ -40,29 +94,49 @@ def nexus_from_dictionary(output_fname, md, show_tree=False):
     # deal with empty dictionary
     if not md:
         return
-
-    nx_tree = Tree()
-    nx_tree.create_node('root', '/')
-
-    for key in md.keys():
-        # parse the path and get ride of the starting empty string;
-        temp = key.split('/')[1:]
-        for n, x in enumerate(temp):
-            idf = '/' + '/'.join(temp[:n + 1])
-            parent = '/' + '/'.join(temp[:n])
-            # create branch if it doesn't exist
-            if idf not in nx_tree.is_branch(parent):
-                nx_tree.create_node(x, idf, parent=parent)
+    if scalars not in SCALAR_MODES:
+        raise ValueError(f"scalars must be one of {SCALAR_MODES}, not {scalars!r}")
+
+    # all groups, each path is walked up only until a known group
+    branches = set()
+    for key in md:
+        parent = _parent(key)
+        while parent != '/' and parent not in branches:
+            branches.add(parent)
+            parent = _parent(parent)
+    # the keys of a group next to each other
+    keys = sorted(md, key=lambda key: (_parent(key), key))
 
     if show_tree:
-        nx_tree.show()
+        show_paths(sorted(md))
 
+    output_fname = str(output_fname)
     if len(output_fname) < 3 or \
             output_fname[-3:] not in ['.h5', 'hdf', '.nx']:
         output_fname += '.nx'
 
-    with h5py.File(output_fname, 'w') as f:
-        create_nx_worker(f, nx_tree, '/', md)
+    # the HDF5 1.8 format keeps many attributes in dense storage (a B-tree) instead of
+    # the object header, which gets slow and eventually too large
+    libver = ('v108', 'latest') if scalars == "attributes" else None
+    with h5py.File(output_fname, 'w', libver=libver) as f:
+        for parent, group_keys in itertools.groupby(keys, key=_parent):
+            group = f.require_group(parent)
+            batched = []
+            for key in group_keys:
+                if key in branches:
+                    logger.warning("'%s' is a group, its value is not written", key)
+                    continue
+                name = key[len(parent):].lstrip('/')
+                value = md[key]
+                if scalars is not None and _is_scalar(value):
+                    batched.append((name, value))
+                else:
+                    group.create_dataset(name, data=value)
+            if scalars == "attributes":
+                for name, value in batched:
+                    group.attrs[name] = value
+            elif batched:
+                _write_compound(group, compound_name, batched)
 
 
 def example_1():
@@ -0,0 +1,23 @@
+import h5py
+import numpy as np
+
+from batch_converter import collect_inputs, convert_batch
+
+
+def test_batch_converter(tmp_path):
+    for i in range(3):
+        with h5py.File(tmp_path / f'A{i:03d}.hdf', 'w') as f:
+            f['/exchange/norm-0-g2'] = np.ones((8, 2))
+            f['/exchange/tau'] = np.arange(8)
+            f['/xpcs/dqmap'] = np.zeros((4, 4), dtype=int)
+    (tmp_path / 'broken.hdf').write_text('not an HDF5 file')
+
+    inputs = collect_inputs([str(tmp_path)])
+    assert len(inputs) == 4
+    summary = convert_batch(inputs, 'aps', output_dir=str(tmp_path / 'out'), workers=2)
+    assert summary['converted'] == 3
+    assert summary['failed'] == 1
+    assert summary['failures'][0]['input'].endswith('broken.hdf')
+    assert summary['files_per_second'] > 0
+    with h5py.File(tmp_path / 'out' / 'A001.nxs', 'r') as nx:
+        assert np.array_equal(nx['/entry/XPCS/data/g2'][()], np.ones((8, 2)))
@@ -0,0 +1,38 @@
+import h5py
+import pytest
+
+from benchmarks.bench_conversion import bench_conversion
+from benchmarks.bench_startup import bench_startup
+from benchmarks.synthetic_xpcs import MAKERS, SCALES
+
+
+@pytest.mark.parametrize('loader_id', sorted(MAKERS))
+def test_bench_conversion(tmp_path, loader_id):
+    source = tmp_path / f'{loader_id}.hdf'
+    MAKERS[loader_id](source, **SCALES['tiny'])
+
+    records = bench_conversion(source, tmp_path / 'out.nxs', loader_id)
+
+    stages = [r['stage'] for r in records]
+    assert 'create_xpcs_group' in stages and 'load:create_xpcs_group' in stages
+    for record in records:
+        assert record['seconds'] >= 0
+        assert record['peak_rss_bytes'] > 0
+        assert 'bytes_written' in record
+    with h5py.File(tmp_path / 'out.nxs', 'r') as f:
+        assert f['/entry/XPCS/twotime/two_time_corr_func'].shape == (4, 32, 32)
+
+
+def test_bench_startup(tmp_path):
+    MAKERS['aps'](tmp_path / 'aps.hdf', **SCALES['tiny'])
+
+    records = {r['case']: r for r in bench_startup(tmp_path / 'aps.hdf', tmp_path / 'out.nxs', 'aps', repeat=1)}
+
+    # the API imports the standard library only, a conversion with SI units needs no pint
+    assert records['import_api']['modules'] == []
+    assert records['import_batch']['modules'] == []
+    assert records['convert']['modules'] == ['numpy', 'h5py']
+    # about 0.04 s here, generous bound for slow machines
+    assert records['import_api']['seconds'] - records['python']['seconds'] < 0.3
+    with h5py.File(tmp_path / 'out.nxs', 'r') as f:
+        assert f['/entry/instrument/detector/count_time'].attrs['units'] == 's'
@@ -0,0 +1,80 @@
+import os
+
+import h5py
+import numpy as np
+
+from batch_converter import collect_inputs, convert_batch
+from conversion_cache import ConversionCache
+from simple_converter import convert_file, output_options
+
+
+def _input(filename, value=1.0):
+    with h5py.File(filename, 'w') as f:
+        f['/exchange/norm-0-g2'] = np.full((8, 2), value)
+        f['/exchange/tau'] = np.arange(8)
+
+
+def _touch(filename):
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_convert_file_with_cache(tmp_path):
+    _input(tmp_path / 'A.hdf')
+    output = tmp_path / 'A.nxs'
+    with ConversionCache(tmp_path / 'cache.sqlite') as cache:
+        assert convert_file(tmp_path / 'A.hdf', output, 'aps', cache=cache)
+        assert not convert_file(tmp_path / 'A.hdf', output, 'aps', cache=cache)
+        # other options, other output
+        assert convert_file(tmp_path / 'A.hdf', output, 'aps', two_time_storage='packed', cache=cache)
+        assert not convert_file(tmp_path / 'A.hdf', output, 'aps', two_time_storage='packed', cache=cache)
+        # output deleted
+        os.remove(output)
+        assert convert_file(tmp_path / 'A.hdf', output, 'aps', two_time_storage='packed', cache=cache)
+        # input changed
+        _input(tmp_path / 'A.hdf', 2.0)
+        _touch(tmp_path / 'A.hdf')
+        assert convert_file(tmp_path / 'A.hdf', output, 'aps', two_time_storage='packed', cache=cache)
+        assert len(cache) == 1
+    # persistent, but not for another converter version
+    with ConversionCache(tmp_path / 'cache.sqlite') as cache:
+        assert not convert_file(tmp_path / 'A.hdf', output, 'aps', two_time_storage='packed', cache=cache)
+    with ConversionCache(tmp_path / 'cache.sqlite', version='next') as cache:
+        assert convert_file(tmp_path / 'A.hdf', output, 'aps', two_time_storage='packed', cache=cache)
+
+
+def test_digest_of_touched_input(tmp_path):
+    _input(tmp_path / 'A.hdf')
+    output = tmp_path / 'A.nxs'
+    with ConversionCache(tmp_path / 'cache.sqlite', digest='sha256') as cache:
+        assert convert_file(tmp_path / 'A.hdf', output, 'aps', cache=cache)
+        _touch(tmp_path / 'A.hdf')  # same content
+        assert cache.is_current(tmp_path / 'A.hdf', output, 'aps', **_defaults())
+        with open(tmp_path / 'A.hdf', 'r+b') as f:  # same size, other content
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 0xff]))
+        _touch(tmp_path / 'A.hdf')
+        assert not cache.is_current(tmp_path / 'A.hdf', output, 'aps', **_defaults())
+
+
+def _defaults():
+    return output_options()
+
+
+def test_incremental_batch(tmp_path):
+    for i in range(3):
+        _input(tmp_path / f'A{i:03d}.hdf')
+    inputs = collect_inputs([str(tmp_path)])
+    with ConversionCache(tmp_path / 'cache.sqlite') as cache:
+        summary = convert_batch(inputs, 'aps', output_dir=str(tmp_path / 'out'), workers=1, cache=cache)
+        assert (summary['converted'], summary['skipped']) == (3, 0)
+        summary = convert_batch(inputs, 'aps', output_dir=str(tmp_path / 'out'), workers=1, cache=cache)
+        assert (summary['converted'], summary['skipped']) == (0, 3)
+        _input(tmp_path / 'A001.hdf', 5.0)
+        _touch(tmp_path / 'A001.hdf')
+        summary = convert_batch(inputs, 'aps', output_dir=str(tmp_path / 'out'), workers=2, cache=cache)
+        assert (summary['converted'], summary['skipped']) == (1, 2)
+    with h5py.File(tmp_path / 'out' / 'A001.nxs', 'r') as nx:
+        assert np.array_equal(nx['/entry/XPCS/data/g2'][()], np.full((8, 2), 5.0))
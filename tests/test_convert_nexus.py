@@ -0,0 +1,64 @@
+import time
+
+import h5py
+import numpy as np
+
+from tests.convert_nexus import nexus_from_dictionary
+from tests.nexus_map import md
+
+
+def test_nexus_from_dictionary(tmp_path):
+    nexus_from_dictionary(tmp_path / 'out.nx', md)
+    with h5py.File(tmp_path / 'out.nx', 'r') as f:
+        for key, value in md.items():
+            if isinstance(value, str):
+                assert f[key][()].decode() == value
+            else:
+                assert np.array_equal(f[key][()], value)
+
+
+def test_nexus_from_dictionary_batched_scalars(tmp_path):
+    metadata = {'/entry/a/b/c': np.arange(3), '/entry/a/x': 1.5, '/entry/a/name': 'run',
+                '/entry/a/b': 7, '/entry/z': 2}
+    nexus_from_dictionary(tmp_path / 'attrs.nx', metadata, scalars='attributes')
+    with h5py.File(tmp_path / 'attrs.nx', 'r') as f:
+        assert dict(f['/entry/a'].attrs) == {'x': 1.5, 'name': 'run'}
+        assert f['/entry'].attrs['z'] == 2
+        assert list(f['/entry/a/b/c'][()]) == [0, 1, 2]  # /entry/a/b is a group
+
+    nexus_from_dictionary(tmp_path / 'compound.nx', metadata, scalars='compound')
+    with h5py.File(tmp_path / 'compound.nx', 'r') as f:
+        row = f['/entry/a/metadata'][()]
+        assert row['x'] == 1.5 and row['name'].decode() == 'run'
+        assert f['/entry/metadata'][()]['z'] == 2
+
+
+def test_nexus_from_dictionary_is_linear(tmp_path):
+    metadata = {f'/entry/md/group_{i // 100}/field_{i}': i for i in range(20000)}
+    start = time.perf_counter()
+    nexus_from_dictionary(tmp_path / 'large.nx', metadata, scalars='compound')
+    assert time.perf_counter() - start < 10
+    with h5py.File(tmp_path / 'large.nx', 'r') as f:
+        assert len(f['/entry/md']) == 200
+        assert f['/entry/md/group_7/metadata'][()]['field_789'] == 789
+
+
+def test_nexus_from_dictionary_large_group(tmp_path):
+    metadata = {f'/entry/md/a_long_field_name_{i}': i for i in range(10000)}
+    metadata['/entry/md/title'] = 'run'
+    for scalars in ('attributes', 'compound'):
+        start = time.perf_counter()
+        nexus_from_dictionary(tmp_path / f'{scalars}.nx', metadata, scalars=scalars)
+        assert time.perf_counter() - start < 10
+    with h5py.File(tmp_path / 'attributes.nx', 'r') as f:
+        assert len(f['/entry/md'].attrs) == 10001
+        assert f['/entry/md'].attrs['a_long_field_name_9999'] == 9999
+    with h5py.File(tmp_path / 'compound.nx', 'r') as f:
+        md = f['/entry/md']
+        assert len(md) > 1 and set(md) == {'metadata'} | {f'metadata_{i}' for i in range(1, len(md))}
+        fields = {}
+        for ds in md.values():
+            row = ds[()]
+            fields.update((name, row[name]) for name in row.dtype.names)
+        assert len(fields) == 10001
+        assert fields['a_long_field_name_1234'] == 1234 and fields['title'].decode() == 'run'
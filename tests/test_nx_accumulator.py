@@ -0,0 +1,55 @@
+import h5py
+import numpy as np
+import pytest
+
+from creator.nx_accumulator_xpcs import FrameAccumulator
+from creator.nx_creator_xpcs import NXCreator
+
+
+def test_accumulator_resume(tmp_path):
+    filename = tmp_path / 'out.nxs'
+    stack = np.random.default_rng(8).poisson(2, (50, 6, 7)).astype(np.uint16)
+
+    accumulator = FrameAccumulator(filename, (6, 7), checkpoint_every=10, publish_every=20)
+    for start in range(0, 35, 5):
+        accumulator.add(stack[start:start + 5])
+    # "crash" after 35 frames: the last checkpoint holds 30
+    with h5py.File(filename, 'r') as f:
+        published = f['/entry/SAXS_2D/data/I']
+        assert published.attrs['frames'] == 20
+        assert np.allclose(published[()], stack[:20].mean(axis=0))
+
+    resumed = FrameAccumulator(filename, (6, 7), checkpoint_every=10)
+    assert resumed.frames == 30
+    for frame in stack[resumed.frames:]:
+        resumed.add(frame)
+    result = resumed.finalize()
+    assert np.allclose(result['frame_sum'], stack.sum(axis=0))
+
+    with h5py.File(filename, 'r') as f:
+        assert np.allclose(f['/entry/XPCS/data/frame_average'][()], stack.mean(axis=0))
+        assert np.allclose(f['/entry/SAXS_2D/data/I'][()], stack.mean(axis=0))
+        assert f['/entry/XPCS/accumulator'].attrs['NX_class'] == 'NXcollection'
+        # written by the creator
+        assert f['/entry/SAXS_2D/data/I'].attrs['units'] == 'au'
+        assert f['/entry/XPCS/data/frame_sum'].attrs['target'] == '/entry/XPCS/data/frame_sum'
+
+    # the creator adds the other results to the groups of the accumulator
+    creator = NXCreator(filename)
+    creator.entry_group_name = '/entry'
+    with pytest.raises(ValueError):
+        creator.create_xpcs_group(g2=np.ones((4, 2)))
+    creator = NXCreator(filename, reuse_groups=True)
+    creator.entry_group_name = '/entry'
+    creator.create_xpcs_group(g2=np.ones((4, 2)))
+    with h5py.File(filename, 'r') as f:
+        assert '/entry/XPCS/data/g2' in f and '/entry/XPCS/data/frame_sum' in f
+
+
+def test_accumulator_nan_pixels(tmp_path):
+    frames = np.ones((4, 2, 2))
+    frames[0, 0, 0] = np.nan
+    accumulator = FrameAccumulator(tmp_path / 'out.nxs', (2, 2), checkpoint_every=None)
+    accumulator.add(frames)
+    assert accumulator.counts[0, 0] == 3
+    assert np.allclose(accumulator.frame_average, 1)
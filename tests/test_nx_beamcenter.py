@@ -0,0 +1,49 @@
+import h5py
+import numpy as np
+import pytest
+
+from benchmarks.synthetic_xpcs import SCALES, make_aps_file
+from creator.nx_beamcenter_xpcs import find_beam_center, radial_variance
+from simple_converter import convert_file
+
+
+def _rings(shape, x, y, seed=0):
+    rows, columns = np.indices(shape)
+    r = np.hypot(columns - x, rows - y)
+    image = 1e4 * np.exp(-r / 60) * (1.2 + np.cos(2 * np.pi * r / 23)) + 1
+    return np.random.default_rng(seed).poisson(image).astype(np.float32)
+
+
+def _mask(shape, x, y):
+    rows, columns = np.indices(shape)
+    mask = np.ones(shape, dtype=np.int32)
+    mask[:, shape[1] // 3:shape[1] // 3 + 6] = 0  # module gap
+    mask[np.hypot(columns - x, rows - y) < 8] = 0  # beam stop
+    return mask
+
+
+@pytest.mark.parametrize('shape, center', [((256, 300), (140.3, 111.7)), ((512, 512), (20.6, 480.2))])
+def test_find_beam_center(shape, center):
+    image = _rings(shape, *center)
+    x, y = find_beam_center(image, _mask(shape, *center))
+    assert abs(x - center[0]) < 0.5 and abs(y - center[1]) < 0.5
+    assert radial_variance(image, center) < radial_variance(image, (center[0] + 3, center[1]))
+
+
+def test_find_beam_center_outside_of_detector():
+    image = _rings((256, 256), -30.5, 100.2)
+    x, y = find_beam_center(image, guess=(0, 100), radius=60)
+    assert abs(x + 30.5) < 0.5 and abs(y - 100.2) < 0.5
+
+
+def test_convert_with_beam_center(tmp_path):
+    make_aps_file(tmp_path / 'aps.hdf', **SCALES['tiny'])
+    with h5py.File(tmp_path / 'aps.hdf', 'a') as f:
+        shape = f['/exchange/pixelSum'].shape
+        f['/exchange/pixelSum'][...] = _rings(shape, 20.4, 17.8)
+    convert_file(tmp_path / 'aps.hdf', tmp_path / 'out.nxs', 'aps', find_beam_center=True)
+    with h5py.File(tmp_path / 'out.nxs', 'r') as f:
+        detector = f['/entry/instrument/detector']
+        assert abs(detector['beam_center_x'][()] - 20.4) < 0.5
+        assert abs(detector['beam_center_y'][()] - 17.8) < 0.5
+        assert detector['beam_center_x'].attrs['units'] == 'pixel'
@@ -0,0 +1,77 @@
+import tracemalloc
+
+import h5py
+import numpy as np
+import pytest
+
+from creator.nx_c2t_xpcs import TwoTimeSource, tile_size
+from creator.nx_creator_xpcs import NXCreator
+from creator.nx_twotime_xpcs import TwoTimeReader
+
+
+def _c2t(stack, roi_map):
+    """two-time matrices straight from the definition"""
+    c2t = []
+    for roi in range(1, roi_map.max() + 1):
+        a = stack[:, roi_map == roi].astype(float)
+        c2t.append((a @ a.T / a.shape[1]) / np.outer(a.mean(axis=1), a.mean(axis=1)))
+    return np.array(c2t)
+
+
+def test_tile_size():
+    assert tile_size(1000, 20000, max_bytes=64 * 1024 ** 2) % 64 == 0
+    edge = tile_size(10 ** 6, 20000, max_bytes=64 * 1024 ** 3)
+    assert 2 * edge * 10 ** 6 * 8 + edge ** 2 * 8 <= 64 * 1024 ** 3
+    assert tile_size(10, 50) == 50
+    # the result tiles of all ROIs count
+    assert tile_size(1000, 20000, max_bytes=64 * 1024 ** 2, n_q=100) < tile_size(1000, 20000, 64 * 1024 ** 2)
+
+
+@pytest.mark.parametrize('storage', ['full', 'tiles', 'packed'])
+def test_two_time_source(tmp_path, storage):
+    rng = np.random.default_rng(3)
+    roi_map = np.zeros((6, 8), dtype=int)
+    roi_map[:3], roi_map[3:] = 1, 2
+    with h5py.File(tmp_path / 'frames.h5', 'w') as f:
+        f['frames'] = rng.poisson(4, (50, 6, 8)).astype(np.uint16)
+        expected = _c2t(f['frames'][()], roi_map)
+
+    with h5py.File(tmp_path / 'frames.h5', 'r') as f, \
+            NXCreator(tmp_path / 'out.nxs', max_block_bytes=1024, two_time_storage=storage) as creator:
+        source = TwoTimeSource(f['frames'], roi_map, tile=16)
+        assert np.allclose(source.read(), expected, rtol=1e-5)
+        assert np.allclose(source[1, 10:20], expected[1, 10:20], rtol=1e-5)
+        creator.init_file()
+        creator.create_entry_group()
+        creator.create_xpcs_group(two_time_corr_func=source, dynamic_roi_map=roi_map)
+
+    with h5py.File(tmp_path / 'out.nxs', 'r') as f:
+        ds = f['/entry/XPCS/twotime/two_time_corr_func']
+        reader = TwoTimeReader(ds)
+        for q in range(2):
+            assert np.allclose(reader[q], expected[q], rtol=1e-5)
+        if storage != 'packed':
+            assert ds.chunks == (1, 16, 16)
+        if storage == 'tiles':
+            assert ds.attrs['populated_elements'] == 'upper_half'
+            assert np.all(ds[0, 16:32, :16] == 0)  # lower tiles are never written
+
+
+@pytest.mark.parametrize('storage', ['tiles', 'packed'])
+def test_two_time_source_memory(tmp_path, storage):
+    roi_map = np.zeros((128, 128), dtype=int)
+    roi_map[40:80, 40:60], roi_map[40:80, 60:80] = 1, 2
+    with h5py.File(tmp_path / 'frames.h5', 'w') as f:
+        f['frames'] = np.random.default_rng(3).poisson(4, (400, 128, 128)).astype(np.uint16)
+
+    budget = 512 * 1024  # a tenth of the frames
+    with h5py.File(tmp_path / 'frames.h5', 'r') as f, \
+            NXCreator(tmp_path / 'out.nxs', max_block_bytes=budget, two_time_storage=storage) as creator:
+        creator.init_file()
+        creator.create_entry_group()
+        source = TwoTimeSource(f['frames'], roi_map, max_bytes=budget)
+        tracemalloc.start()
+        creator.create_xpcs_group(two_time_corr_func=source)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    assert peak < 1.5 * budget
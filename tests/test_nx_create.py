@@ -1,4 +1,5 @@
 import h5py
+import numpy as np
 from creator.nx_creator_xpcs import NXCreator
 
 
@@ -53,3 +54,144 @@ md = {"title": "title",
       "Instrument": instrument_md
       }
 
+
+
+def _write_example(creator):
+    creator.init_file()
+    creator.create_entry_group(title="session")
+    creator.create_xpcs_group(g2=np.ones((8, 2)),
+                              g2_units='a.u.',
+                              delay_difference=np.arange(8),
+                              delay_difference_units='s',
+                              dynamic_roi_map=np.zeros((4, 4), dtype=int))
+    creator.create_saxs_1d_group(I=np.ones(4), I_units='a.u.', Q=np.arange(4), Q_units='1/angstrom')
+    creator.create_saxs_2d_group(I=np.ones((4, 4)))
+    creator.create_instrument_group(distance=4.0, distance_units='m', energy=10.0, energy_units='keV')
+
+
+def test_nx_session(tmp_path):
+    session_file = tmp_path / 'session.nxs'
+    single_file = tmp_path / 'single.nxs'
+    with NXCreator(session_file) as creator:
+        _write_example(creator)
+        # the session keeps one handle open until the end
+        assert creator._file is not None
+    assert creator._file is None
+    _write_example(NXCreator(single_file))
+
+    with h5py.File(session_file, 'r') as session, h5py.File(single_file, 'r') as single:
+        for path in ('/entry/XPCS/data/g2',
+                     '/entry/XPCS/instrument/masks/dynamic_roi_map',
+                     '/entry/SAXS_1D/data/Q',
+                     '/entry/SAXS_2D/data/I',
+                     '/entry/instrument/detector/distance'):
+            assert path in session
+            assert np.array_equal(session[path][()], single[path][()])
+        assert session['/entry/instrument/detector/distance'].attrs['units'] == 'm'
+
+
+def test_nx_streamed_twotime(tmp_path):
+    from creator.nx_stream_xpcs import StackedSource
+
+    source_file = tmp_path / 'source.hdf'
+    c2t = np.random.uniform(0, 1, (3, 16, 16))
+    with h5py.File(source_file, 'w') as source:
+        for i, c in enumerate(c2t):
+            source.create_dataset(f'exchange/C2T_all/c2t_{i:05d}', data=c)
+
+    with h5py.File(source_file, 'r') as source:
+        group = source['exchange/C2T_all']
+        stack = StackedSource(group[key] for key in group)
+        assert stack.shape == (3, 16, 16)
+        # one block must never exceed the budget (4 rows of 16 float64 values)
+        blocks = list(stack.iter_blocks(max_bytes=4 * 16 * 8))
+        assert len(blocks) == 12
+        assert max(block.nbytes for _, block in blocks) <= 4 * 16 * 8
+
+        with NXCreator(tmp_path / 'streamed.nxs', max_block_bytes=4 * 16 * 8) as creator:
+            creator.init_file()
+            creator.create_entry_group()
+            creator.create_xpcs_group(two_time_corr_func=stack, two_time_corr_units='a.u.')
+
+    with h5py.File(tmp_path / 'streamed.nxs', 'r') as nx:
+        assert np.array_equal(nx['/entry/XPCS/twotime/two_time_corr_func'][()], c2t)
+
+
+def test_nx_layout_policy(tmp_path):
+    from creator.nx_layout_xpcs import LayoutPolicy
+
+    policy = LayoutPolicy(min_compress_bytes=1024)
+    assert policy.dataset_options("g2", (8, 2), "f8") == {}
+    assert policy.dataset_options("two_time_corr_func", (4, 64, 64), "f4")["chunks"] == (1, 64, 64)
+    assert policy.dataset_options("g2", (200, 5), "f8")["chunks"] == (200, 1)
+    assert policy.dataset_options("dynamic_roi_map", (64, 64), "i4")["compression"] == "gzip"
+
+    c2t = np.random.uniform(0, 1, (4, 64, 64)).astype("f4")
+    with NXCreator(tmp_path / 'layout.nxs', layout=policy) as creator:
+        creator.init_file()
+        creator.create_entry_group()
+        creator.create_xpcs_group(two_time_corr_func=c2t, dynamic_roi_map=np.ones((64, 64), dtype="i4"))
+    with h5py.File(tmp_path / 'layout.nxs', 'r') as nx:
+        ds = nx['/entry/XPCS/twotime/two_time_corr_func']
+        assert ds.chunks == (1, 64, 64)
+        assert ds.compression == "lzf"
+        assert np.array_equal(ds[()], c2t)
+
+
+def test_nx_reference_mode(tmp_path):
+    from creator.nx_reference_xpcs import materialize
+    from loader.nx_loader_aps import APSLoader
+
+    c2t = np.random.uniform(0, 1, (2, 32, 32))
+    with h5py.File(tmp_path / 'source.hdf', 'w') as source:
+        source['/xpcs/mask'] = np.ones((64, 64), dtype="u1")
+        for i, c in enumerate(c2t):
+            source[f'exchange/C2T_all/c2t_{i:05d}'] = c
+
+    with APSLoader(tmp_path / 'source.hdf') as loader:
+        md_xpcs = loader.xpcs_md()
+        with NXCreator(tmp_path / 'reference.nxs', reference_mode=True) as creator:
+            creator.init_file()
+            creator.create_entry_group()
+            creator.create_xpcs_group(two_time_corr_func=md_xpcs['twotime'],
+                                      two_time_corr_units='a.u.',
+                                      mask=md_xpcs['mask'])
+
+    with h5py.File(tmp_path / 'reference.nxs', 'r') as nx:
+        assert nx['/entry/XPCS/twotime/two_time_corr_func'].is_virtual
+        assert np.array_equal(nx['/entry/XPCS/twotime/two_time_corr_func'][1], c2t[1])
+
+    materialize(tmp_path / 'reference.nxs', tmp_path / 'archive.nxs')
+    (tmp_path / 'source.hdf').unlink()
+
+    with h5py.File(tmp_path / 'archive.nxs', 'r') as nx:
+        c2t_ds = nx['/entry/XPCS/twotime/two_time_corr_func']
+        assert not c2t_ds.is_virtual
+        assert c2t_ds.attrs['units'] == 'a.u.'
+        assert np.array_equal(c2t_ds[()], c2t)
+        assert np.array_equal(nx['/entry/XPCS/instrument/masks/mask'][()], np.ones((64, 64)))
+        assert nx['/entry'].attrs['NX_class'] == 'NXentry'
+
+
+def test_nx_two_time_half_storage(tmp_path):
+    from creator.nx_twotime_xpcs import TwoTimeReader, packed_size
+
+    c2t = np.random.uniform(0, 1, (2, 40, 40))
+    c2t = c2t + c2t.transpose(0, 2, 1)
+    for storage, half in (("packed", "upper"), ("packed", "lower"), ("tiles", "upper")):
+        filename = tmp_path / f'{storage}_{half}.nxs'
+        with NXCreator(filename, max_block_bytes=7 * 40 * 8,
+                       two_time_storage=storage, two_time_half=half) as creator:
+            creator.init_file()
+            creator.create_entry_group()
+            creator.create_xpcs_group(two_time_corr_func=c2t, two_time_corr_units='a.u.', baseline_reference=1)
+        with h5py.File(filename, 'r') as nx:
+            ds = nx['/entry/XPCS/twotime/two_time_corr_func']
+            assert ds.attrs['populated_elements'] == f'{half}_half'
+            assert ds.attrs['time_origin_location'] == 'upper_left'
+            if storage == "packed":
+                assert ds.shape == (2, packed_size(40))
+            reader = TwoTimeReader(ds)
+            assert len(reader) == 2
+            for q in range(2):
+                assert np.allclose(reader[q], c2t[q])
@@ -0,0 +1,52 @@
+import os
+
+import h5py
+import numpy as np
+
+from benchmarks.synthetic_xpcs import make_aps_file
+from creator.nx_library_xpcs import MAP_NAME, MapLibrary
+from creator.nx_reference_xpcs import materialize
+from creator.nx_series_xpcs import DIGEST_ATTR
+from simple_converter import convert_file
+
+
+def test_library_insert_is_idempotent(tmp_path):
+    library = MapLibrary(tmp_path / 'maps', max_bytes=64)
+    roi = np.arange(100, dtype=np.int32).reshape(10, 10)
+    digest = library.insert(roi)
+    assert digest in library
+    assert library.insert(roi.copy()) == digest
+    assert library.insert(roi.T) != digest
+    assert len(library) == 2
+    np.testing.assert_array_equal(library.read(digest), roi)
+    with h5py.File(library.path(digest), 'r') as f:
+        assert f[MAP_NAME].attrs[DIGEST_ATTR] == digest
+    assert not [name for name in os.listdir(os.path.dirname(library.path(digest))) if name.endswith('.tmp')]
+
+
+def test_conversions_share_the_maps(tmp_path):
+    for seed in range(2):
+        make_aps_file(tmp_path / f'scan_{seed}.hdf', detector_shape=(256, 256), two_time=False, seed=seed)
+    convert_file(tmp_path / 'scan_0.hdf', tmp_path / 'copied.nxs', 'aps')
+    for seed in range(2):
+        convert_file(tmp_path / f'scan_{seed}.hdf', tmp_path / f'scan_{seed}.nxs', 'aps',
+                     map_library=tmp_path / 'maps')
+    # mask, dynamic_roi_map and static_roi_map, once for both files
+    assert len(MapLibrary(tmp_path / 'maps')) == 3
+    assert os.path.getsize(tmp_path / 'scan_0.nxs') < 0.5 * os.path.getsize(tmp_path / 'copied.nxs')
+
+    masks = '/entry/XPCS/instrument/masks'
+    with h5py.File(tmp_path / 'copied.nxs', 'r') as copied, h5py.File(tmp_path / 'scan_1.nxs', 'r') as f:
+        ds = f[f'{masks}/dynamic_roi_map']
+        assert ds.is_virtual
+        assert ds.attrs['target'] == ds.name
+        with h5py.File(tmp_path / 'scan_0.nxs', 'r') as first:
+            assert first[ds.name].attrs[DIGEST_ATTR] == ds.attrs[DIGEST_ATTR]
+        for name in ('mask', 'dynamic_roi_map', 'static_roi_map'):
+            np.testing.assert_array_equal(f[f'{masks}/{name}'][()], copied[f'{masks}/{name}'][()])
+        assert not f[f'{masks}/dynamic_q_list'].is_virtual
+
+    materialize(tmp_path / 'scan_1.nxs', tmp_path / 'archive.nxs')
+    with h5py.File(tmp_path / 'archive.nxs', 'r') as f:
+        assert not f[f'{masks}/dynamic_roi_map'].is_virtual
+        assert f[f'{masks}/dynamic_roi_map'].shape == (256, 256)
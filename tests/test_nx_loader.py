@@ -0,0 +1,54 @@
+import h5py
+import numpy as np
+
+from creator.nx_creator_xpcs import NXCreator
+from loader.nx_loader_aps import APSLoader
+from loader.nx_loader_nslsii import NSLSLoader
+
+
+def test_aps_loader_lazy_fields(tmp_path):
+    with h5py.File(tmp_path / 'aps.hdf', 'w') as f:
+        f['/exchange/norm-0-g2'] = np.ones((8, 2))
+        f['/xpcs/dqmap'] = np.arange(16).reshape(4, 4)
+        f['/exchange/C2T_all/c2t_00001'] = np.eye(8)
+        f['/exchange/C2T_all/c2t_00002'] = np.eye(8)
+
+    with APSLoader(tmp_path / 'aps.hdf') as loader:
+        md_xpcs = loader.xpcs_md()
+        assert md_xpcs['g2'].shape == (8, 2)
+        assert md_xpcs['g2'].units == 'a.u.'
+        assert md_xpcs['g2_stderr'] is None
+        assert loader.describe()['xpcs_md']['twotime'][0] == (2, 8, 8)
+        assert loader.nbytes() == (16 + 16 + 128) * 8
+
+        with NXCreator(tmp_path / 'aps.nxs') as creator:
+            creator.init_file()
+            creator.create_entry_group()
+            creator.create_xpcs_group(g2=md_xpcs['g2'],
+                                      g2_units=md_xpcs['g2_units'],
+                                      dynamic_roi_map=md_xpcs['dynamic_roi_map'])
+
+    with h5py.File(tmp_path / 'aps.nxs', 'r') as nx:
+        assert np.array_equal(nx['/entry/XPCS/instrument/masks/dynamic_roi_map'][()],
+                              np.arange(16).reshape(4, 4))
+        assert nx['/entry/XPCS/data/g2'].attrs['units'] == 'a.u.'
+
+
+def test_nsls_loader_lazy_fields(tmp_path):
+    with h5py.File(tmp_path / 'nsls.h5', 'w') as f:
+        f['g2'] = np.ones((8, 3))
+        qval_dict = f.create_group('qval_dict')
+        for i in range(3):
+            qval_dict.attrs[str(i)] = [0.001 * (i + 1), 0.0]
+        md = f.create_group('md')
+        md.attrs['detector'] = 'eiger4m'
+        md.attrs['detector_distance'] = 16.0
+
+    with NSLSLoader(tmp_path / 'nsls.h5') as loader:
+        md_xpcs = loader.xpcs_md()
+        assert md_xpcs['g2'].source is not None
+        assert np.allclose(md_xpcs['dynamic_q_list'].read(), [0.001, 0.002, 0.003])
+        md_instrument = loader.instrument_md()
+        assert md_instrument['distance'].read() == 16.0
+        assert md_instrument['distance'].units == 'm'
+        assert md_instrument['energy'] is None
@@ -0,0 +1,65 @@
+import h5py
+import numpy as np
+
+from creator.nx_creator_xpcs import NXCreator
+from creator.nx_multitau_xpcs import delays, multi_tau, write_multi_tau
+
+
+def _g2(stack, roi_map, tau):
+    """g2 of every ROI at delay tau, straight from the definition"""
+    g2 = []
+    for roi in range(1, roi_map.max() + 1):
+        pixels = stack[:, roi_map == roi]
+        past, future = pixels[:len(pixels) - tau], pixels[tau:]
+        g2.append((past * future).mean() / (past.mean() * future.mean()))
+    return np.array(g2)
+
+
+def test_multi_tau_matches_definition():
+    rng = np.random.default_rng(1)
+    stack = rng.poisson(5, (100, 8, 10)).astype(np.uint16)
+    roi_map = np.zeros((8, 10), dtype=int)
+    roi_map[:4, :5], roi_map[:4, 5:], roi_map[4:] = 1, 2, 3
+
+    result = multi_tau(stack, roi_map, buf=4, max_bytes=8 * 10 * 2 * 7)
+    tau = result['delay_difference']
+    assert np.array_equal(tau, delays(100, buf=4))
+    assert result['g2'].shape == result['g2_stderr'].shape == (len(tau), 3)
+    for i, t in enumerate(tau[:3]):  # level 0
+        assert np.allclose(result['g2'][i], _g2(stack.astype(float), roi_map, t))
+    # level 1 correlates averages of two frames
+    pairs = (stack[0:100:2].astype(float) + stack[1:100:2]) / 2
+    assert tau[3] == 4
+    assert np.allclose(result['g2'][3], _g2(pairs, roi_map, 2))
+
+    threaded = multi_tau(stack, roi_map, buf=4, workers=3)
+    assert np.allclose(threaded['g2'], result['g2'])
+
+
+def test_write_multi_tau(tmp_path):
+    rng = np.random.default_rng(2)
+    roi_map = np.zeros((16, 16), dtype=int)
+    roi_map[2:8], roi_map[8:14] = 1, 3  # ROI 2 is empty
+    with h5py.File(tmp_path / 'frames.h5', 'w') as f:
+        f['frames'] = rng.poisson(2, (64, 16, 16)).astype(np.uint32)
+
+    with h5py.File(tmp_path / 'frames.h5', 'r') as f, NXCreator(tmp_path / 'out.nxs') as creator:
+        creator.init_file()
+        creator.create_entry_group()
+        write_multi_tau(creator, f['frames'], roi_map, dynamic_q_list=[0.01, 0.02, 0.03],
+                        frame_time=0.5, workers=2)
+
+    with h5py.File(tmp_path / 'out.nxs', 'r') as f:
+        data = f['/entry/XPCS/data']
+        assert data['g2'].shape == data['G2_unnormalized'].shape == (len(delays(64)), 3)
+        assert np.isnan(data['g2'][:, 1]).all()
+        assert np.isfinite(data['g2'][:, 0]).all()
+        assert np.allclose(data['delay_difference'][()], delays(64) * 0.5)
+        assert data['delay_difference'].attrs['units'] == 's'
+
+
+def test_multi_tau_without_roi_pixels():
+    stack = np.ones((20, 4, 4), dtype=np.uint16)
+    result = multi_tau(stack, np.zeros((4, 4), dtype=int), buf=4, workers=2)
+    assert np.array_equal(result['delay_difference'], delays(20, buf=4))
+    assert result['g2'].shape == result['g2_stderr'].shape == (len(delays(20, buf=4)), 0)
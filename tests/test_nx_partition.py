@@ -0,0 +1,57 @@
+import numpy as np
+
+from creator.nx_partition_xpcs import LOG10, continuous_phi, detector_maps, partition, xpcs_partition_kwargs
+
+
+GEOMETRY = dict(distance=4.0, distance_units='m',
+                x_pixel_size=75.0, y_pixel_size=75.0, pixel_size_units='um',
+                beam_center_x=20.5, beam_center_y=30.0,
+                energy=10.0, energy_units='keV')
+
+
+def test_detector_maps():
+    maps = detector_maps((64, 48), **GEOMETRY)
+    assert maps['q'].shape == (64, 48)
+    assert maps['q'][30, 20] < maps['q'][0, 0]
+    assert np.allclose(maps['q'] ** 2, maps['qx'] ** 2 + maps['qy'] ** 2 + maps['qz'] ** 2)
+    assert np.allclose(maps['qr'], np.hypot(maps['qx'], maps['qy']))
+    # small angles: q ~ 4 pi / lambda * r / (2 L)
+    r = np.hypot(47 - 20.5, 63 - 30.0) * 75e-6
+    assert np.isclose(maps['q'][63, 47], 2 * np.pi / (12.398419843320026 / 10) * r / 4, rtol=1e-3)
+
+
+def test_partition_matches_loop():
+    maps = detector_maps((40, 50), **GEOMETRY)
+    mask = np.ones((40, 50), dtype=int)
+    mask[:5] = 0
+    result = partition(maps, mask, ('q', 'phi'), (6, 4), (LOG10, 1))
+
+    q, phi = maps['q'][mask != 0], continuous_phi(maps['phi'][mask != 0])
+    qspan, phispan = result.spans
+    assert np.isclose(qspan[0], q.min()) and np.isclose(qspan[-1], q.max())
+    assert np.allclose(np.diff(np.log10(qspan)), np.log10(qspan[1] / qspan[0]))
+    assert (result.roi_map[:5] == 0).all()
+    assert result.counts.sum() == mask.sum()
+    for n in range(6):
+        for m in range(4):
+            inq = (q >= qspan[n]) & ((q < qspan[n + 1]) | (n == 5))
+            inphi = (phi >= phispan[m]) & ((phi < phispan[m + 1]) | (m == 3))
+            pixels = inq & inphi
+            label = n * 4 + m + 1
+            assert pixels.sum() == result.counts[n, m] == (result.roi_map == label).sum()
+            if pixels.any():
+                assert np.isclose(result.mean[0, n, m], q[pixels].mean())
+
+
+def test_continuous_phi():
+    phi = np.array([170.0, 179.0, -179.0, -170.0])
+    assert np.allclose(continuous_phi(phi), [170, 179, 181, 190])
+    assert np.allclose(continuous_phi(np.array([-10.0, 0.0, 10.0])), [-10, 0, 10])
+
+
+def test_xpcs_partition_kwargs():
+    kwargs = xpcs_partition_kwargs((40, 50), snpt=(12, 1), dnpt=(3, 1), **GEOMETRY)
+    assert kwargs['static_roi_map'].max() == 12
+    assert kwargs['dynamic_roi_map'].max() == 3
+    assert np.all(np.diff(kwargs['static_q_list']) > 0)
+    assert kwargs['dynamic_q_list'].shape == kwargs['dynamic_phi_list'].shape == (3,)
@@ -0,0 +1,41 @@
+import h5py
+import numpy as np
+import pytest
+
+from creator.nx_pipeline_xpcs import PrefetchSource
+from creator.nx_stream_xpcs import StackedSource
+from simple_converter import convert_file
+
+
+def test_pipelined_conversion(tmp_path):
+    c2t = np.random.uniform(0, 1, (3, 64, 64))
+    with h5py.File(tmp_path / 'source.hdf', 'w') as f:
+        f['/exchange/norm-0-g2'] = np.random.uniform(0, 1, (8, 3))
+        f['/exchange/pixelSum'] = np.random.uniform(0, 1, (32, 32))
+        f['/measurement/instrument/detector/distance'] = 4000.0
+        for i, c in enumerate(c2t):
+            f[f'/exchange/C2T_all/c2t_{i:05d}'] = c
+
+    convert_file(tmp_path / 'source.hdf', tmp_path / 'sequential.nxs', 'aps')
+    convert_file(tmp_path / 'source.hdf', tmp_path / 'pipelined.nxs', 'aps', pipelined=True)
+
+    with h5py.File(tmp_path / 'sequential.nxs', 'r') as seq, h5py.File(tmp_path / 'pipelined.nxs', 'r') as pipe:
+        for path in ('/entry/XPCS/data/g2',
+                     '/entry/XPCS/twotime/two_time_corr_func',
+                     '/entry/SAXS_2D/data/I',
+                     '/entry/instrument/detector/distance'):
+            assert np.array_equal(seq[path][()], pipe[path][()])
+
+
+def test_prefetch_source_errors():
+    class Failing(StackedSource):
+        def iter_blocks(self, max_bytes):
+            yield from super().iter_blocks(max_bytes)
+            raise OSError("read error")
+
+    source = PrefetchSource(Failing([np.ones((4, 4))] * 2), depth=1)
+    blocks = []
+    with pytest.raises(OSError):
+        for selection, block in source.iter_blocks(max_bytes=4 * 8):
+            blocks.append(block)
+    assert len(blocks) == 8
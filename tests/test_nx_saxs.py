@@ -0,0 +1,45 @@
+import h5py
+import numpy as np
+
+from creator.nx_creator_xpcs import NXCreator
+from creator.nx_saxs_xpcs import saxs_1d, write_saxs_1d
+from creator.nx_sparse_xpcs import write_sparse
+
+
+def _expected(stack, roi_map, edges):
+    rois = range(1, roi_map.max() + 1)
+    I = np.array([stack[:, roi_map == roi].mean() for roi in rois])
+    I_partial = np.array([[stack[a:b, roi_map == roi].mean() for roi in rois]
+                          for a, b in zip(edges[:-1], edges[1:])])
+    return I, I_partial
+
+
+def test_saxs_1d(tmp_path):
+    stack = np.random.default_rng(7).poisson(3, (23, 10, 12)).astype(np.uint16)
+    roi_map = np.arange(120).reshape(10, 12) % 5  # label 0 unused
+    I, I_partial = _expected(stack.astype(float), roi_map, [0, 8, 15, 23])
+
+    for workers in (1, 3):
+        result = saxs_1d(stack, roi_map, slices=3, workers=workers, max_bytes=10 * 12 * 2 * 5)
+        assert np.allclose(result['I'], I)
+        assert np.allclose(result['I_partial'], I_partial)
+
+    with h5py.File(tmp_path / 'sparse.h5', 'w') as f:
+        sparse = write_sparse(f.create_group('events'), stack)
+        result = saxs_1d(sparse, roi_map, slices=3, max_bytes=1000)
+        assert np.allclose(result['I'], I)
+        assert np.allclose(result['I_partial'], I_partial)
+
+
+def test_write_saxs_1d(tmp_path):
+    stack = np.ones((20, 8, 8))
+    roi_map = np.repeat(np.arange(1, 5), 16).reshape(8, 8)
+    with NXCreator(tmp_path / 'out.nxs') as creator:
+        creator.init_file()
+        creator.create_entry_group()
+        write_saxs_1d(creator, stack, roi_map, static_q_list=[0.1, 0.2, 0.3, 0.4], slices=4)
+    with h5py.File(tmp_path / 'out.nxs', 'r') as f:
+        data = f['/entry/SAXS_1D/data']
+        assert np.allclose(data['I'][()], 1)
+        assert data['I_partial'].shape == (4, 4)
+        assert np.allclose(data['Q'][()], [0.1, 0.2, 0.3, 0.4])
@@ -0,0 +1,92 @@
+import os
+
+import h5py
+import numpy as np
+
+from benchmarks.synthetic_xpcs import make_aps_file
+from creator.nx_creator_xpcs import NXCreator
+from creator.nx_reference_xpcs import materialize
+from creator.nx_series_xpcs import DIGEST_ATTR, content_digest
+from creator.nx_validate_xpcs import validate
+from simple_converter import convert, convert_file, convert_series
+
+
+def _is_same(f, a, b):
+    return f[a].id == f[b].id
+
+
+def _relative(issue):
+    return issue.severity, issue.path.split('/', 2)[-1], issue.message
+
+
+def test_content_digest():
+    roi = np.arange(12).reshape(3, 4)
+    digest = content_digest(dict(dynamic_roi_map=roi, q=None))
+    assert digest == content_digest(dict(q=None, dynamic_roi_map=roi.copy()))
+    assert digest != content_digest(dict(dynamic_roi_map=roi.reshape(4, 3), q=None))
+    assert digest != content_digest(dict(dynamic_roi_map=roi.astype(np.int32), q=None))
+    # datasets are hashed block by block, like arrays
+    with h5py.File('digest.h5', 'w', driver='core', backing_store=False) as f:
+        f['roi'] = roi
+        assert content_digest(dict(dynamic_roi_map=f['roi'], q=None), max_bytes=16) == digest
+
+
+def test_series_shares_identical_groups(tmp_path):
+    inputs = []
+    for seed in range(3):
+        inputs.append(tmp_path / f'scan_{seed}.hdf')
+        make_aps_file(inputs[-1], detector_shape=(256, 256), two_time=False, seed=seed)
+    # a different q partition in the last scan
+    make_aps_file(tmp_path / 'other.hdf', detector_shape=(256, 256), n_q=6, two_time=False)
+
+    assert convert_series(inputs[:2], tmp_path / 'series.nxs', 'aps') == ['/entry_1', '/entry_2']
+    # appended in a second session
+    assert convert_series([inputs[2], tmp_path / 'other.hdf'], tmp_path / 'series.nxs', 'aps') == \
+        ['/entry_3', '/entry_4']
+    with h5py.File(tmp_path / 'series.nxs', 'r') as f:
+        assert _is_same(f, '/entry_1/XPCS/instrument/masks', '/entry_2/XPCS/instrument/masks')
+        assert _is_same(f, '/entry_1/XPCS/instrument/masks', '/entry_3/XPCS/instrument/masks')
+        assert not _is_same(f, '/entry_1/XPCS/instrument/masks', '/entry_4/XPCS/instrument/masks')
+        assert _is_same(f, '/entry_1/instrument', '/entry_4/instrument')
+        assert not _is_same(f, '/entry_1/XPCS/data/g2', '/entry_2/XPCS/data/g2')
+        assert DIGEST_ATTR in f['/entry_1/instrument'].attrs
+        assert f['/entry_3/XPCS/instrument/masks/dynamic_roi_map'].attrs['target'] == \
+            '/entry_1/XPCS/instrument/masks/dynamic_roi_map'
+
+    separate = 0
+    for index, filename in enumerate(inputs):
+        convert_file(filename, tmp_path / f'single_{index}.nxs', 'aps')
+        separate += os.path.getsize(tmp_path / f'single_{index}.nxs')
+    convert_series(inputs, tmp_path / 'three.nxs', 'aps')
+    # each entry of the series is as complete as a single file for the validator
+    single = {_relative(issue) for issue in validate(tmp_path / 'single_0.nxs')}
+    series = [_relative(issue) for issue in validate(tmp_path / 'three.nxs')]
+    assert set(series) == single
+    assert len(series) == 3 * len(single)
+    assert os.path.getsize(tmp_path / 'three.nxs') < 0.6 * separate
+
+
+def test_materialize_keeps_hard_links(tmp_path):
+    with NXCreator(tmp_path / 'series.nxs', share_identical=True) as creator:
+        creator.init_file()
+        for index in (1, 2):
+            creator.create_entry_group(entry_index=index)
+            creator.create_xpcs_group(g2=np.full((5, 2), index), dynamic_roi_map=np.ones((8, 8), dtype=int))
+            creator.create_instrument_group(count_time=0.1, count_time_units='s')
+    materialize(tmp_path / 'series.nxs', tmp_path / 'copy.nxs')
+    with h5py.File(tmp_path / 'copy.nxs', 'r') as f:
+        assert _is_same(f, '/entry_1/instrument', '/entry_2/instrument')
+        assert _is_same(f, '/entry_1/XPCS/instrument/masks', '/entry_2/XPCS/instrument/masks')
+        assert f['/entry_2/instrument/detector/count_time'][()] == 0.1
+        assert f['/entry_2/XPCS/data/g2'][0, 0] == 2
+
+
+def test_series_pipelined(tmp_path):
+    make_aps_file(tmp_path / 'scan.hdf', detector_shape=(128, 128), two_time=False)
+    convert_series([tmp_path / 'scan.hdf'] * 2, tmp_path / 'sequential.nxs', 'aps')
+    convert(tmp_path / 'scan.hdf', tmp_path / 'pipelined.nxs', 'aps', append=True, pipelined=True)
+    convert(tmp_path / 'scan.hdf', tmp_path / 'pipelined.nxs', 'aps', append=True, pipelined=True)
+    with h5py.File(tmp_path / 'sequential.nxs', 'r') as seq, h5py.File(tmp_path / 'pipelined.nxs', 'r') as pipe:
+        for name in ('/entry_1/XPCS/data/g2', '/entry_2/XPCS/data/g2',
+                     '/entry_2/XPCS/instrument/masks/dynamic_roi_map'):
+            assert np.array_equal(seq[name][()], pipe[name][()])
@@ -0,0 +1,59 @@
+import h5py
+import numpy as np
+import pytest
+
+from creator.nx_multitau_xpcs import multi_tau
+from creator.nx_sparse_xpcs import SparseFrames, write_sparse
+
+
+def _stack(seed=5):
+    return np.random.default_rng(seed).poisson(0.05, (60, 12, 10)).astype(np.uint16)
+
+
+def test_sparse_roundtrip(tmp_path):
+    stack = _stack()
+    with h5py.File(tmp_path / 'sparse.h5', 'w') as f:
+        sparse = write_sparse(f.create_group('events'), stack, max_bytes=12 * 10 * 2 * 7)
+        assert sparse.nnz == np.count_nonzero(stack)
+    with h5py.File(tmp_path / 'sparse.h5', 'r') as f:
+        sparse = SparseFrames(f['events'])
+        assert sparse.shape == stack.shape
+        assert np.array_equal(sparse.read(), stack)
+        assert np.array_equal(sparse[5:9, 2], stack[5:9, 2])
+        assert np.array_equal(sparse[-1], stack[-1])
+        assert np.array_equal(sparse.pixel_sum(max_bytes=100), stack.sum(axis=0))
+        assert np.array_equal(sparse.frame_totals(), stack.sum(axis=(1, 2)))
+        roi_map = np.arange(120).reshape(12, 10) % 4
+        sums = sparse.roi_sums(roi_map, max_bytes=100)
+        for roi in (1, 2, 3):
+            assert np.array_equal(sums[:, roi - 1], stack[:, roi_map == roi].sum(axis=1))
+
+
+def test_sparse_multi_tau(tmp_path):
+    stack = _stack(6)
+    roi_map = np.zeros((12, 10), dtype=int)
+    roi_map[:6], roi_map[6:, :5] = 1, 2
+    with h5py.File(tmp_path / 'sparse.h5', 'w') as f:
+        sparse = write_sparse(f.create_group('events'), stack)
+        dense = multi_tau(stack, roi_map, buf=4)
+        for workers in (1, 2):
+            result = multi_tau(sparse, roi_map, buf=4, workers=workers, max_bytes=200)
+            assert np.array_equal(result['delay_difference'], dense['delay_difference'])
+            assert np.allclose(result['G2_unnormalized'], dense['G2_unnormalized'])
+            assert np.allclose(result['g2'], dense['g2'], equal_nan=True)
+
+
+def test_sparse_counts_are_not_saturated(tmp_path):
+    stack = _stack().astype(np.int32)
+    stack[3, 2, 1] = 70000
+    with h5py.File(tmp_path / 'sparse.h5', 'w') as f:
+        sparse = write_sparse(f.create_group('events'), stack)
+        assert sparse.dtype == np.int32
+        assert np.array_equal(sparse.read(), stack)
+        with pytest.raises(ValueError, match='does not fit'):
+            write_sparse(f.create_group('narrow'), stack, count_dtype=np.uint16)
+        with pytest.raises(ValueError, match='non-integer'):
+            write_sparse(f.create_group('float'), stack + 0.5, count_dtype=np.uint32)
+        stack[4, 0, 0] = -1  # bad pixel flag
+        with pytest.raises(ValueError, match='negative'):
+            write_sparse(f.create_group('flagged'), stack)
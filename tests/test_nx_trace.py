@@ -0,0 +1,81 @@
+import json
+import time
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic_xpcs import SCALES, make_aps_file
+from creator import nx_trace_xpcs
+from creator.nx_trace_xpcs import records, span, traced, tracing
+from simple_converter import convert_file
+
+
+@pytest.fixture(autouse=True)
+def _tracing_off():
+    yield
+    nx_trace_xpcs.disable()
+    nx_trace_xpcs.TRACER.clear()
+
+
+def test_conversion_spans(tmp_path):
+    make_aps_file(tmp_path / 'aps.hdf', **SCALES['tiny'])
+    with tracing(jsonl=tmp_path / 'trace.jsonl', prometheus=tmp_path / 'trace.prom'):
+        convert_file(tmp_path / 'aps.hdf', tmp_path / 'out.nxs', 'aps')
+
+    spans = {r['span']: r for r in records()}
+    for name in ('APSLoader.__init__', 'APSLoader.xpcs_md', 'APSLoader._get_c2t',
+                 'NXCreator.create_xpcs_group', 'NXCreator.create_instrument_group',
+                 'NXCreator.check_units', 'NXCreator.write_dataset'):
+        assert name in spans
+    assert spans['APSLoader._get_c2t']['parent'] == 'APSLoader.xpcs_md'
+    g2 = [r for r in records() if r['labels'] == {'field': 'g2'}][0]
+    assert g2['parent'] == 'NXCreator.create_xpcs_group' and g2['depth'] == 1
+    xpcs = spans['NXCreator.create_xpcs_group']
+    assert xpcs['peak_rss_bytes'] >= g2['peak_rss_bytes'] > 0
+    assert xpcs['bytes_written'] > 0
+
+    lines = (tmp_path / 'trace.jsonl').read_text().splitlines()
+    assert [json.loads(line) for line in lines] == json.loads(json.dumps(records()))
+    prom = (tmp_path / 'trace.prom').read_text()
+    assert '# TYPE nxxpcs_span_seconds_total counter' in prom
+    assert 'nxxpcs_span_calls_total{span="NXCreator.create_xpcs_group"} 1' in prom
+    assert 'nxxpcs_span_calls_total{field="g2",span="NXCreator.write_dataset"} 1' in prom
+
+
+def test_nested_span_keeps_parent_peak():
+    if not nx_trace_xpcs.reset_peak_rss():
+        pytest.skip("peak RSS cannot be reset")
+    size = 128 * 2**20
+    with tracing():
+        with span('parent'):
+            buffer = np.ones(size // 8)
+            del buffer
+            with span('child'):
+                pass
+    spans = {r['span']: r for r in records()}
+    assert spans['parent']['peak_rss_bytes'] >= spans['child']['peak_rss_bytes'] + size // 2
+
+
+def test_tracing_off():
+    @traced()
+    def add(a, b):
+        return a + b
+
+    with span('nothing'):
+        assert add(1, 2) == 3
+    assert records() == []
+
+    def plain(a, b):
+        return a + b
+
+    def best(func):
+        seconds = []
+        for _ in range(5):
+            start = time.perf_counter()
+            for _ in range(10000):
+                func(1, 2)
+            seconds.append(time.perf_counter() - start)
+        return min(seconds)
+
+    # one attribute lookup and a call, well below a microsecond per call
+    assert (best(add) - best(plain)) / 10000 < 2e-6
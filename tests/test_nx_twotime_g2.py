@@ -0,0 +1,91 @@
+import tracemalloc
+
+import h5py
+import numpy as np
+
+import creator.nx_twotime_xpcs
+from benchmarks.synthetic_xpcs import make_aps_file, make_nsls_file
+from creator.nx_creator_xpcs import NXCreator
+from creator.nx_twotime_xpcs import g2_from_two_time
+from simple_converter import convert_file
+
+
+def _c2t(n_q, frames, seed=4):
+    c = np.random.default_rng(seed).uniform(1, 2, (n_q, frames, frames))
+    return (c + c.transpose(0, 2, 1)) / 2
+
+
+def test_g2_from_two_time_matches_loops():
+    c2t = _c2t(3, 40)
+    g2, partials = g2_from_two_time(c2t, partials=[0, 10, 25, 40], max_bytes=7 * 3 * 40 * 8)
+    assert g2.shape == (40, 3) and partials.shape == (40, 3, 3)
+    for q in range(3):
+        for tau in (0, 1, 17, 39):
+            diagonal = np.diagonal(c2t[q], tau)
+            assert np.isclose(g2[tau, q], diagonal.mean())
+            assert np.isclose(partials[tau, q, 1], diagonal[10:25].mean() if tau < 30 else np.nan,
+                              equal_nan=True)
+
+
+def test_g2_from_half_storage(tmp_path):
+    c2t = _c2t(2, 30)
+    expected = g2_from_two_time(c2t)
+    for storage in ('packed', 'tiles'):
+        for half in ('upper', 'lower'):
+            with NXCreator(tmp_path / f'{storage}_{half}.nxs', two_time_storage=storage,
+                           two_time_half=half) as creator:
+                creator.init_file()
+                creator.create_entry_group()
+                creator.create_xpcs_group(two_time_corr_func=c2t)
+            with h5py.File(tmp_path / f'{storage}_{half}.nxs', 'r') as f:
+                derived = g2_from_two_time(f['/entry/XPCS/twotime/two_time_corr_func'])
+            assert np.allclose(derived[0], expected[0])
+            assert np.allclose(derived[1], expected[1], equal_nan=True)
+
+
+def test_g2_from_half_storage_memory(tmp_path):
+    frames = 400
+    c2t = _c2t(1, frames)
+    for storage in ('packed', 'tiles'):
+        with NXCreator(tmp_path / f'{storage}.nxs', two_time_storage=storage, two_time_half='lower') as creator:
+            creator.init_file()
+            creator.create_entry_group()
+            creator.create_xpcs_group(two_time_corr_func=c2t)
+        with h5py.File(tmp_path / f'{storage}.nxs', 'r') as f:
+            tracemalloc.start()
+            g2_from_two_time(f['/entry/XPCS/twotime/two_time_corr_func'], max_bytes=64 * 1024)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        # far below the full frames x frames matrix (1.28 MB)
+        assert peak < 0.5 * frames * frames * 8
+
+
+def test_converter_keeps_aps_two_time_g2(tmp_path, monkeypatch):
+    make_aps_file(tmp_path / 'aps.hdf', n_q=2, frames=24)
+
+    def never(*args, **kwargs):
+        raise AssertionError("g2_from_two_time must not be called")
+
+    monkeypatch.setattr(creator.nx_twotime_xpcs, 'g2_from_two_time', never)
+    for reference_mode in (False, True):
+        convert_file(tmp_path / 'aps.hdf', tmp_path / 'out.nxs', 'aps', reference_mode=reference_mode,
+                     derive_g2=True)
+        with h5py.File(tmp_path / 'aps.hdf', 'r') as f, h5py.File(tmp_path / 'out.nxs', 'r') as out:
+            twotime = out['/entry/XPCS/twotime']
+            np.testing.assert_array_equal(twotime['g2_from_two_time_corr_func'][()], f['/exchange/g2full'][()])
+            np.testing.assert_array_equal(twotime['g2_from_two_time_corr_func_partials'][()],
+                                          f['/exchange/g2partials'][()])
+
+
+def test_converter_fills_two_time_g2(tmp_path):
+    make_nsls_file(tmp_path / 'nsls.hdf', n_q=2, frames=24)
+    convert_file(tmp_path / 'nsls.hdf', tmp_path / 'plain.nxs', 'nslsii')
+    with h5py.File(tmp_path / 'plain.nxs', 'r') as f:
+        assert 'g2_from_two_time_corr_func' not in f['/entry/XPCS/twotime']
+    convert_file(tmp_path / 'nsls.hdf', tmp_path / 'out.nxs', 'nslsii', derive_g2=True)
+    with h5py.File(tmp_path / 'nsls.hdf', 'r') as f:
+        expected = g2_from_two_time(f['g12b'])
+    with h5py.File(tmp_path / 'out.nxs', 'r') as f:
+        twotime = f['/entry/XPCS/twotime']
+        assert np.allclose(twotime['g2_from_two_time_corr_func'][()], expected[0])
+        assert twotime['g2_from_two_time_corr_func_partials'].shape == (24, 2, 4)
@@ -0,0 +1,24 @@
+from creator.nx_units import (clear_units_cache, conversion_factor, get_unit_registry, prefixed_unit,
+                              units_cache_info, units_compatible)
+
+
+def test_units_cache():
+    clear_units_cache()
+    assert get_unit_registry() is get_unit_registry()
+    assert units_compatible('keV', 'eV')
+    assert not units_compatible('mm', 's')
+    assert units_compatible('keV', 'eV')
+    info = units_cache_info()
+    assert info['misses'] == 2
+    assert info['hits'] == 1
+
+
+def test_si_prefixes_without_pint():
+    assert prefixed_unit('keV') == ('eV', 3)
+    assert prefixed_unit('mm') == ('m', -3)
+    assert prefixed_unit('1/angstrom') is None
+    assert conversion_factor('um', 'mm') == 0.001
+    assert not units_compatible('ms', 'm')
+    # other units are left to pint
+    assert conversion_factor('min', 's') == 60.0
+    assert units_compatible('nm', 'angstrom')
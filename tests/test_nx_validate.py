@@ -0,0 +1,88 @@
+import time
+
+import h5py
+import numpy as np
+
+from benchmarks.synthetic_xpcs import SCALES, make_aps_file
+from creator.nx_creator_xpcs import NXCreator
+from creator.nx_validate_xpcs import definitions, main, validate
+from simple_converter import convert_file
+
+
+def _errors(issues):
+    return {(path, message) for severity, path, message in issues if severity == 'error'}
+
+
+def _complete_file(filename, **xpcs):
+    with NXCreator(filename) as creator:
+        creator.init_file()
+        creator.create_entry_group()
+        creator.create_xpcs_group(g2=np.ones((5, 2)), dynamic_roi_map=np.ones((4, 4), dtype=int), **xpcs)
+        creator.create_instrument_group(count_time=0.1, count_time_units='s', frame_time=0.1,
+                                        frame_time_units='s', beam_center_x=1.0, beam_center_y=2.0,
+                                        beam_center_units='pixel')
+    with h5py.File(filename, 'a') as f:
+        entry = f['entry']
+        entry['entry_identifier'] = 'scan 7'
+        entry['scan_number'] = 7
+        entry['start_time'] = '2021-06-01T10:00:00'
+        beam = entry['instrument'].create_group('incident_beam')
+        beam.attrs['NX_class'] = 'NXbeam'
+        beam['incident_energy'] = 8.0
+
+
+def test_definitions_index():
+    index, children, enumerated = definitions()['NXxpcs']
+    assert definitions() is definitions()  # parsed once
+    assert index['/entry/scan_number'].required
+    assert not index['/entry/data/g2'].required
+    assert index['/entry/instrument/detector'].nx_type == 'NXdetector'
+    assert index['/entry/twotime/two_time_corr_func@baseline_reference'].enumeration == ('0', '1')
+    assert '/entry/instrument/masks/dynamic_roi_map' in children['/entry/instrument/masks']
+    assert {s.name for s in enumerated['/entry/data/g2']} == {'storage_mode'}
+    assert 'NXarraymask' in definitions()
+
+
+def test_validate_complete_file(tmp_path):
+    _complete_file(tmp_path / 'ok.nxs', two_time_corr_func=np.ones((2, 5, 5)), baseline_reference=1)
+    assert _errors(validate(tmp_path / 'ok.nxs')) == set()
+    assert main([str(tmp_path / 'ok.nxs'), '--errors']) == 0
+
+
+def test_validate_reports_errors(tmp_path):
+    _complete_file(tmp_path / 'bad.nxs', two_time_corr_func=np.ones((2, 5, 5)), baseline_reference=2)
+    with h5py.File(tmp_path / 'bad.nxs', 'a') as f:
+        del f['/entry/scan_number']
+        del f['/entry/instrument/detector/beam_center_y']
+        f['/entry/XPCS/data/g2'].attrs['storage_mode'] = 'two_arrays'
+        del f['/entry/XPCS/instrument/masks/dynamic_roi_map']
+        mask = f['/entry'].create_group('mask')
+        mask.attrs['NX_class'] = 'NXarraymask'
+        mask['usage'] = 'Exclusive'
+    errors = _errors(validate(tmp_path / 'bad.nxs'))
+    assert errors == {
+        ('/entry/scan_number', 'required field is missing'),
+        ('/entry/instrument/detector/beam_center_y', 'required field is missing'),
+        ('/entry/XPCS/instrument/masks/dynamic_roi_map', 'required field is missing'),
+        ('/entry/XPCS/data/g2@storage_mode',
+         "value 'two_arrays' is not one of ['one_array', 'data_exchange_keys', 'other']"),
+        ('/entry/XPCS/twotime/two_time_corr_func@baseline_reference', "value '2' is not one of ['0', '1']"),
+        ('/entry/mask/usage', "value 'Exclusive' is not one of ['Unionable', 'Intersectable', 'Selective']"),
+    }
+    assert main([str(tmp_path / 'bad.nxs')]) == 1
+
+
+def test_validate_converted_file_is_fast(tmp_path):
+    make_aps_file(tmp_path / 'aps.hdf', **SCALES['tiny'])
+    convert_file(tmp_path / 'aps.hdf', tmp_path / 'out.nxs', 'aps', two_time_storage='packed')
+    with h5py.File(tmp_path / 'out.nxs', 'r') as f:
+        issues = validate(f)
+        seconds = []
+        for _ in range(5):
+            start = time.perf_counter()
+            validate(f)
+            seconds.append(time.perf_counter() - start)
+    assert ('/entry/scan_number', 'required field is missing') in _errors(issues)
+    assert not any('storage_mode' in path for _, path, _ in issues)
+    # about 5 ms here, generous bound for slow machines
+    assert min(seconds) < 0.05